@@ -1,50 +1,186 @@
-import json, asyncio
-from typing import Callable, Dict
+import asyncio, time, uuid
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Sequence
 import paho.mqtt.client as mqtt
+from .codec import CODECS, JSON, decode
+from .topic_router import TopicRouter
+
+class RequestStats:
+    """Round-trip latency of :meth:`AsyncMqtt.request`, per request topic."""
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        self._counts: Dict[str, Dict[str, int]] = {}
+
+    def record(self, topic: str, outcome: str, seconds: Optional[float] = None):
+        counts = self._counts.setdefault(topic, {})
+        counts[outcome] = counts.get(outcome, 0) + 1
+        if seconds is not None:
+            self._samples.setdefault(topic, deque(maxlen=self.window)).append(seconds)
+
+    def summary(self) -> Dict[str, Dict]:
+        out = {}
+        for topic, counts in self._counts.items():
+            lat = sorted(self._samples.get(topic, ()))
+            out[topic] = dict(counts, p50_ms=_pct(lat, 0.50), p95_ms=_pct(lat, 0.95), p99_ms=_pct(lat, 0.99),
+                              max_ms=lat[-1] * 1000 if lat else 0.0)
+        return out
+
+def _pct(sorted_s, q: float) -> float:
+    if not sorted_s:
+        return 0.0
+    return sorted_s[min(len(sorted_s) - 1, int(q * len(sorted_s)))] * 1000
 
 class AsyncMqtt:
-    def __init__(self, client_id: str, host: str, port: int, lwt_topic: str):
+    """paho client driven from an asyncio agent.
+
+    paho runs its network loop on its own thread; connection events and
+    incoming messages are handed to the event loop with
+    ``call_soon_threadsafe``, so subscription handlers and :meth:`request`
+    futures only ever run on the loop thread.
+
+    paho reconnects on its own after a broker outage; subscriptions are
+    re-issued on every (re)connect and ``on_online``/``on_offline`` are
+    called on the loop so the agent can republish its status and drain
+    whatever it queued while offline.
+
+    Payloads are sent as JSON until the core answers :meth:`hello` on
+    ``eg/dev/<id>/codec`` with one of the offered ``codecs``; incoming
+    payloads are decoded whatever their format.
+    """
+
+    def __init__(self, client_id: str, host: str, port: int, lwt_topic: str, max_inflight: int = 8,
+                 codecs: Sequence[str] = ("json",)):
         self.client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv5)
         self.client.will_set(lwt_topic, payload="offline", qos=1, retain=True)
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message
+        self.client.on_disconnect = self._on_disconnect
         self.host, self.port = host, port
-        self._handlers: Dict[str, Callable[[str, dict], None]] = {}
-        self._connected = asyncio.Event()
+        self.lwt_topic = lwt_topic
+        self.on_online: Optional[Callable[[], None]] = None
+        self.on_offline: Optional[Callable[[], None]] = None
+        self.device_id = client_id
+        self.res_topic = f"eg/dev/{client_id}/res"
+        self.codecs = list(codecs)
+        self.codec = JSON
+        self.stats = RequestStats()
+        self.max_inflight = max_inflight
+        self._router = TopicRouter()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._connected: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._topics: List[str] = []
+
+    @property
+    def connected(self) -> bool:
+        return self._connected is not None and self._connected.is_set()
 
     def _on_connect(self, client, userdata, flags, reason_code, props=None):
+        self._loop.call_soon_threadsafe(self._online)
+
+    def _on_disconnect(self, client, userdata, *args):
+        self._loop.call_soon_threadsafe(self._offline)
+
+    def _online(self):
+        for topic in self._topics:
+            self.client.subscribe(topic, qos=1)
         self._connected.set()
+        if self.on_online:
+            self.on_online()
+
+    def _offline(self):
+        if not self._connected.is_set():
+            return
+        self._connected.clear()
+        if self.on_offline:
+            self.on_offline()
 
     def _on_message(self, client, userdata, msg):
-        try:
-            payload = json.loads(msg.payload.decode("utf-8")) if msg.payload else {}
-        except Exception:
-            payload = {}
-        for pat, handler in self._handlers.items():
-            if self._match(pat, msg.topic):
-                handler(msg.topic, payload)
-
-    def _match(self, pattern: str, topic: str) -> bool:
-        pp = pattern.split("/")
-        tt = topic.split("/")
-        for i, p in enumerate(pp):
-            if p == "#": return True
-            if i >= len(tt): return False
-            if p == "+" or p == tt[i]: continue
-            return False
-        return len(pp) == len(tt)
-
-    async def connect(self):
-        self.client.connect(self.host, self.port, keepalive=30)
+        payload = decode(msg.payload)
+        self._loop.call_soon_threadsafe(self._dispatch, msg.topic, payload)
+
+    def _dispatch(self, topic: str, payload: dict):
+        for handler in self._router.match(topic):
+            handler(topic, payload)
+
+    async def connect(self, timeout: float = 10):
+        """Start the network loop and wait up to ``timeout`` s for the broker.
+
+        On timeout ``asyncio.TimeoutError`` is raised but paho keeps trying
+        in the background; ``on_online`` fires once it gets through.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._connected = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_inflight)
+        self.subscribe(self.res_topic, self._on_res)
+        self.subscribe(f"eg/dev/{self.device_id}/codec", self._on_codec)
+        self.client.connect_async(self.host, self.port, keepalive=30)
         self.client.loop_start()
-        await asyncio.wait_for(self._connected.wait(), timeout=10)
+        await asyncio.wait_for(self._connected.wait(), timeout=timeout)
 
     def subscribe(self, topic: str, handler: Callable[[str, dict], None]):
-        self._handlers[topic] = handler
-        self.client.subscribe(topic, qos=1)
+        self._router.add(topic, handler)
+        if topic not in self._topics:
+            self._topics.append(topic)
+        if self.connected:
+            self.client.subscribe(topic, qos=1)
 
     def publish(self, topic: str, obj: dict, retain=False):
-        self.client.publish(topic, json.dumps(obj), qos=1, retain=retain)
+        self.client.publish(topic, self.codec.encode(obj), qos=1, retain=retain)
+
+    def hello(self, info: dict):
+        self.publish(f"eg/dev/{self.device_id}/hello", dict(info, codecs=self.codecs))
 
     def set_status_online(self, topic: str):
         self.client.publish(topic, "online", qos=1, retain=True)
+
+    async def request(self, topic: str, payload: dict, timeout: float = 2.0, retries: int = 2,
+                      backoff: float = 0.2) -> dict:
+        """Publish ``payload`` and wait for the ``eg/dev/<id>/res`` reply with the same ``req_id``.
+
+        A timeout or a ``busy`` reply is retried up to ``retries`` times with
+        exponential ``backoff``, re-sending the same ``req_id`` so the core
+        answers a duplicate from its reply cache instead of applying it
+        twice. At most ``max_inflight`` requests are outstanding; further
+        callers wait for a slot. Raises ``asyncio.TimeoutError`` when every
+        attempt timed out.
+        """
+        payload = dict(payload)
+        req_id = payload.setdefault("req_id", uuid.uuid4().hex[:24])
+        async with self._slots:
+            t0 = time.perf_counter()
+            for attempt in range(retries + 1):
+                if attempt:
+                    self.stats.record(topic, "retries")
+                    await asyncio.sleep(backoff * (2 ** (attempt - 1)))
+                fut = self._loop.create_future()
+                self._pending[req_id] = fut
+                self.publish(topic, payload)
+                try:
+                    res = await asyncio.wait_for(fut, timeout)
+                except asyncio.TimeoutError:
+                    continue
+                finally:
+                    self._pending.pop(req_id, None)
+                if res.get("status") == "busy" and attempt < retries:
+                    continue
+                self.stats.record(topic, "replies", time.perf_counter() - t0)
+                return res
+            self.stats.record(topic, "timeouts")
+            raise asyncio.TimeoutError(f"{topic} req_id={req_id}: no reply after {retries + 1} attempts")
+
+    def inflight(self) -> int:
+        return len(self._pending)
+
+    def _on_codec(self, topic: str, msg: dict):
+        name = msg.get("codec")
+        if name in CODECS and name in self.codecs:
+            self.codec = CODECS[name]
+
+    def _on_res(self, topic: str, msg: dict):
+        fut = self._pending.get(msg.get("req_id"))
+        if fut is not None and not fut.done():
+            fut.set_result(msg)
@@ -0,0 +1,158 @@
+import abc, asyncio, logging, re, threading, time
+from typing import List, NamedTuple, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+class TagEvent(NamedTuple):
+    kind: str  # "present" | "removed"
+    tag_uid: str
+    t: float  # time.monotonic() of the read that produced it (same clock as loop.time())
+
+class TagReader(abc.ABC):
+    """Reader backend polled by :class:`TagPipeline` on its own thread.
+
+    ``read(timeout)`` blocks for at most ``timeout`` s and returns the UID
+    currently in the field (upper-case hex) or None.
+    """
+
+    @abc.abstractmethod
+    def read(self, timeout: float) -> Optional[str]:
+        ...
+
+    def close(self):
+        pass
+
+class SerialReader(TagReader):
+    """USB/UART reader that sends the UID as a text line or an STX ... ETX frame (RDM6300 style)."""
+
+    def __init__(self, port: str, baud: int = 9600):
+        try:
+            import serial
+        except ImportError:
+            raise RuntimeError("reader.type=serial needs pyserial (python3 -m pip install pyserial)")
+        self._port = serial.Serial(port, baud, timeout=0.05)
+
+    def read(self, timeout: float) -> Optional[str]:
+        self._port.timeout = timeout
+        # Frame readers send no newline: readline() then returns whatever came in before the timeout.
+        frames = [f for f in re.split(rb"[\x02\x03\r\n]+", self._port.readline()) if f.strip()]
+        return frames[-1].strip().decode("ascii", "ignore").upper() if frames else None
+
+    def close(self):
+        self._port.close()
+
+class SimulatedReader(TagReader):
+    """Replays a scan trace: ``(seconds from start, UID or None)`` field changes.
+
+    Trace files hold one change per line, ``<seconds> <UID>`` or
+    ``<seconds> -`` for an empty field; ``#`` starts a comment. Each read
+    returns after ``poll_ms`` or at the next change, whichever comes first.
+    """
+
+    def __init__(self, trace: List[Tuple[float, Optional[str]]], poll_ms: int = 20):
+        self.trace = sorted(trace)
+        self.poll_s = poll_ms / 1000.0
+        self._t0: Optional[float] = None
+
+    @classmethod
+    def from_file(cls, path: str, poll_ms: int = 20) -> "SimulatedReader":
+        trace = []
+        with open(path) as f:
+            for line in f:
+                parts = line.split("#", 1)[0].split()
+                if len(parts) == 2:
+                    trace.append((float(parts[0]), None if parts[1] == "-" else parts[1].upper()))
+        return cls(trace, poll_ms)
+
+    def read(self, timeout: float) -> Optional[str]:
+        if self._t0 is None:
+            self._t0 = time.monotonic()
+        elapsed = time.monotonic() - self._t0
+        wait = min(timeout, self.poll_s)
+        for at, _ in self.trace:
+            if at > elapsed:
+                wait = min(wait, at - elapsed)
+                break
+        time.sleep(max(0.0, wait))
+        elapsed = time.monotonic() - self._t0
+        uid = None
+        for at, tag in self.trace:
+            if at > elapsed:
+                break
+            uid = tag
+        return uid
+
+class TagPipeline:
+    """Polls a :class:`TagReader` on a dedicated thread and queues debounced tag events.
+
+    A card is ``present`` from the first read that sees it: repeated reads
+    of the same card produce nothing. It is ``removed`` once no read has
+    seen it for ``remove_ms`` (0: only when another card shows up, for
+    readers that report a card once). Events are put on ``queue`` from the
+    event loop thread.
+    """
+
+    def __init__(self, reader: TagReader, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop,
+                 remove_ms: int = 300, poll_ms: int = 20):
+        self.reader = reader
+        self.queue = queue
+        self.loop = loop
+        self.remove_s = remove_ms / 1000.0
+        self.poll_s = poll_ms / 1000.0
+        self.reads = 0
+        self.suppressed = 0
+        self._current: Optional[str] = None
+        self._last_seen = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="rfid-reader", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.reader.close()
+
+    def _emit(self, kind: str, tag_uid: str, t: float):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, TagEvent(kind, tag_uid, t))
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                uid = self.reader.read(self.poll_s)
+            except Exception:
+                log.exception("rfid read failed")
+                self._stop.wait(1.0)
+                continue
+            now = time.monotonic()
+            self.reads += 1
+            if uid is not None:
+                self._last_seen = now
+                if uid == self._current:
+                    self.suppressed += 1
+                    continue
+                if self._current is not None:
+                    self._emit("removed", self._current, now)
+                self._current = uid
+                self._emit("present", uid, now)
+            elif self._current is not None and self.remove_s and now - self._last_seen >= self.remove_s:
+                self._emit("removed", self._current, now)
+                self._current = None
+
+def make_reader(cfg: dict) -> Optional[TagReader]:
+    """Backend for the ``reader`` section of device_config.yaml; None for keyboard-only."""
+    kind = cfg.get("type", "keyboard")
+    if kind == "serial":
+        return SerialReader(cfg.get("port", "/dev/ttyUSB0"), int(cfg.get("baud", 9600)))
+    if kind == "sim":
+        return SimulatedReader.from_file(cfg["trace"], int(cfg.get("poll_ms", 20)))
+    if kind != "keyboard":
+        raise ValueError(f"unknown reader.type {kind!r}")
+    return None
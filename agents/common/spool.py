@@ -0,0 +1,62 @@
+import json, os, sqlite3, time
+from typing import Dict, List, Optional, Tuple
+
+class Spool:
+    """Persistent FIFO of messages that could not be sent, plus last known balances.
+
+    Both live in one small SQLite file on the agent (``spool.db`` next to
+    the config by default) so a power cut loses neither. Messages too old to
+    be replayed safely are moved to the ``expired`` table for a manual
+    check instead of being deleted. Only used from the agent's event loop
+    thread.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS spool(seq INTEGER PRIMARY KEY, ts INTEGER NOT NULL, "
+                           "topic TEXT NOT NULL, payload TEXT NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS expired(seq INTEGER PRIMARY KEY, ts INTEGER NOT NULL, "
+                           "topic TEXT NOT NULL, payload TEXT NOT NULL, expired_at INTEGER NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS balances(tag_uid TEXT PRIMARY KEY, balance_cents INTEGER "
+                           "NOT NULL, updated_at INTEGER NOT NULL)")
+
+    def put(self, topic: str, payload: Dict) -> int:
+        cur = self._conn.execute("INSERT INTO spool(ts, topic, payload) VALUES(?,?,?)",
+                                 (int(time.time()), topic, json.dumps(payload)))
+        return cur.lastrowid
+
+    def peek(self, limit: int = 1) -> List[Tuple[int, int, str, Dict]]:
+        """Oldest (seq, ts, topic, payload) rows, ``ts`` being when they were spooled."""
+        rows = self._conn.execute("SELECT seq, ts, topic, payload FROM spool ORDER BY seq LIMIT ?", (limit,)).fetchall()
+        return [(seq, ts, topic, json.loads(payload)) for seq, ts, topic, payload in rows]
+
+    def ack(self, seq: int):
+        self._conn.execute("DELETE FROM spool WHERE seq=?", (seq,))
+
+    def expire(self, seq: int):
+        self._conn.execute("BEGIN")
+        self._conn.execute("INSERT INTO expired(seq, ts, topic, payload, expired_at) "
+                           "SELECT seq, ts, topic, payload, ? FROM spool WHERE seq=?", (int(time.time()), seq))
+        self._conn.execute("DELETE FROM spool WHERE seq=?", (seq,))
+        self._conn.execute("COMMIT")
+
+    def expired(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM expired").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def get_balance(self, tag_uid: str) -> Optional[int]:
+        row = self._conn.execute("SELECT balance_cents FROM balances WHERE tag_uid=?", (tag_uid,)).fetchone()
+        return row[0] if row else None
+
+    def set_balance(self, tag_uid: str, balance_cents: int):
+        self._conn.execute("INSERT INTO balances(tag_uid, balance_cents, updated_at) VALUES(?,?,?) "
+                           "ON CONFLICT(tag_uid) DO UPDATE SET balance_cents=excluded.balance_cents, "
+                           "updated_at=excluded.updated_at", (tag_uid, balance_cents, int(time.time())))
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,120 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+# Shared between the core (core/app/topic_router.py) and the agents
+# (agents/common/topic_router.py); keep both copies identical
+# (tests/test_topic_router.py fails when they differ).
+
+SHARE_PREFIX = "$share/"
+
+def strip_share(pattern: str) -> str:
+    """``$share/<group>/<filter>`` -> ``<filter>``; other patterns are returned unchanged."""
+    if pattern.startswith(SHARE_PREFIX):
+        parts = pattern.split("/", 2)
+        return parts[2] if len(parts) == 3 else ""
+    return pattern
+
+class _Node:
+    __slots__ = ("children", "plus", "exact", "multi")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.plus: Optional["_Node"] = None
+        self.exact: List[Tuple[int, Any]] = []  # subscriptions ending at this level
+        self.multi: List[Tuple[int, Any]] = []  # subscriptions ending with '#' below this level
+
+class TopicRouter:
+    """Subscription trie resolving a topic to every matching handler.
+
+    Supports ``+``/``#`` wildcards and ``$share/<group>/`` prefixes. Lookup
+    cost depends on the topic depth rather than the number of subscriptions,
+    and the handler tuples of recently seen topics are kept in a bounded LRU
+    cache that is invalidated whenever subscriptions change. Handlers are
+    returned in subscription order.
+    """
+
+    def __init__(self, cache_size: int = 1024):
+        self.cache_size = cache_size
+        self._root = _Node()
+        self._seq = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, Tuple[Any, ...]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, pattern: str, handler: Any):
+        with self._lock:
+            slot = self._slot(strip_share(pattern), create=True)
+            if any(h == handler for _, h in slot):
+                return
+            self._seq += 1
+            slot.append((self._seq, handler))
+            self._count += 1
+            self._cache.clear()
+
+    def remove(self, pattern: str, handler: Any = None) -> bool:
+        with self._lock:
+            slot = self._slot(strip_share(pattern), create=False)
+            if not slot:
+                return False
+            keep = [(s, h) for s, h in slot if handler is not None and h != handler]
+            removed = len(slot) - len(keep)
+            slot[:] = keep
+            self._count -= removed
+            self._cache.clear()
+            return removed > 0
+
+    def match(self, topic: str) -> Tuple[Any, ...]:
+        with self._lock:
+            hit = self._cache.get(topic)
+            if hit is not None:
+                self._cache.move_to_end(topic)
+                return hit
+            found: List[Tuple[int, Any]] = []
+            self._collect(self._root, topic.split("/"), 0, found)
+            found.sort(key=lambda e: e[0])
+            result = tuple(h for _, h in found)
+            self._cache[topic] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return result
+
+    def _slot(self, pattern: str, create: bool) -> Optional[List[Tuple[int, Any]]]:
+        node = self._root
+        parts = pattern.split("/")
+        for i, p in enumerate(parts):
+            if p == "#":
+                if i != len(parts) - 1:
+                    raise ValueError(f"'#' must be the last level: {pattern}")
+                return node.multi
+            if p == "+":
+                if node.plus is None:
+                    if not create:
+                        return None
+                    node.plus = _Node()
+                node = node.plus
+            else:
+                child = node.children.get(p)
+                if child is None:
+                    if not create:
+                        return None
+                    child = node.children[p] = _Node()
+                node = child
+        return node.exact
+
+    def _collect(self, node: _Node, parts: List[str], i: int, out: List[Tuple[int, Any]]):
+        # Wildcards never match a leading '$' level ($SYS, ...).
+        wild = i > 0 or not parts[0].startswith("$")
+        if wild and node.multi:
+            out.extend(node.multi)
+        if i == len(parts):
+            out.extend(node.exact)
+            return
+        child = node.children.get(parts[i])
+        if child is not None:
+            self._collect(child, parts, i + 1, out)
+        if wild and node.plus is not None:
+            self._collect(node.plus, parts, i + 1, out)
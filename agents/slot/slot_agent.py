@@ -1,11 +1,17 @@
-import asyncio, yaml, uuid, sys, os
+import asyncio, yaml, uuid, sys, os, time
 # Ensure parent dir (/agents) is on sys.path for 'common' import
 CURRENT_DIR = os.path.dirname(__file__)
 PARENT_DIR = os.path.abspath(os.path.join(CURRENT_DIR, ".."))
 if PARENT_DIR not in sys.path:
     sys.path.append(PARENT_DIR)
 
-from common.mqtt_async import AsyncMqtt
+from common.mqtt_async import AsyncMqtt, RequestStats
+from common.rfid import TagEvent, TagPipeline, make_reader
+from common.spool import Spool
+
+# Requests that may be spooled while offline and replayed later (same req_id,
+# so the core dedupes a replay it already applied). Debits never are.
+SPOOLABLE = ("eg/core/wallet/credit", "eg/night/vote")
 
 def ulid_like():
     return uuid.uuid4().hex[:24]
@@ -20,35 +26,176 @@ class SlotAgent:
         self.dev_mode = cfg.get("dev_mode", True)
         self.bet_amount = int(cfg.get("bet_amount_cents", 200))
         self.credit_amount = int(cfg.get("credit_amount_cents", 500))
+        self.request_timeout = int(cfg.get("request_timeout_ms", 2000)) / 1000.0
+        self.request_retries = int(cfg.get("request_retries", 2))
+        self.spool_rate = float(cfg.get("spool_rate", 10))
+        self.spool_max_age = int(cfg.get("spool_max_age_s", 82800))
+        spool_path = cfg.get("spool_path") or os.path.join(os.path.dirname(os.path.abspath(config_path)),
+                                                           f"spool-{self.device_id}.db")
+        self.spool = Spool(spool_path)
+        self._draining = False
         self.tag_uid = None
         self.mode = "day"
         self.bus = AsyncMqtt(client_id=self.device_id, host=self.host, port=self.port,
-                             lwt_topic=f"eg/dev/{self.device_id}/status")
+                             lwt_topic=f"eg/dev/{self.device_id}/status",
+                             max_inflight=int(cfg.get("max_inflight", 8)),
+                             codecs=cfg.get("codecs", ["json"]))
+        self._tasks = set()
+        reader_cfg = dict(cfg.get("reader") or {})
+        if reader_cfg.get("trace"):
+            reader_cfg["trace"] = os.path.join(os.path.dirname(os.path.abspath(config_path)), reader_cfg["trace"])
+        self.reader = make_reader(reader_cfg)
+        self.reader_remove_ms = int(reader_cfg.get("remove_ms", 300))
+        self.reader_poll_ms = int(reader_cfg.get("poll_ms", 20))
+        self.pipeline = None
+        # Scan (reader detection or keyboard "r") to balance on screen.
+        self.scan_stats = RequestStats()
 
     async def run(self):
-        await self.bus.connect()
-        self.bus.set_status_online(f"eg/dev/{self.device_id}/status")
-        self.bus.publish(f"eg/dev/{self.device_id}/hello",
-                         {"type":"slot","version":"1.0.0","ts": asyncio.get_event_loop().time()})
         self.bus.subscribe("eg/state/mode", self.on_mode)
-        self.bus.subscribe(f"eg/dev/{self.device_id}/res", self.on_res)
         self.bus.subscribe("eg/night/step", self.on_night_step)
-        print(f"[{self.device_id}] Connected. Dev mode: {self.dev_mode}.")
-        print("Keyboard: r <UID> (scan), b (bet), c (credit), v <A|B|C> (vote), balance, q")
-        await self.keyboard_loop()
+        # Current step, sent by the core to this slot only when it comes online mid-step.
+        self.bus.subscribe(f"eg/dev/{self.device_id}/night/step", self.on_night_step)
+        self.bus.on_online = self.on_online
+        self.bus.on_offline = lambda: print(f"[{self.device_id}] Offline: credits/votes go to the spool, bets refused.")
+        try:
+            await self.bus.connect()
+            print(f"[{self.device_id}] Connected. Dev mode: {self.dev_mode}.")
+        except asyncio.TimeoutError:
+            print(f"[{self.device_id}] Broker unreachable, starting offline ({len(self.spool)} spooled).")
+        if self.reader:
+            tags: asyncio.Queue = asyncio.Queue()
+            self.pipeline = TagPipeline(self.reader, tags, asyncio.get_running_loop(),
+                                        remove_ms=self.reader_remove_ms, poll_ms=self.reader_poll_ms)
+            self.pipeline.start()
+            self.spawn(self.tag_loop(tags))
+        print("Keyboard: r <UID> (scan), b (bet), c (credit), s [win] (spin), v <A|B|C> (vote), balance, stats, q")
+        try:
+            await self.keyboard_loop()
+        finally:
+            if self.pipeline:
+                self.pipeline.stop()
+            self.print_stats()
+
+    async def tag_loop(self, tags: asyncio.Queue):
+        while True:
+            self.on_tag(await tags.get())
+
+    def on_tag(self, ev: TagEvent):
+        if ev.kind == "removed":
+            if self.tag_uid == ev.tag_uid:
+                self.tag_uid = None
+                print(f"[{self.device_id}] TAG removed: {ev.tag_uid}")
+            return
+        self.tag_uid = ev.tag_uid
+        print(f"TAG set: {self.tag_uid}")
+        # Balance prefetch: the request leaves as soon as the card is seen.
+        self.spawn(self.publish_wallet_get(scanned_at=ev.t))
+
+    def on_online(self):
+        self.bus.set_status_online(f"eg/dev/{self.device_id}/status")
+        self.bus.hello({"type":"slot","version":"1.0.0","ts": asyncio.get_event_loop().time()})
+        self.drain()
 
     def on_mode(self, topic, msg):
         self.mode = msg.get("mode", "day")
         print(f"[{self.device_id}] Mode now: {self.mode}")
 
-    def on_res(self, topic, msg):
+    async def call(self, topic: str, payload: dict):
+        t0 = asyncio.get_running_loop().time()
+        try:
+            res = await self.bus.request(topic, payload, timeout=self.request_timeout, retries=self.request_retries)
+        except asyncio.TimeoutError as e:
+            if topic in SPOOLABLE:
+                self.spool.put(topic, payload)
+                print(f"[{self.device_id}] {topic} timed out, spooled ({len(self.spool)} pending)")
+            else:
+                print(f"[{self.device_id}] {topic} timed out: {e}")
+            return None
+        self.reconcile(payload.get("tag_uid"), res)
+        self.on_res(res, (asyncio.get_running_loop().time() - t0) * 1000)
+        self.drain()
+        return res
+
+    def send(self, topic: str, payload: dict) -> bool:
+        """Spoolable request: spool it if offline or older ones are still queued (keeps order)."""
+        if self.bus.connected and not len(self.spool):
+            return True
+        self.spool.put(topic, payload)
+        print(f"[{self.device_id}] Offline: {topic} spooled ({len(self.spool)} pending)")
+        return False
+
+    def drain(self):
+        if self.bus.connected and not self._draining and len(self.spool):
+            self.spawn(self._drain())
+
+    async def _drain(self):
+        # Replay in order, rate limited; stop at the first timeout and wait for the next reconnect/success.
+        self._draining = True
+        try:
+            while self.bus.connected:
+                rows = self.spool.peek(1)
+                if not rows:
+                    print(f"[{self.device_id}] Spool drained.")
+                    return
+                seq, ts, topic, payload = rows[0]
+                if time.time() - ts > self.spool_max_age:
+                    # The core may no longer know whether it applied this req_id: never replay it blind.
+                    self.spool.expire(seq)
+                    print(f"[{self.device_id}] {topic} {payload.get('req_id')} spooled too long ago, "
+                          f"moved to expired ({self.spool.expired()} to check)")
+                    continue
+                payload = dict(payload, spooled_at=ts)
+                if topic == "eg/night/vote":
+                    self.bus.publish(topic, payload)
+                else:
+                    try:
+                        res = await self.bus.request(topic, payload, timeout=self.request_timeout,
+                                                     retries=self.request_retries)
+                    except asyncio.TimeoutError:
+                        return
+                    self.reconcile(payload.get("tag_uid"), res)
+                self.spool.ack(seq)
+                await asyncio.sleep(1.0 / self.spool_rate)
+        finally:
+            self._draining = False
+
+    def cached_balance(self, tag_uid: str):
+        return self.spool.get_balance(tag_uid)
+
+    def reconcile(self, tag_uid, res: dict):
+        """Replace the optimistic balance with the core's answer."""
+        if res.get("type") == "wallet_batch":
+            for tag, bal in (res.get("balances") or {}).items():
+                self.spool.set_balance(tag, bal)
+            return
+        bal = res.get("balance_cents", res.get("new_balance_cents"))
+        if tag_uid and bal is not None:
+            self.spool.set_balance(tag_uid, bal)
+
+    def show_optimistic(self, delta: int, what: str) -> bool:
+        bal = self.cached_balance(self.tag_uid)
+        if bal is not None:
+            print(f"[{self.device_id}] {what}: ~{bal + delta} cents (unconfirmed)")
+        return bal is not None
+
+    def spawn(self, coro):
+        # Requests are pipelined: the keyboard never waits on the core.
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def on_res(self, msg, latency_ms: float):
         t = msg.get("type")
+        print(f"[{self.device_id}] ({latency_ms:.1f} ms)", end=" ")
         if t == "wallet_get":
-            print(f"[{self.device_id}] Balance: {msg.get('balance_cents')} cents")
+            print(f"Balance: {msg.get('balance_cents')} cents")
         elif t in ("wallet_debit", "wallet_credit"):
-            print(f"[{self.device_id}] {t} -> {msg.get('status')} | new_balance={msg.get('new_balance_cents')}")
+            print(f"{t} -> {msg.get('status')} | new_balance={msg.get('new_balance_cents')}")
+        elif t == "wallet_batch":
+            print(f"{t} -> {msg.get('status')} | balances={msg.get('balances')}")
         else:
-            print(f"[{self.device_id}] Response: {msg}")
+            print(f"Response: {msg}")
 
     def on_night_step(self, topic, msg):
         step = msg.get("step")
@@ -56,21 +203,39 @@ class SlotAgent:
         opts = msg.get("options")
         print(f"[{self.device_id}] NIGHT STEP {step}: {q} options={opts}")
 
-    def publish_wallet_get(self):
+    async def publish_wallet_get(self, scanned_at: float = None):
         if not self.tag_uid:
             print("No tag. Use: r <UID>")
             return
-        self.bus.publish("eg/core/wallet/get", {
+        loop = asyncio.get_running_loop()
+        if self.show_optimistic(0, "Balance") and scanned_at is not None:
+            self.scan_stats.record("scan->cached", "ok", loop.time() - scanned_at)
+        if not self.bus.connected:
+            if scanned_at is not None:
+                self.scan_stats.record("scan->balance", "offline")
+            return
+        res = await self.call("eg/core/wallet/get", {
             "req_id": ulid_like(),
             "device_id": self.device_id,
             "tag_uid": self.tag_uid
         })
+        if scanned_at is not None:
+            if res is None:
+                self.scan_stats.record("scan->balance", "timeout")
+            else:
+                elapsed = loop.time() - scanned_at
+                self.scan_stats.record("scan->balance", "ok", elapsed)
+                print(f"[{self.device_id}] scan->balance {elapsed * 1000:.1f} ms")
 
-    def publish_bet(self):
+    async def publish_bet(self):
         if not self.tag_uid:
             print("No tag. Use: r <UID>")
             return
-        self.bus.publish("eg/core/wallet/debit", {
+        if not self.bus.connected:
+            print(f"[{self.device_id}] Offline: bets need the core.")
+            return
+        self.show_optimistic(-self.bet_amount, "Bet")
+        await self.call("eg/core/wallet/debit", {
             "req_id": ulid_like(),
             "device_id": self.device_id,
             "tag_uid": self.tag_uid,
@@ -78,25 +243,50 @@ class SlotAgent:
             "reason": "slot_bet"
         })
 
-    def publish_credit(self):
+    async def publish_credit(self):
         if not self.tag_uid:
             print("No tag. Use: r <UID>")
             return
-        self.bus.publish("eg/core/wallet/credit", {
+        payload = {
             "req_id": ulid_like(),
             "device_id": self.device_id,
             "tag_uid": self.tag_uid,
             "amount_cents": self.credit_amount,
             "reason": "slot_win"
+        }
+        self.show_optimistic(self.credit_amount, "Credit")
+        cached = self.cached_balance(self.tag_uid)
+        if not self.send("eg/core/wallet/credit", payload):
+            if cached is not None:
+                self.spool.set_balance(self.tag_uid, cached + self.credit_amount)
+            return
+        await self.call("eg/core/wallet/credit", payload)
+
+    async def publish_spin(self, win_cents: int = 0):
+        # Bet + win settled atomically in one round trip.
+        if not self.tag_uid:
+            print("No tag. Use: r <UID>")
+            return
+        if not self.bus.connected:
+            print(f"[{self.device_id}] Offline: bets need the core.")
+            return
+        self.show_optimistic(win_cents - self.bet_amount, "Spin")
+        await self.call("eg/core/wallet/batch", {
+            "req_id": ulid_like(),
+            "device_id": self.device_id,
+            "ops": [{"op": "settle_spin", "tag_uid": self.tag_uid,
+                     "bet_cents": self.bet_amount, "win_cents": win_cents}]
         })
 
     def publish_vote(self, choice: str, step: int = None):
-        self.bus.publish("eg/night/vote", {
+        payload = {
             "device_id": self.device_id,
             "step": step or 1,
             "choice": choice,
             "ts": str(asyncio.get_event_loop().time())
-        })
+        }
+        if self.send("eg/night/vote", payload):
+            self.bus.publish("eg/night/vote", payload)
 
     async def keyboard_loop(self):
         loop = asyncio.get_event_loop()
@@ -111,20 +301,32 @@ class SlotAgent:
                 print("Bye.")
                 break
             if line.startswith("r "):
-                self.tag_uid = line.split(" ",1)[1].strip().upper()
-                print(f"TAG set: {self.tag_uid}")
-                self.publish_wallet_get()
+                self.on_tag(TagEvent("present", line.split(" ",1)[1].strip().upper(), loop.time()))
             elif line == "b":
-                self.publish_bet()
+                self.spawn(self.publish_bet())
             elif line == "c":
-                self.publish_credit()
+                self.spawn(self.publish_credit())
+            elif line == "s" or line.startswith("s "):
+                arg = line[1:].strip()
+                self.spawn(self.publish_spin(int(arg) if arg.isdigit() else 0))
             elif line.startswith("v "):
                 choice = line.split(" ",1)[1].strip().upper()
                 self.publish_vote(choice)
             elif line == "balance":
-                self.publish_wallet_get()
+                self.spawn(self.publish_wallet_get())
+            elif line == "stats":
+                self.print_stats()
             else:
-                print("Commands: r <UID>, b, c, v <A|B|C>, balance, q")
+                print("Commands: r <UID>, b, c, s [win], v <A|B|C>, balance, stats, q")
+
+    def print_stats(self):
+        for topic, s in self.bus.stats.summary().items():
+            print(f"  {topic}: {s}")
+        for what, s in self.scan_stats.summary().items():
+            print(f"  {what}: {s}")
+        if self.pipeline:
+            print(f"  reader: {self.pipeline.reads} reads, {self.pipeline.suppressed} repeats suppressed")
+        print(f"  spool: {len(self.spool)} pending")
 
 if __name__ == "__main__":
     cfg = sys.argv[1] if len(sys.argv) > 1 else "device_config.yaml"
@@ -0,0 +1,171 @@
+import asyncio, logging, time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from .codec import CODECS, JSON, decode
+from .metrics import metrics, profiler, topic_label
+from .topic_router import TopicRouter
+
+log = logging.getLogger(__name__)
+
+class AsyncMqttBus:
+    """MqttBus variant whose network I/O runs on the asyncio (uvicorn) loop.
+
+    paho's external-socket hooks register its socket with the loop instead
+    of starting the ``loop_start`` thread, and every message becomes a task
+    running the (coroutine) handlers. Messages are acknowledged manually
+    once their handlers finished. At most ``max_inflight`` are processed at
+    a time: the broker is told so through MQTTv5 Receive Maximum (it stops
+    delivering until acks come back), and locally the socket stops being
+    read when the cap is reached, so a slow DB queue backs up all the way
+    to the broker. Same public API as :class:`MqttBus`;
+    ``publish`` may be called from any thread.
+    """
+
+    def __init__(self, client_id: str, host: str, port: int, max_inflight: int = 256):
+        self.client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv5, transport="tcp", manual_ack=True)
+        self.client.enable_logger()
+        self.host, self.port = host, port
+        self.max_inflight = max(1, max_inflight)
+        self._router = TopicRouter()
+        self._topics: List[str] = []
+        self._codecs: Dict[str, object] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._sock = None
+        self._misc: Optional[asyncio.Task] = None
+        self._inflight = 0
+        self._backlog: Deque[Tuple] = deque()
+        self._paused = False
+        self._stopping = False
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = lambda c, u, sock: self._loop.add_writer(sock, c.loop_write)
+        self.client.on_socket_unregister_write = lambda c, u, sock: self._loop.remove_writer(sock)
+        metrics.gauge("eg_mqtt_inflight", lambda: self._inflight, "MQTT messages being handled (asyncio core)")
+
+    def connect(self):
+        """Open the connection from the running loop; CONNACK and SUBACKs arrive asynchronously."""
+        self._loop = asyncio.get_running_loop()
+        self._stopping = False
+        props = Properties(PacketTypes.CONNECT)
+        props.ReceiveMaximum = min(self.max_inflight, 65535)
+        self.client.connect(self.host, self.port, keepalive=30, properties=props)
+
+    def disconnect(self):
+        self._stopping = True
+        self._call(self.client.disconnect)
+
+    def _on_connect(self, client, userdata, flags, reason_code, props=None):
+        # Covers subscriptions made before CONNACK and the clean session after a reconnect.
+        for topic in self._topics:
+            client.subscribe(topic, qos=1)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._sock = sock
+        self._paused = False
+        self._loop.add_reader(sock, client.loop_read)
+        self._misc = self._loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        if not self._paused:
+            self._loop.remove_reader(sock)
+        self._sock = None
+
+    async def _misc_loop(self):
+        # Keepalive/retries, then reconnect with backoff until shutdown.
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+        delay = 1.0
+        while not self._stopping and self._sock is None:
+            await asyncio.sleep(delay)
+            try:
+                self.client.reconnect()
+                return
+            except Exception as e:
+                log.warning("MQTT reconnect failed: %s", e)
+                delay = min(delay * 2, 30.0)
+
+    def set_codec(self, device_id: str, name: str):
+        if name == JSON.name:
+            self._codecs.pop(device_id, None)
+        else:
+            self._codecs[device_id] = CODECS[name]
+
+    def subscribe(self, topic: str, handler: Callable):
+        self._router.add(topic, atimed(handler))
+        if topic not in self._topics:
+            self._topics.append(topic)
+        if self.client.is_connected():
+            self._call(self.client.subscribe, topic, 1)
+
+    def publish(self, topic: str, obj: dict, retain: bool = False) -> bool:
+        metrics.inc("eg_mqtt_published_total", topic=topic_label(topic))
+        codec = JSON
+        if self._codecs and topic.startswith("eg/dev/"):
+            codec = self._codecs.get(topic.split("/", 3)[2], JSON)
+        self._call(self.client.publish, topic, codec.encode(obj), 1, retain)
+        return True
+
+    def _call(self, fn: Callable, *args):
+        # paho registers its socket with the loop from inside these calls, so they must run on the loop thread.
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop or self._loop is None:
+            fn(*args)
+        else:
+            self._loop.call_soon_threadsafe(fn, *args)
+
+    def _on_message(self, client, userdata, msg):
+        metrics.inc("eg_mqtt_messages_total", topic=topic_label(msg.topic))
+        item = (self._router.match(msg.topic), msg.topic, decode(msg.payload), msg.mid, msg.qos)
+        if self._inflight < self.max_inflight:
+            self._start(item)
+            return
+        # One loop_read() can carry several packets: park the extra ones and stop reading.
+        self._backlog.append(item)
+        if not self._paused and self._sock is not None:
+            self._paused = True
+            self._loop.remove_reader(self._sock)
+
+    def _start(self, item: Tuple):
+        self._inflight += 1
+        self._loop.create_task(self._handle(*item))
+
+    async def _handle(self, handlers: List[Callable], topic: str, payload: dict, mid: int, qos: int):
+        try:
+            for handler in handlers:
+                try:
+                    await handler(topic, payload)
+                except Exception:
+                    log.exception("handler failed for %s", topic)
+        finally:
+            self.client.ack(mid, qos)
+            self._inflight -= 1
+            if self._backlog:
+                self._start(self._backlog.popleft())
+            elif self._paused and self._sock is not None:
+                self._paused = False
+                self._loop.add_reader(self._sock, self.client.loop_read)
+
+def atimed(handler: Callable) -> Callable:
+    """Coroutine counterpart of :func:`mqtt_bus.timed`; plain functions are called as-is."""
+    name = getattr(handler, "__name__", repr(handler))
+    is_coro = asyncio.iscoroutinefunction(handler)
+
+    async def run(topic: str, payload: dict):
+        t0 = time.perf_counter()
+        try:
+            if is_coro:
+                await handler(topic, payload)
+            else:
+                profiler.call(name, handler, topic, payload)
+        finally:
+            metrics.observe("eg_handler_seconds", time.perf_counter() - t0, handler=name)
+    run.__name__ = name
+    return run
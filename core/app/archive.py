@@ -0,0 +1,110 @@
+import gzip, json, logging, os, threading, time
+from typing import Callable, Dict, List, Optional, Tuple
+from .db import DB
+
+log = logging.getLogger(__name__)
+
+class TxArchiver:
+    """Moves closed sessions out of ``tx_log`` into gzip JSONL files.
+
+    A session runs from ``session_start_hour`` (local time) to the same hour
+    the next day, so one evening of play lands in one file. Sessions that
+    ended more than ``retention_days`` ago are written to
+    ``<directory>/tx-<session>-<first id>-<last id>.jsonl.gz`` and then
+    deleted from the database, their per-tag credit/debit totals being
+    folded into ``tx_archive_totals`` in the same transaction. A file is
+    fsynced and renamed into place before its rows are deleted; if the core
+    dies in between, the next run rewrites the same file name. With
+    ``max_id`` (the ledger engine's last checkpoint) rows after that id stay
+    in the database until a checkpoint covers them. ``writer(fn, *args)``
+    runs the deletions (see :class:`db_executor.DBExecutor`).
+    """
+
+    def __init__(self, db: DB, directory: str, retention_days: int = 3, session_start_hour: int = 12,
+                 interval_s: float = 3600.0, chunk_rows: int = 10000, max_id: Optional[Callable[[], int]] = None,
+                 writer: Optional[Callable] = None):
+        self.db = db
+        self.writer = writer or (lambda fn, *args: fn(*args))
+        self.directory = directory
+        self.retention_days = retention_days
+        self.session_start_hour = session_start_hour
+        self.interval_s = interval_s
+        self.chunk_rows = chunk_rows
+        self.max_id = max_id
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def session_of(self, ts: int) -> str:
+        return time.strftime("%Y-%m-%d", time.localtime(ts - self.session_start_hour * 3600))
+
+    def cutoff(self, now: Optional[float] = None) -> int:
+        """Start of the oldest session still kept in the database."""
+        t = time.localtime((now or time.time()) - self.session_start_hour * 3600)
+        day = time.mktime((t.tm_year, t.tm_mon, t.tm_mday - self.retention_days, 0, 0, 0, 0, 0, -1))
+        return int(day) + self.session_start_hour * 3600
+
+    def start(self):
+        if self._thread or self.retention_days <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="tx-archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self, now: Optional[float] = None) -> List[str]:
+        """Archive everything before :meth:`cutoff`; returns the files written."""
+        with self._lock:
+            cutoff = self.cutoff(now)
+            files: List[str] = []
+            while True:
+                rows = self.db.tx_before(cutoff, limit=self.chunk_rows)
+                if self.max_id:
+                    ceiling = self.max_id()
+                    rows = [r for r in rows if r["id"] <= ceiling]
+                if not rows:
+                    return files
+                sessions: Dict[str, List[Dict]] = {}
+                for r in rows:
+                    sessions.setdefault(self.session_of(r["ts"]), []).append(r)
+                for session, items in sessions.items():
+                    files.append(self._write(session, items))
+                self.writer(self.db.archive_tx, rows[-1]["id"], _totals(rows))
+                log.info("archived %d tx_log rows up to id %d", len(rows), rows[-1]["id"])
+
+    def _write(self, session: str, rows: List[Dict]) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"tx-{session}-{rows[0]['id']}-{rows[-1]['id']}.jsonl.gz"
+        path = os.path.join(self.directory, name)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as raw:
+            with gzip.GzipFile(filename=name[:-3], mode="wb", fileobj=raw) as gz:
+                for r in rows:
+                    gz.write((json.dumps(r, separators=(",", ":")) + "\n").encode("utf-8"))
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp, path)
+        return path
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            try:
+                self.run_once()
+            except Exception:
+                log.exception("tx_log archival failed")
+
+def _totals(rows: List[Dict]) -> Dict[str, Tuple[int, int, int]]:
+    out: Dict[str, Tuple[int, int, int]] = {}
+    for r in rows:
+        credit, debit, n = out.get(r["tag_uid"], (0, 0, 0))
+        if r["op"] == "credit":
+            credit += r["amount_cents"] or 0
+        elif r["op"] == "debit":
+            debit += r["amount_cents"] or 0
+        out[r["tag_uid"]] = (credit, debit, n + 1)
+    return out
@@ -0,0 +1,130 @@
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+# Operations accepted by eg/core/wallet/batch, applied in order:
+#   {"op":"debit","tag_uid","amount_cents","reason"?}
+#   {"op":"credit","tag_uid","amount_cents","reason"?}
+#   {"op":"settle_spin","tag_uid","bet_cents","win_cents","reason"?}   debit bet, then credit win
+#   {"op":"payout_claim","tag_uid","payout_id"}
+OPS = ("debit", "credit", "settle_spin", "payout_claim")
+
+@dataclass
+class BatchPlan:
+    status: str = "ok"
+    failed_op: Optional[int] = None
+    balances: Dict[str, int] = field(default_factory=dict)
+    results: List[Dict] = field(default_factory=list)
+    txs: List[Tuple] = field(default_factory=list)
+    claims: List[Tuple[str, int, str]] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return self.status == "ok"
+
+def batch_keys(ops: List[Dict]) -> Tuple[Set[str], Set[str]]:
+    """Validate the ops and return the (tag_uids, payout_ids) they touch; raises ValueError."""
+    if not isinstance(ops, list) or not ops:
+        raise ValueError("ops must be a non-empty list")
+    tags, payout_ids = set(), set()
+    for i, op in enumerate(ops):
+        kind = op.get("op") if isinstance(op, dict) else None
+        if kind not in OPS:
+            raise ValueError(f"op {i}: unknown op {kind!r}")
+        if not op.get("tag_uid"):
+            raise ValueError(f"op {i}: tag_uid required")
+        tags.add(op["tag_uid"])
+        if kind in ("debit", "credit"):
+            _amount(op, "amount_cents", i)
+        elif kind == "settle_spin":
+            _amount(op, "bet_cents", i)
+            _amount(op, "win_cents", i, allow_zero=True)
+        elif not op.get("payout_id"):
+            raise ValueError(f"op {i}: payout_id required")
+        else:
+            payout_ids.add(op["payout_id"])
+    return tags, payout_ids
+
+def plan_batch(device_id: str, ops: List[Dict], balances: Dict[str, int], payouts: Dict[str, Optional[Dict]],
+               ts: int) -> BatchPlan:
+    """Apply ``ops`` to copies of ``balances``/``payouts`` and return the resulting writes.
+
+    All or nothing: the first op that fails sets ``status``/``failed_op``
+    and the plan carries no writes, with ``balances`` left at their
+    starting values.
+    """
+    bal = dict(balances)
+    claimed: Set[str] = set()
+    plan = BatchPlan()
+    for i, op in enumerate(ops):
+        kind, tag = op["op"], op["tag_uid"]
+        if kind in ("debit", "credit"):
+            amount = int(op["amount_cents"])
+            if kind == "debit" and bal[tag] < amount:
+                return _failed("insufficient", i, balances)
+            bal[tag] += amount if kind == "credit" else -amount
+            plan.txs.append((ts, device_id, kind, tag, amount, op.get("reason", kind)))
+            plan.results.append({"op": kind, "tag_uid": tag, "status": "ok", "new_balance_cents": bal[tag]})
+        elif kind == "settle_spin":
+            bet, win = int(op["bet_cents"]), int(op.get("win_cents", 0))
+            if bal[tag] < bet:
+                return _failed("insufficient", i, balances)
+            bal[tag] -= bet
+            plan.txs.append((ts, device_id, "debit", tag, bet, op.get("reason", "slot_bet")))
+            if win:
+                bal[tag] += win
+                plan.txs.append((ts, device_id, "credit", tag, win, "slot_win"))
+            plan.results.append({"op": kind, "tag_uid": tag, "status": "ok", "bet_cents": bet, "win_cents": win,
+                                 "new_balance_cents": bal[tag]})
+        else:
+            payout_id = op["payout_id"]
+            row = payouts.get(payout_id)
+            if not row:
+                return _failed("not_found", i, balances)
+            if row["status"] != "ready" or payout_id in claimed:
+                return _failed("already_claimed", i, balances)
+            amount = int(row["amount_cents"])
+            claimed.add(payout_id)
+            bal[tag] += amount
+            plan.claims.append((tag, ts, payout_id))
+            plan.txs.append((ts, device_id, "credit", tag, amount, f"payout_claim:{payout_id}"))
+            plan.txs.append((ts, device_id, "payout_claim", tag, amount, payout_id))
+            plan.results.append({"op": kind, "tag_uid": tag, "status": "ok", "payout_id": payout_id,
+                                 "credited_cents": amount, "new_balance_cents": bal[tag]})
+    plan.balances = bal
+    return plan
+
+def claim_result(plan: BatchPlan) -> Tuple[str, Optional[int], Optional[int]]:
+    """(status, credited_cents, new_balance_cents) of a single payout_claim plan."""
+    if not plan.ok:
+        return plan.status, None, None
+    res = plan.results[0]
+    return "ok", res["credited_cents"], res["new_balance_cents"]
+
+def forwarded_claim(row: Optional[Dict], payout_id: str, amount_cents: int, tag_uid: str,
+                    balance: int) -> Tuple[Optional[Tuple[str, Optional[int], Optional[int]]], Dict]:
+    """Owner shard's side of a payout claimed on the coordinator (sharded mode).
+
+    ``row`` is the payout as this shard knows it, None for the first
+    forward (a ready copy is planned against). Returns ``(result, row)``:
+    ``result`` is set when nothing is to be credited, "ok" with the current
+    ``balance`` when this tag already got the payout (redelivery, retried
+    claim), "already_claimed" when another tag did.
+    """
+    if row is None:
+        return None, {"payout_id": payout_id, "amount_cents": amount_cents, "status": "ready"}
+    if row["status"] == "ready":
+        return None, row
+    if row.get("claimed_by_tag") == tag_uid:
+        return ("ok", int(row.get("amount_cents") or amount_cents), balance), row
+    return ("already_claimed", None, None), row
+
+def _failed(status: str, index: int, balances: Dict[str, int]) -> BatchPlan:
+    return BatchPlan(status=status, failed_op=index, balances=dict(balances))
+
+def _amount(op: Dict, key: str, index: int, allow_zero: bool = False):
+    try:
+        v = int(op.get(key, 0))
+    except (TypeError, ValueError):
+        raise ValueError(f"op {index}: {key} must be an integer")
+    if v < 0 or (v == 0 and not allow_zero):
+        raise ValueError(f"op {index}: {key} must be positive")
@@ -0,0 +1,157 @@
+import json, struct
+from typing import Any, Dict, List, Optional, Tuple
+
+# Shared between the core (core/app/codec.py) and the agents
+# (agents/common/codec.py); keep both copies identical (tests/test_codec.py
+# fails when they differ).
+#
+# Payload codecs. JSON is the default and the only format browsers speak.
+# "bin1" packs the fixed-shape wallet/vote/payout messages with struct:
+#
+#   magic 0xEB | kind u8 | presence u16 (bit i = field i present) | fields...
+#
+# strings are u8 length + UTF-8, ints are big-endian i32/i64, None fields are
+# left out (read back with .get() as before). Messages that
+# do not fit a schema (unknown keys, long strings, batch ops, ...) are sent
+# as JSON, and decode() sniffs the first byte, so a receiver never needs to
+# know which codec the sender picked.
+
+MAGIC = 0xEB
+STATUS_WORDS = (b"online", b"offline")
+_HEAD = struct.Struct(">BBH")
+_I32 = struct.Struct(">i")
+_I64 = struct.Struct(">q")
+
+class Schema:
+    __slots__ = ("kind", "consts", "fields", "names")
+
+    def __init__(self, kind: int, consts: Dict[str, Any], fields: List[Tuple[str, str]]):
+        self.kind = kind
+        self.consts = consts
+        self.fields = fields
+        self.names = {name for name, _ in fields}
+
+    def fits(self, obj: Dict) -> bool:
+        for k, v in obj.items():
+            if k in self.consts:
+                if self.consts[k] != v:
+                    return False
+            elif k not in self.names:
+                return False
+        return all(k in obj for k in self.consts)
+
+_REQ = [("req_id", "s"), ("device_id", "s"), ("tag_uid", "s")]
+SCHEMAS = [
+    Schema(1, {}, _REQ),                                                          # wallet/get
+    Schema(2, {}, _REQ + [("amount_cents", "i"), ("reason", "s")]),               # wallet/debit, wallet/credit
+    Schema(3, {}, [("req_id", "s"), ("device_id", "s"), ("payout_id", "s"), ("tag_uid", "s")]),  # payouts/claim
+    Schema(4, {}, [("device_id", "s"), ("step", "i"), ("choice", "s"), ("ts", "s")]),  # night/vote
+    Schema(5, {}, [("payout_id", "s"), ("source", "s"), ("amount_cents", "i")]),  # payouts/new without meta
+    Schema(16, {"type": "wallet_get"}, [("req_id", "s"), ("status", "s"), ("balance_cents", "q")]),
+    Schema(17, {"type": "wallet_debit"}, [("req_id", "s"), ("status", "s"), ("new_balance_cents", "q")]),
+    Schema(18, {"type": "wallet_credit"}, [("req_id", "s"), ("status", "s"), ("new_balance_cents", "q")]),
+    Schema(19, {"type": "payout_claim"}, [("req_id", "s"), ("status", "s"), ("credited_cents", "q"),
+                                          ("new_balance_cents", "q")]),
+]
+_BY_KIND = {s.kind: s for s in SCHEMAS}
+
+class JsonCodec:
+    name = "json"
+
+    def encode(self, obj: Dict) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+class BinaryCodec:
+    name = "bin1"
+
+    def __init__(self):
+        self._by_shape: Dict[Tuple, Optional[Schema]] = {}  # (keys, type) -> first fitting schema
+
+    def encode(self, obj: Dict) -> bytes:
+        shape = (tuple(obj), obj.get("type"))
+        try:
+            schema = self._by_shape[shape]
+        except (KeyError, TypeError):
+            schema = next((s for s in SCHEMAS if s.fits(obj)), None)
+            if len(self._by_shape) < 1024:
+                try:
+                    self._by_shape[shape] = schema
+                except TypeError:
+                    pass
+        if schema is not None:
+            data = _pack(schema, obj)
+            if data is not None:
+                return data
+        return JSON.encode(obj)
+
+def _pack(schema: Schema, obj: Dict) -> Optional[bytes]:
+    present = 0
+    parts = []
+    for i, (name, kind) in enumerate(schema.fields):
+        v = obj.get(name)
+        if v is None:
+            continue
+        present |= 1 << i
+        if kind == "s":
+            if type(v) is not str:
+                return None
+            b = v.encode("utf-8")
+            if len(b) > 255:
+                return None
+            parts.append(bytes((len(b),)) + b)
+        else:
+            if type(v) is not int:
+                return None
+            try:
+                parts.append((_I32 if kind == "i" else _I64).pack(v))
+            except struct.error:
+                return None
+    return _HEAD.pack(MAGIC, schema.kind, present) + b"".join(parts)
+
+def _unpack(data: bytes) -> Dict:
+    _, kind, present = _HEAD.unpack_from(data)
+    schema = _BY_KIND[kind]
+    out = dict(schema.consts)
+    pos = _HEAD.size
+    for i, (name, ftype) in enumerate(schema.fields):
+        if not present & (1 << i):
+            continue
+        if ftype == "s":
+            n = data[pos]
+            out[name] = data[pos + 1:pos + 1 + n].decode("utf-8")
+            pos += 1 + n
+        elif ftype == "i":
+            out[name] = _I32.unpack_from(data, pos)[0]
+            pos += 4
+        else:
+            out[name] = _I64.unpack_from(data, pos)[0]
+            pos += 8
+    return out
+
+def decode(data: bytes) -> Dict:
+    """Decode a payload in any supported format; empty or malformed input gives {}.
+
+    The bare ``online``/``offline`` words of ``eg/dev/<id>/status`` (LWT)
+    come back as ``{"status": word}``.
+    """
+    if not data:
+        return {}
+    if data in STATUS_WORDS:
+        return {"status": data.decode("ascii")}
+    try:
+        if data[0] == MAGIC:
+            return _unpack(data)
+        return json.loads(data.decode("utf-8"))
+    except Exception:
+        return {}
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+CODECS = {c.name: c for c in (BINARY, JSON)}
+
+def negotiate(offered: List[str], allowed: Optional[List[str]] = None) -> str:
+    """First codec in the device's preference list that we support (and allow); JSON otherwise."""
+    for name in offered or []:
+        if name in CODECS and (allowed is None or name in allowed):
+            return name
+    return JSON.name
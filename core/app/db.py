@@ -1,13 +1,121 @@
-import json, sqlite3, threading, time
-from typing import Optional, Dict, Tuple, List
+import json, queue, sqlite3, time
+from contextlib import contextmanager
+from typing import Any, Optional, Dict, Tuple, List, Iterable
+from .batch import BatchPlan, batch_keys, claim_result, forwarded_claim, plan_batch
+from .metrics import metrics, TimedLock
+
+TX_INSERT = "INSERT INTO tx_log(ts, device_id, op, tag_uid, amount_cents, details) VALUES(?,?,?,?,?,?)"
+WALLET_SET = ("INSERT INTO wallets(tag_uid, balance_cents, updated_at) VALUES(?,?,?) "
+              "ON CONFLICT(tag_uid) DO UPDATE SET balance_cents=excluded.balance_cents, updated_at=excluded.updated_at")
+PAYOUT_CLAIM = "UPDATE payouts SET status='claimed', claimed_by_tag=?, claimed_at=? WHERE payout_id=? AND status='ready'"
+PAYOUT_INSERT = ("INSERT OR IGNORE INTO payouts(payout_id, source, amount_cents, status, meta, created_at) "
+                 "VALUES(?,?,?,'ready',?,?)")
+SELECT_PAYOUT = "SELECT payout_id, amount_cents, status, claimed_by_tag FROM payouts WHERE payout_id=?"
+SELECT_BALANCE = "SELECT balance_cents FROM wallets WHERE tag_uid=?"
+REPLY_INSERT = "INSERT OR REPLACE INTO processed_reqs(device_id, req_id, ts, response) VALUES(?,?,?,?)"
+SELECT_READY_PAYOUTS = "SELECT payout_id, source, amount_cents FROM payouts WHERE status='ready' ORDER BY created_at ASC"
+ROLLUP_ADD = ("INSERT INTO tx_rollup(minute, device_id, op, n, total_cents) VALUES(?,?,?,?,?) "
+              "ON CONFLICT(minute, device_id, op) DO UPDATE SET n=n+excluded.n, total_cents=total_cents+excluded.total_cents")
+ROLLUP_TOTALS_ADD = ("INSERT INTO tx_rollup_totals(device_id, op, n, total_cents) VALUES(?,?,?,?) "
+                     "ON CONFLICT(device_id, op) DO UPDATE SET n=n+excluded.n, total_cents=total_cents+excluded.total_cents")
+ROLLUP_FROM_TX = ("SELECT ts / 60 * 60, COALESCE(device_id, ''), COALESCE(op, ''), COUNT(*), "
+                  "COALESCE(SUM(amount_cents), 0) FROM tx_log {where} GROUP BY 1, 2, 3")
+ROLLUP_TOTALS_FILL = ("INSERT INTO tx_rollup_totals(device_id, op, n, total_cents) "
+                      "SELECT device_id, op, SUM(n), SUM(total_cents) FROM tx_rollup GROUP BY device_id, op")
+
+class ReadPool:
+    """Small pool of read-only connections to a WAL database.
+
+    WAL readers see the last committed snapshot without taking the writer
+    lock, so pooled SELECTs never wait behind a commit. Each connection
+    keeps its own prepared-statement cache; queries use constant SQL so
+    repeated reads skip re-preparing.
+    """
+
+    def __init__(self, path: str, size: int):
+        self._idle: queue.Queue = queue.Queue()
+        for _ in range(size):
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False,
+                                   isolation_level=None, cached_statements=64)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA query_only=ON")
+            self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
 
 class DB:
-    def __init__(self, path: str):
+    # Schema migrations, applied in order and tracked with PRAGMA user_version.
+    MIGRATIONS: List[List[str]] = [
+        # 1: one vote per device and step, indexed by step
+        [
+            "DELETE FROM night_votes WHERE rowid NOT IN "
+            "(SELECT MAX(rowid) FROM night_votes GROUP BY step, device_id)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_night_votes_step_device ON night_votes(step, device_id)",
+        ],
+        # 2: partial index backing the ready-payout list
+        [
+            "CREATE INDEX IF NOT EXISTS idx_payouts_ready ON payouts(created_at) WHERE status='ready'",
+        ],
+        # 3: tx_log gets an explicit rowid key, history indexes and archive totals
+        [
+            "CREATE TABLE tx_log_new(id INTEGER PRIMARY KEY, ts INTEGER NOT NULL, device_id TEXT, op TEXT, "
+            "tag_uid TEXT, amount_cents INTEGER, details TEXT)",
+            "INSERT INTO tx_log_new(id, ts, device_id, op, tag_uid, amount_cents, details) "
+            "SELECT rowid, ts, device_id, op, tag_uid, amount_cents, details FROM tx_log ORDER BY rowid",
+            "DROP TABLE tx_log",
+            "ALTER TABLE tx_log_new RENAME TO tx_log",
+            "CREATE INDEX IF NOT EXISTS idx_tx_log_tag_ts ON tx_log(tag_uid, ts)",
+            "CREATE INDEX IF NOT EXISTS idx_tx_log_device_ts ON tx_log(device_id, ts)",
+            # Net effect of rows moved to archive files, so balances still reconcile with tx_log.
+            "CREATE TABLE IF NOT EXISTS tx_archive_totals(tag_uid TEXT PRIMARY KEY, "
+            "credit_cents INTEGER NOT NULL DEFAULT 0, debit_cents INTEGER NOT NULL DEFAULT 0, "
+            "rows INTEGER NOT NULL DEFAULT 0)",
+        ],
+        # 4: per-minute and all-time rollups of tx_log by device and op, backfilled from what is left of tx_log
+        [
+            "CREATE TABLE IF NOT EXISTS tx_rollup(minute INTEGER NOT NULL, device_id TEXT NOT NULL, op TEXT NOT NULL, "
+            "n INTEGER NOT NULL, total_cents INTEGER NOT NULL, PRIMARY KEY(minute, device_id, op)) WITHOUT ROWID",
+            "CREATE TABLE IF NOT EXISTS tx_rollup_totals(device_id TEXT NOT NULL, op TEXT NOT NULL, "
+            "n INTEGER NOT NULL, total_cents INTEGER NOT NULL, PRIMARY KEY(device_id, op)) WITHOUT ROWID",
+            "INSERT INTO tx_rollup(minute, device_id, op, n, total_cents) " + ROLLUP_FROM_TX.format(where=""),
+            ROLLUP_TOTALS_FILL,
+        ],
+        # 5: tx_log becomes the sequenced ledger (ids never reused, rows never updated) with balance checkpoints
+        [
+            "CREATE TABLE tx_log_new(id INTEGER PRIMARY KEY AUTOINCREMENT, ts INTEGER NOT NULL, device_id TEXT, "
+            "op TEXT, tag_uid TEXT, amount_cents INTEGER, details TEXT)",
+            "INSERT INTO tx_log_new(id, ts, device_id, op, tag_uid, amount_cents, details) "
+            "SELECT id, ts, device_id, op, tag_uid, amount_cents, details FROM tx_log ORDER BY id",
+            "DROP TABLE tx_log",
+            "ALTER TABLE tx_log_new RENAME TO tx_log",
+            "CREATE INDEX IF NOT EXISTS idx_tx_log_tag_ts ON tx_log(tag_uid, ts)",
+            "CREATE INDEX IF NOT EXISTS idx_tx_log_device_ts ON tx_log(device_id, ts)",
+            "CREATE TRIGGER IF NOT EXISTS tx_log_append_only BEFORE UPDATE ON tx_log "
+            "BEGIN SELECT RAISE(ABORT, 'tx_log is append-only'); END",
+            # wallets holds the balances as of tx_log id <= seq of the newest row
+            "CREATE TABLE IF NOT EXISTS wallet_checkpoints(seq INTEGER PRIMARY KEY, ts INTEGER NOT NULL, "
+            "wallets INTEGER NOT NULL)",
+        ],
+    ]
+
+    def __init__(self, path: str, read_pool: int = 0):
         self.path = path
-        self._lock = threading.Lock()
+        # Guards every write on the shared connection; reentrant so helpers can nest.
+        self._lock = TimedLock("db", metrics)
         self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
         self._conn.row_factory = sqlite3.Row
         self._setup()
+        self._readers = ReadPool(self.path, read_pool) if read_pool > 0 and self.path != ":memory:" else None
 
     def _setup(self):
         c = self._conn.cursor()
@@ -51,25 +159,75 @@ class DB:
             choice TEXT NOT NULL,
             ts INTEGER NOT NULL
         );""")
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS processed_reqs(
+            device_id TEXT NOT NULL,
+            req_id TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            response TEXT NOT NULL,
+            PRIMARY KEY(device_id, req_id)
+        ) WITHOUT ROWID;""")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_processed_reqs_ts ON processed_reqs(ts);")
         self._conn.commit()
+        self._migrate()
+
+    def _migrate(self):
+        version = int(self._conn.execute("PRAGMA user_version").fetchone()[0])
+        for i in range(version, len(self.MIGRATIONS)):
+            with self._tx() as c:
+                for sql in self.MIGRATIONS[i]:
+                    c.execute(sql)
+                c.execute(f"PRAGMA user_version={i + 1}")
 
     def now(self) -> int:
         return int(time.time())
 
+    @contextmanager
+    def _tx(self):
+        # The connection runs in autocommit mode, so multi-statement writes
+        # need an explicit transaction to be atomic and to commit once.
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            with metrics.timer("eg_db_commit_seconds", kind="tx"):
+                self._conn.execute("COMMIT")
+
+    @contextmanager
+    def _read(self):
+        # Pooled read-only connection when available, else the writer connection.
+        if self._readers:
+            with self._readers.connection() as conn:
+                yield conn
+        else:
+            with self._lock:
+                yield self._conn
+
+    @contextmanager
+    def _write(self):
+        # Single autocommit write: the statement is its own commit.
+        with self._lock:
+            with metrics.timer("eg_db_commit_seconds", kind="autocommit"):
+                with self._conn:
+                    yield self._conn
+
     # KV
     def get_kv(self, k: str) -> Optional[str]:
-        cur = self._conn.execute("SELECT v FROM kv WHERE k=?", (k,))
-        row = cur.fetchone()
-        return row["v"] if row else None
+        with self._read() as conn:
+            row = conn.execute("SELECT v FROM kv WHERE k=?", (k,)).fetchone()
+            return row["v"] if row else None
 
     def set_kv(self, k: str, v: str):
-        with self._conn:
+        with self._write():
             self._conn.execute("INSERT INTO kv(k,v) VALUES(?,?) ON CONFLICT(k) DO UPDATE SET v=excluded.v", (k, v))
 
     # Wallet helpers
     def ensure_wallet(self, tag_uid: str):
         ts = self.now()
-        with self._conn:
+        with self._write():
             self._conn.execute(
                 "INSERT INTO wallets(tag_uid, balance_cents, updated_at) VALUES(?,?,?) "
                 "ON CONFLICT(tag_uid) DO NOTHING",
@@ -77,89 +235,381 @@ class DB:
             )
 
     def get_balance(self, tag_uid: str) -> int:
-        self.ensure_wallet(tag_uid)
-        cur = self._conn.execute("SELECT balance_cents FROM wallets WHERE tag_uid=?", (tag_uid,))
-        row = cur.fetchone()
-        return row["balance_cents"] if row else 0
+        # Pure read: unknown tags are 0 and get no row until their first write.
+        with self._read() as conn:
+            row = conn.execute(SELECT_BALANCE, (tag_uid,)).fetchone()
+            return int(row["balance_cents"]) if row else 0
 
-    def credit(self, device_id: str, tag_uid: str, amount_cents: int, reason: str) -> int:
-        ts = self.now()
-        with self._lock:
-            with self._conn:
-                self.ensure_wallet(tag_uid)
-                self._conn.execute(
-                    "UPDATE wallets SET balance_cents = balance_cents + ?, updated_at=? WHERE tag_uid=?",
-                    (amount_cents, ts, tag_uid)
-                )
-                new_balance = self.get_balance(tag_uid)
-                self._conn.execute("INSERT INTO tx_log(ts, device_id, op, tag_uid, amount_cents, details) VALUES(?,?,?,?,?,?)",
-                                   (ts, device_id, "credit", tag_uid, amount_cents, reason))
-                return new_balance
-
-    def debit(self, device_id: str, tag_uid: str, amount_cents: int, reason: str) -> Tuple[bool, int]:
+    def credit(self, device_id: str, tag_uid: str, amount_cents: int, reason: str, reply: Any = None) -> int:
         ts = self.now()
-        with self._lock:
-            with self._conn:
-                self.ensure_wallet(tag_uid)
-                cur = self._conn.execute(
-                    "UPDATE wallets SET balance_cents = balance_cents - ?, updated_at=? "
-                    "WHERE tag_uid=? AND balance_cents >= ?",
-                    (amount_cents, ts, tag_uid, amount_cents)
-                )
-                if cur.rowcount == 0:
-                    bal = self.get_balance(tag_uid)
-                    self._conn.execute("INSERT INTO tx_log(ts, device_id, op, tag_uid, amount_cents, details) VALUES(?,?,?,?,?,?)",
-                                       (ts, device_id, "debit_insufficient", tag_uid, amount_cents, reason))
-                    return False, bal
-                new_balance = self.get_balance(tag_uid)
-                self._conn.execute("INSERT INTO tx_log(ts, device_id, op, tag_uid, amount_cents, details) VALUES(?,?,?,?,?,?)",
-                                   (ts, device_id, "debit", tag_uid, amount_cents, reason))
-                return True, new_balance
+        with self._tx() as c:
+            c.execute(
+                "INSERT INTO wallets(tag_uid, balance_cents, updated_at) VALUES(?,?,?) "
+                "ON CONFLICT(tag_uid) DO UPDATE SET balance_cents = balance_cents + excluded.balance_cents, "
+                "updated_at=excluded.updated_at",
+                (tag_uid, amount_cents, ts)
+            )
+            new_balance = self._balance(c, tag_uid)
+            tx = (ts, device_id, "credit", tag_uid, amount_cents, reason)
+            c.execute(TX_INSERT, tx)
+            self._rollup(c, [tx])
+            self._remember(c, reply, new_balance, ts)
+            return new_balance
 
-    # Payouts
-    def insert_payout(self, payout_id: str, source: str, amount_cents: int, meta: Dict):
+    def debit(self, device_id: str, tag_uid: str, amount_cents: int, reason: str, reply: Any = None) -> Tuple[bool, int]:
         ts = self.now()
-        meta_json = json.dumps(meta or {})
-        with self._conn:
-            self._conn.execute(
-                "INSERT OR IGNORE INTO payouts(payout_id, source, amount_cents, status, meta, created_at) "
-                "VALUES(?,?,?,?,?,?)",
-                (payout_id, source, amount_cents, "ready", meta_json, ts)
+        with self._tx() as c:
+            cur = c.execute(
+                "UPDATE wallets SET balance_cents = balance_cents - ?, updated_at=? "
+                "WHERE tag_uid=? AND balance_cents >= ?",
+                (amount_cents, ts, tag_uid, amount_cents)
             )
+            ok = cur.rowcount > 0
+            bal = self._balance(c, tag_uid)
+            tx = (ts, device_id, "debit" if ok else "debit_insufficient", tag_uid, amount_cents, reason)
+            c.execute(TX_INSERT, tx)
+            self._rollup(c, [tx])
+            self._remember(c, reply, (ok, bal), ts)
+            return ok, bal
+
+    def _balance(self, c, tag_uid: str) -> int:
+        row = c.execute(SELECT_BALANCE, (tag_uid,)).fetchone()
+        return int(row["balance_cents"]) if row else 0
+
+    def apply_batch(self, device_id: str, ops: List[Dict], reply: Any = None) -> BatchPlan:
+        """Run an ordered list of wallet ops atomically in one transaction (see batch.py).
+        Raises ValueError for malformed ops."""
+        tags, payout_ids = batch_keys(ops)
+        ts = self.now()
+        with self._tx() as c:
+            balances = {t: 0 for t in tags}
+            for r in c.execute(f"SELECT tag_uid, balance_cents FROM wallets WHERE tag_uid IN ({_marks(tags)})",
+                               list(tags)):
+                balances[r["tag_uid"]] = int(r["balance_cents"])
+            payouts = {}
+            if payout_ids:
+                for r in c.execute(f"SELECT payout_id, amount_cents, status FROM payouts WHERE payout_id IN ({_marks(payout_ids)})",
+                                   list(payout_ids)):
+                    payouts[r["payout_id"]] = dict(r)
+            plan = plan_batch(device_id, ops, balances, payouts, ts)
+            self._apply_plan(c, plan, ts)
+            self._remember(c, reply, plan, ts)
+            return plan
+
+    def _apply_plan(self, c, plan: BatchPlan, ts: int):
+        if plan.ok:
+            c.executemany(WALLET_SET, [(t, b, ts) for t, b in plan.balances.items()])
+            c.executemany(TX_INSERT, plan.txs)
+            self._rollup(c, plan.txs)
+            c.executemany(PAYOUT_CLAIM, plan.claims)
+
+    # Bulk wallet access (write-behind engine)
+    def load_balances(self) -> Dict[str, int]:
+        with self._read() as conn:
+            cur = conn.execute("SELECT tag_uid, balance_cents FROM wallets")
+            return {r["tag_uid"]: int(r["balance_cents"]) for r in cur.fetchall()}
+
+    def write_batch(self, wallets: Iterable[Tuple[str, int, int]], txs: Iterable[Tuple],
+                    claims: Iterable[Tuple[str, int, str]] = (), replies: Iterable[Tuple[str, str, int, str]] = (),
+                    checkpoint: bool = False, payouts: Iterable[Tuple[str, str, int, str, int]] = ()) -> int:
+        """Commit absolute wallet balances (tag_uid, balance_cents, ts), tx_log rows,
+        new payouts (payout_id, source, amount_cents, meta JSON, created_at),
+        payout claims (claimed_by_tag, claimed_at, payout_id) and processed_reqs
+        rows (device_id, req_id, ts, response JSON) in one transaction.
+
+        With ``checkpoint`` the wallet rows are the balances as of the last
+        tx_log id once ``txs`` are in, and that id is recorded in
+        wallet_checkpoints. Returns the last tx_log id.
+        """
+        txs, wallets = list(txs), list(wallets)
+        with self._tx() as c:
+            c.executemany(WALLET_SET, wallets)
+            c.executemany(TX_INSERT, txs)
+            self._rollup(c, txs)
+            c.executemany(PAYOUT_INSERT, list(payouts))
+            c.executemany(PAYOUT_CLAIM, list(claims))
+            c.executemany(REPLY_INSERT, list(replies))
+            seq = _last_seq(c)
+            if checkpoint:
+                c.execute("INSERT OR REPLACE INTO wallet_checkpoints(seq, ts, wallets) VALUES(?,?,?)",
+                          (seq, self.now(), len(wallets)))
+            return seq
+
+    # Ledger (tx_log as the event stream, wallets as checkpoints)
+    def last_checkpoint(self) -> int:
+        """tx_log id covered by the newest balance checkpoint (0: none)."""
+        with self._read() as conn:
+            row = conn.execute("SELECT MAX(seq) FROM wallet_checkpoints").fetchone()
+            return int(row[0] or 0)
+
+    def ledger_after(self, after_id: int, limit: int = 10000) -> List[Tuple[int, str, str, int]]:
+        """(id, op, tag_uid, amount_cents) of the tx_log rows after ``after_id``, in id order."""
+        with self._read() as conn:
+            cur = conn.execute("SELECT id, op, tag_uid, amount_cents FROM tx_log WHERE id>? ORDER BY id LIMIT ?",
+                               (after_id, limit))
+            return [tuple(r) for r in cur]
+
+    # Payouts
+    def get_payout(self, payout_id: str) -> Optional[Dict]:
+        with self._read() as conn:
+            row = conn.execute(SELECT_PAYOUT, (payout_id,)).fetchone()
+            return dict(row) if row else None
+
+    def insert_payout(self, payout_id: str, source: str, amount_cents: int, meta: Dict) -> bool:
+        with self._write():
+            cur = self._conn.execute(PAYOUT_INSERT, (payout_id, source, amount_cents, json.dumps(meta or {}), self.now()))
+            return cur.rowcount > 0
 
     def list_ready_payouts(self) -> List[Dict]:
-        cur = self._conn.execute("SELECT payout_id, source, amount_cents FROM payouts WHERE status='ready' ORDER BY created_at ASC")
-        return [dict(r) for r in cur.fetchall()]
+        with self._read() as conn:
+            return [dict(r) for r in conn.execute(SELECT_READY_PAYOUTS).fetchall()]
+
+    def claim_payout(self, payout_id: str, device_id: str, tag_uid: str, reply: Any = None):
+        # ``reply`` is built from the BatchPlan, like apply_batch's.
+        plan = self.apply_batch(device_id, [{"op": "payout_claim", "payout_id": payout_id, "tag_uid": tag_uid}], reply)
+        return claim_result(plan)
 
-    def claim_payout(self, payout_id: str, device_id: str, tag_uid: str):
+    def take_payout(self, payout_id: str, tag_uid: str) -> Tuple[str, Optional[int], Optional[str]]:
+        """Mark a payout claimed without crediting anything (sharded mode: the wallet's shard credits it).
+
+        Returns (status, amount_cents, source). A repeat for the same tag is "ok" again
+        so a redelivered claim is forwarded again; the owner credits once.
+        """
+        with self._tx() as c:
+            row = c.execute("SELECT amount_cents, source, status, claimed_by_tag FROM payouts WHERE payout_id=?",
+                            (payout_id,)).fetchone()
+            if not row:
+                return "not_found", None, None
+            if row["status"] != "ready":
+                if row["claimed_by_tag"] == tag_uid:
+                    return "ok", int(row["amount_cents"]), row["source"]
+                return "already_claimed", None, None
+            c.execute(PAYOUT_CLAIM, (tag_uid, self.now(), payout_id))
+            return "ok", int(row["amount_cents"]), row["source"]
+
+    def credit_forwarded_payout(self, payout_id: str, source: str, amount_cents: int, device_id: str, tag_uid: str,
+                                reply: Any = None) -> Tuple[str, Optional[int], Optional[int]]:
+        """Credit a payout taken on the coordinator (sharded mode), at most once per payout_id.
+
+        The payout is copied into this shard's payouts table and claimed in
+        the transaction that credits it, so the claimed row is the durable
+        marker of the credit. Returns (status, credited_cents,
+        new_balance_cents) like :meth:`claim_payout`; ``reply`` is built
+        from that tuple. A repeat for the same tag is "ok" again.
+        """
         ts = self.now()
-        with self._lock:
-            with self._conn:
-                cur = self._conn.execute("SELECT payout_id, amount_cents, status FROM payouts WHERE payout_id=?", (payout_id,))
-                row = cur.fetchone()
-                if not row:
-                    return "not_found", None, None
-                if row["status"] != "ready":
-                    return "already_claimed", None, None
-                amount = int(row["amount_cents"])
-                self._conn.execute("UPDATE payouts SET status='claimed', claimed_by_tag=?, claimed_at=? WHERE payout_id=?",
-                                   (tag_uid, ts, payout_id))
-                new_balance = self.credit(device_id, tag_uid, amount, f"payout_claim:{payout_id}")
-                self._conn.execute("INSERT INTO tx_log(ts, device_id, op, tag_uid, amount_cents, details) VALUES(?,?,?,?,?,?)",
-                                   (ts, device_id, "payout_claim", tag_uid, amount, payout_id))
-                return "ok", amount, new_balance
+        with self._tx() as c:
+            known = c.execute(SELECT_PAYOUT, (payout_id,)).fetchone()
+            balance = self._balance(c, tag_uid)
+            res, payout = forwarded_claim(dict(known) if known else None, payout_id, amount_cents, tag_uid, balance)
+            if res is None:
+                plan = plan_batch(device_id, [{"op": "payout_claim", "payout_id": payout_id, "tag_uid": tag_uid}],
+                                  {tag_uid: balance}, {payout_id: payout}, ts)
+                if known is None and plan.ok:
+                    c.execute(PAYOUT_INSERT, (payout_id, source, amount_cents, "{}", ts))
+                self._apply_plan(c, plan, ts)
+                res = claim_result(plan)
+            self._remember(c, reply, res, ts)
+            return res
+
+    # Transaction history
+    def query_tx(self, tag_uid: Optional[str] = None, device_id: Optional[str] = None, op: Optional[str] = None,
+                 since: Optional[int] = None, until: Optional[int] = None, cursor: Optional[str] = None,
+                 limit: int = 50) -> Tuple[List[Dict], Optional[str]]:
+        """Newest-first page of tx_log; ``cursor`` is the opaque ``next`` of the previous page."""
+        where, args = [], []
+        for col, val in (("tag_uid", tag_uid), ("device_id", device_id), ("op", op)):
+            if val is not None:
+                where.append(f"{col}=?")
+                args.append(val)
+        if since is not None:
+            where.append("ts>=?")
+            args.append(since)
+        if until is not None:
+            where.append("ts<?")
+            args.append(until)
+        if cursor:
+            c_ts, c_id = (int(x) for x in cursor.split(":", 1))
+            where.append("(ts<? OR (ts=? AND id<?))")
+            args += [c_ts, c_ts, c_id]
+        sql = "SELECT id, ts, device_id, op, tag_uid, amount_cents, details FROM tx_log"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY ts DESC, id DESC LIMIT ?"
+        args.append(limit + 1)
+        with self._read() as conn:
+            rows = [dict(r) for r in conn.execute(sql, args).fetchall()]
+        nxt = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            nxt = f"{rows[-1]['ts']}:{rows[-1]['id']}"
+        return rows, nxt
+
+    def tx_summary(self, device_id: Optional[str] = None, tag_uid: Optional[str] = None,
+                   since: Optional[int] = None, until: Optional[int] = None) -> Dict[str, Dict[str, int]]:
+        where, args = [], []
+        for col, val in (("device_id", device_id), ("tag_uid", tag_uid)):
+            if val is not None:
+                where.append(f"{col}=?")
+                args.append(val)
+        if since is not None:
+            where.append("ts>=?")
+            args.append(since)
+        if until is not None:
+            where.append("ts<?")
+            args.append(until)
+        sql = "SELECT op, COUNT(*) AS n, COALESCE(SUM(amount_cents), 0) AS total FROM tx_log"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " GROUP BY op"
+        with self._read() as conn:
+            return {r["op"]: {"count": int(r["n"]), "total_cents": int(r["total"])} for r in conn.execute(sql, args)}
+
+    def tx_before(self, cutoff_ts: int, after_id: int = 0, limit: int = 10000) -> List[Dict]:
+        """Oldest rows in id order, stopping at the first one at or after ``cutoff_ts``."""
+        with self._read() as conn:
+            cur = conn.execute("SELECT id, ts, device_id, op, tag_uid, amount_cents, details FROM tx_log "
+                               "WHERE id>? ORDER BY id LIMIT ?", (after_id, limit))
+            out = []
+            for r in cur:
+                if r["ts"] >= cutoff_ts:
+                    break
+                out.append(dict(r))
+            return out
+
+    def archive_tx(self, upto_id: int, totals: Dict[str, Tuple[int, int, int]]):
+        """Delete archived rows (id <= upto_id) and fold their per-tag (credit, debit, rows) into tx_archive_totals."""
+        with self._tx() as c:
+            c.execute("DELETE FROM tx_log WHERE id<=?", (upto_id,))
+            c.executemany("INSERT INTO tx_archive_totals(tag_uid, credit_cents, debit_cents, rows) VALUES(?,?,?,?) "
+                          "ON CONFLICT(tag_uid) DO UPDATE SET credit_cents=credit_cents+excluded.credit_cents, "
+                          "debit_cents=debit_cents+excluded.debit_cents, rows=rows+excluded.rows",
+                          [(tag, cr, db, n) for tag, (cr, db, n) in totals.items()])
+
+    # Rollups (operator stats)
+    def _rollup(self, c, txs: List[Tuple]):
+        # Fold tx_log rows into tx_rollup/tx_rollup_totals inside the caller's transaction.
+        minutes: Dict[Tuple[int, str, str], List[int]] = {}
+        totals: Dict[Tuple[str, str], List[int]] = {}
+        for ts, device_id, op, _tag, amount, _details in txs:
+            for acc, key in ((minutes, (ts - ts % 60, device_id or "", op or "")), (totals, (device_id or "", op or ""))):
+                cur = acc.setdefault(key, [0, 0])
+                cur[0] += 1
+                cur[1] += amount or 0
+        c.executemany(ROLLUP_ADD, [k + tuple(v) for k, v in minutes.items()])
+        c.executemany(ROLLUP_TOTALS_ADD, [k + tuple(v) for k, v in totals.items()])
+
+    def stats(self, since_ts: int, device_id: Optional[str] = None) -> Dict:
+        """All-time totals per device and op, plus per-minute buckets from ``since_ts`` on.
+
+        ``circulation_cents`` is credits minus debits; a device's ``house_take_cents``
+        is what it debited minus what it credited.
+        """
+        with self._read() as conn:
+            totals = conn.execute("SELECT device_id, op, n, total_cents FROM tx_rollup_totals").fetchall()
+            sql = "SELECT minute, op, SUM(n) AS n, SUM(total_cents) AS total FROM tx_rollup WHERE minute>=?"
+            args: List = [since_ts - since_ts % 60]
+            if device_id is not None:
+                sql += " AND device_id=?"
+                args.append(device_id)
+            minutes = conn.execute(sql + " GROUP BY minute, op ORDER BY minute", args).fetchall()
+        devices: Dict[str, Dict] = {}
+        circulation = 0
+        for r in totals:
+            dev = devices.setdefault(r["device_id"], {"ops": {}, "house_take_cents": 0})
+            dev["ops"][r["op"]] = {"count": int(r["n"]), "total_cents": int(r["total_cents"])}
+            sign = {"credit": -1, "debit": 1}.get(r["op"], 0)
+            dev["house_take_cents"] += sign * int(r["total_cents"])
+            circulation -= sign * int(r["total_cents"])
+        return {
+            "circulation_cents": circulation,
+            "devices": devices,
+            "minutes": [{"minute": int(r["minute"]), "op": r["op"], "count": int(r["n"]), "total_cents": int(r["total"])}
+                        for r in minutes],
+        }
+
+    def rebuild_rollups(self, since_ts: Optional[int] = None, dry_run: bool = False) -> Dict:
+        """Recompute rollup buckets from tx_log and report how many had drifted.
+
+        Only minutes from ``since_ts`` (default: the oldest row still in tx_log)
+        are recomputed: older buckets cover archived rows and are kept as is.
+        The all-time totals are then re-derived from the buckets.
+        """
+        with self._tx() as c:
+            if since_ts is None:
+                since_ts = c.execute("SELECT MIN(ts) FROM tx_log").fetchone()[0]
+            start = since_ts - since_ts % 60 if since_ts is not None else None
+            current = {(m, d, o): (n, t) for m, d, o, n, t in
+                       c.execute("SELECT minute, device_id, op, n, total_cents FROM tx_rollup")}
+            fresh = {k: v for k, v in current.items() if start is None or k[0] < start}
+            if start is not None:
+                for m, d, o, n, t in c.execute(ROLLUP_FROM_TX.format(where="WHERE ts>=?"), (start,)):
+                    fresh[(m, d, o)] = (n, t)
+            expected: Dict[Tuple[str, str], Tuple[int, int]] = {}
+            for (_m, d, o), (n, t) in fresh.items():
+                en, et = expected.get((d, o), (0, 0))
+                expected[(d, o)] = (en + n, et + t)
+            totals = {(d, o): (n, t) for d, o, n, t in c.execute("SELECT device_id, op, n, total_cents FROM tx_rollup_totals")}
+            drifted = sum(1 for k in set(current) | set(fresh) if current.get(k) != fresh.get(k))
+            drifted_totals = sum(1 for k in set(totals) | set(expected) if totals.get(k) != expected.get(k))
+            if not dry_run:
+                if start is not None:
+                    c.execute("DELETE FROM tx_rollup WHERE minute>=?", (start,))
+                    c.executemany("INSERT INTO tx_rollup(minute, device_id, op, n, total_cents) VALUES(?,?,?,?,?)",
+                                  [k + v for k, v in fresh.items() if k[0] >= start])
+                c.execute("DELETE FROM tx_rollup_totals")
+                c.execute(ROLLUP_TOTALS_FILL)
+        return {"since": start, "buckets": len(fresh), "drifted_buckets": drifted,
+                "drifted_totals": drifted_totals, "rebuilt": not dry_run}
+
+    # Processed requests (idempotency)
+    def _remember(self, c, reply, result: Any, ts: int):
+        # Inside the transaction of the write the reply answers (idempotency.Reply).
+        row = reply.row(result, ts) if reply is not None else None
+        if row:
+            c.execute(REPLY_INSERT, row)
+
+    def get_reply(self, device_id: str, req_id: str, since_ts: int) -> Optional[Dict]:
+        with self._read() as conn:
+            row = conn.execute("SELECT response FROM processed_reqs WHERE device_id=? AND req_id=? AND ts>=?",
+                               (device_id, req_id, since_ts)).fetchone()
+            return json.loads(row["response"]) if row else None
+
+    def load_replies(self, since_ts: int) -> List[Tuple[str, str, int, Dict]]:
+        with self._read() as conn:
+            cur = conn.execute("SELECT device_id, req_id, ts, response FROM processed_reqs WHERE ts>=? ORDER BY ts ASC",
+                               (since_ts,))
+            return [(r["device_id"], r["req_id"], int(r["ts"]), json.loads(r["response"])) for r in cur.fetchall()]
+
+    def prune_replies(self, before_ts: int) -> int:
+        with self._write():
+            cur = self._conn.execute("DELETE FROM processed_reqs WHERE ts<?", (before_ts,))
+            return cur.rowcount
 
     # Night votes (log)
     def reset_votes_for_step(self, step: int):
-        with self._conn:
+        with self._write():
             self._conn.execute("DELETE FROM night_votes WHERE step=?", (step,))
 
     def add_vote(self, step: int, device_id: str, choice: str):
-        ts = self.now()
-        with self._conn:
-            self._conn.execute("INSERT INTO night_votes(step, device_id, choice, ts) VALUES(?,?,?,?)",
-                               (step, device_id, choice, ts))
+        self.upsert_votes([(step, device_id, choice, self.now())])
+
+    def upsert_votes(self, rows: Iterable[Tuple[int, str, str, int]]):
+        # Last write wins: a device re-voting replaces its previous choice.
+        with self._tx() as c:
+            c.executemany("INSERT INTO night_votes(step, device_id, choice, ts) VALUES(?,?,?,?) "
+                          "ON CONFLICT(step, device_id) DO UPDATE SET choice=excluded.choice, ts=excluded.ts",
+                          list(rows))
+
+    def load_votes(self, step: int) -> List[Dict]:
+        with self._read() as conn:
+            cur = conn.execute("SELECT device_id, choice, ts FROM night_votes WHERE step=? ORDER BY ts ASC", (step,))
+            return [dict(r) for r in cur.fetchall()]
+
+def _last_seq(c) -> int:
+    # AUTOINCREMENT keeps the highest id ever handed out, even once archived rows are gone.
+    row = c.execute("SELECT seq FROM sqlite_sequence WHERE name='tx_log'").fetchone()
+    return int(row[0]) if row else 0
 
-    def count_votes_for_step(self, step: int) -> int:
-        cur = self._conn.execute("SELECT COUNT(*) AS c FROM night_votes WHERE step=?", (step,))
-        return int(cur.fetchone()["c"])
+def _marks(items) -> str:
+    return ",".join("?" * len(items))
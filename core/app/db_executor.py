@@ -0,0 +1,109 @@
+import asyncio, functools, queue, threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Tuple
+from .metrics import metrics
+
+class InlineExecutor:
+    """Threaded dispatch modes: writes from plain threads run directly in the caller's thread.
+
+    Their handlers are plain functions calling the DB themselves; only
+    :meth:`run`, shared with :class:`DBExecutor`, is used outside them.
+    """
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def run(self, fn: Callable, *args) -> Any:
+        return fn(*args)
+
+class DBExecutor:
+    """DB access for the asyncio core: one writer thread fed by a bounded queue.
+
+    Writes are queued in call order and executed one at a time, so the DB
+    lock is never contended; reads go to a small thread pool (they use the
+    read-only connections). When ``queue_depth`` writes are already
+    pending, :meth:`write` waits for a slot, which keeps the calling
+    handler in flight and, through the bus in-flight cap, slows down
+    consumption from the broker. Plain threads (HTTP endpoints, the vote
+    writer, the archiver, the write-behind flusher) go through
+    :meth:`run`, so the writer thread stays the only one writing.
+    """
+
+    def __init__(self, queue_depth: int = 256, readers: int = 2):
+        self._queue: "queue.Queue" = queue.Queue()
+        self._slots = asyncio.Semaphore(queue_depth)
+        self._readers = ThreadPoolExecutor(readers, thread_name_prefix="db-read")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        metrics.gauge("eg_db_queue_depth", self._queue.qsize, "Writes waiting for the DB writer thread")
+
+    def start(self):
+        if self._thread:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._readers.shutdown(wait=True)
+
+    async def read(self, fn: Callable, *args) -> Any:
+        return await self._loop.run_in_executor(self._readers, functools.partial(fn, *args))
+
+    async def write(self, fn: Callable, *args) -> Any:
+        async with self._slots:
+            fut = self._loop.create_future()
+            self._queue.put((fn, args, fut))
+            return await fut
+
+    def run(self, fn: Callable, *args) -> Any:
+        """Blocking write from any thread; runs inline before :meth:`start` and on the writer thread itself."""
+        if self._thread is None or threading.current_thread() is self._thread:
+            return fn(*args)
+        fut: Future = Future()
+        self._queue.put((fn, args, fut))
+        return fut.result()
+
+    def _run(self):
+        # Run everything already queued, then wake the loop once for the whole batch.
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = []
+            for item in items:
+                if item is None:
+                    if done:
+                        self._loop.call_soon_threadsafe(_resolve, done)
+                    return
+                fn, args, fut = item
+                try:
+                    res, exc = fn(*args), None
+                except Exception as e:
+                    res, exc = None, e
+                if isinstance(fut, Future):
+                    # run(): the caller is a plain thread blocked on it, not the loop.
+                    _resolve([(fut, res, exc)])
+                else:
+                    done.append((fut, res, exc))
+            if done:
+                self._loop.call_soon_threadsafe(_resolve, done)
+
+def _resolve(done: List[Tuple[Any, Any, Optional[BaseException]]]):
+    for fut, res, exc in done:
+        if fut.done():
+            continue
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(res)
@@ -0,0 +1,82 @@
+import logging, queue, threading, zlib
+from typing import Callable, List, Optional
+from .metrics import metrics
+
+log = logging.getLogger(__name__)
+
+Handler = Callable[[str, dict], None]
+
+class ShardedDispatcher:
+    """Runs MQTT handlers on a fixed pool of worker threads.
+
+    Messages are routed to a worker by ``tag_uid`` (or ``device_id`` when the
+    message carries no tag), so everything touching one wallet is processed
+    in arrival order while unrelated wallets run in parallel. Each worker has
+    a bounded queue; when it is full the message is rejected through
+    ``on_overload``. :meth:`submit` never blocks: it is called from paho's
+    network thread, which also has to keep the connection alive.
+    """
+
+    def __init__(self, workers: int = 4, queue_depth: int = 256, on_overload: Optional[Handler] = None):
+        if workers < 1:
+            raise ValueError("workers must be >= 1")
+        self.on_overload = on_overload
+        self.rejected = 0
+        self._queues: List[queue.Queue] = [queue.Queue(maxsize=queue_depth) for _ in range(workers)]
+        self._threads: List[threading.Thread] = []
+        self._stopping = threading.Event()
+
+    @staticmethod
+    def key_for(payload: dict) -> str:
+        tag = payload.get("tag_uid")
+        ops = payload.get("ops")
+        if not tag and isinstance(ops, list) and ops and isinstance(ops[0], dict):
+            tag = ops[0].get("tag_uid")  # batches are ordered by their first wallet
+        return str(tag or payload.get("device_id") or "")
+
+    def shard_for(self, key: str) -> int:
+        return zlib.crc32(key.encode("utf-8")) % len(self._queues)
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopping.clear()
+        for i, q in enumerate(self._queues):
+            t = threading.Thread(target=self._run, args=(q,), name=f"mqtt-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: float = 5.0):
+        # Workers drain what is already queued, then notice the event on their next idle poll.
+        self._stopping.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def submit(self, handler: Handler, topic: str, payload: dict) -> bool:
+        q = self._queues[self.shard_for(self.key_for(payload))]
+        try:
+            q.put_nowait((handler, topic, payload))
+            return True
+        except queue.Full:
+            self.rejected += 1
+            metrics.inc("eg_dispatch_rejected_total")
+            if self.on_overload:
+                self.on_overload(topic, payload)
+            return False
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def _run(self, q: queue.Queue):
+        while True:
+            try:
+                handler, topic, payload = q.get(timeout=0.2)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+            try:
+                handler(topic, payload)
+            except Exception:
+                log.exception("handler failed for %s", topic)
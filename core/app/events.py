@@ -0,0 +1,142 @@
+import asyncio, json, threading, time
+from collections import deque
+from typing import AsyncIterator, Callable, Deque, Dict, List, Optional, Set, Tuple
+from .metrics import metrics
+
+Event = Tuple[str, str, str]  # (id, kind, JSON data)
+
+class _Client:
+    __slots__ = ("buf", "wake", "dropped")
+
+    def __init__(self):
+        self.buf: Deque[Event] = deque()
+        self.wake = asyncio.Event()
+        self.dropped = False
+
+class EventHub:
+    """In-process event stream behind ``GET /api/events`` (operator UIs, kiosks).
+
+    :meth:`publish` may be called from any thread; delivery happens on the
+    asyncio loop. Event ids are ``<epoch>-<seq>`` and the last ``history``
+    events are kept, so a client reconnecting with ``Last-Event-ID`` gets
+    what it missed; an id from another run or older than the ring gets a
+    ``reset`` event (refetch state over REST). ``coalesce=True`` events are
+    merged per kind for ``coalesce_ms`` and only the latest value is sent;
+    ``data`` may then be a callable, evaluated once at send time. Each client
+    buffers at most ``client_buffer`` events: one that falls further behind
+    is disconnected and expected to resume.
+    """
+
+    def __init__(self, history: int = 4096, client_buffer: int = 1024, coalesce_ms: int = 100,
+                 keepalive_s: float = 15.0):
+        self.epoch = int(time.time())
+        self.client_buffer = max(1, client_buffer)
+        self.coalesce_s = coalesce_ms / 1000.0
+        self.keepalive_s = keepalive_s
+        self._ring: Deque[Tuple[int, Event]] = deque(maxlen=max(1, history))
+        self._seq = 0
+        self._clients: Set[_Client] = set()
+        self._pending: Dict[str, object] = {}
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        metrics.gauge("eg_events_clients", lambda: len(self._clients), "Clients connected to /api/events")
+
+    def start(self):
+        # Without a running loop (benchmarks driving the core from threads) nothing is served.
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+
+    def stop(self):
+        self._call(self._close_all)
+
+    def publish(self, kind: str, data, coalesce: bool = False):
+        if self._loop is None:
+            return
+        if not coalesce:
+            self._call(self._emit, kind, data)
+            return
+        with self._lock:
+            first = not self._pending
+            self._pending[kind] = data
+        if first:
+            self._call(self._loop.call_later, self.coalesce_s, self._flush)
+
+    async def stream(self, last_event_id: Optional[str] = None) -> AsyncIterator[Optional[Event]]:
+        """Events for one client, starting after ``last_event_id``; None when idle for ``keepalive_s``."""
+        client = _Client()
+        replay = self._replay(last_event_id)
+        self._clients.add(client)
+        try:
+            for ev in replay:
+                yield ev
+            while True:
+                while client.buf:
+                    yield client.buf.popleft()
+                if client.dropped:
+                    return
+                client.wake.clear()
+                try:
+                    await asyncio.wait_for(client.wake.wait(), self.keepalive_s)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            self._clients.discard(client)
+
+    def _call(self, fn: Callable, *args):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            fn(*args)
+        elif self._loop is not None:
+            self._loop.call_soon_threadsafe(fn, *args)
+
+    # Loop thread only from here on.
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for kind, data in pending.items():
+            self._emit(kind, data() if callable(data) else data)
+
+    def _emit(self, kind: str, data):
+        self._seq += 1
+        ev = (f"{self.epoch}-{self._seq}", kind, json.dumps(data, separators=(",", ":")))
+        self._ring.append((self._seq, ev))
+        metrics.inc("eg_events_published_total", kind=kind)
+        for client in list(self._clients):
+            if len(client.buf) >= self.client_buffer:
+                client.dropped = True
+                self._clients.discard(client)
+                metrics.inc("eg_events_dropped_clients_total")
+            else:
+                client.buf.append(ev)
+            client.wake.set()
+
+    def _replay(self, last_event_id: Optional[str]) -> List[Event]:
+        if not last_event_id:
+            return []
+        epoch, _, seq = last_event_id.partition("-")
+        try:
+            epoch_n, seq_n = int(epoch), int(seq)
+        except ValueError:
+            epoch_n, seq_n = -1, -1
+        oldest = self._ring[0][0] if self._ring else self._seq + 1
+        if epoch_n != self.epoch or seq_n > self._seq or seq_n + 1 < oldest:
+            return [(f"{self.epoch}-{self._seq}", "reset", "{}")]
+        return [ev for n, ev in self._ring if n > seq_n]
+
+    def _close_all(self):
+        for client in list(self._clients):
+            client.dropped = True
+            client.wake.set()
+        self._clients.clear()
+
+def sse(ev: Optional[Event]) -> str:
+    """Server-Sent Events framing; None becomes a keepalive comment."""
+    if ev is None:
+        return ": keepalive\n\n"
+    eid, kind, data = ev
+    return f"id: {eid}\nevent: {kind}\ndata: {data}\n\n"
@@ -0,0 +1,104 @@
+import json, threading, time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+from .db import DB
+
+class Reply:
+    """Response to a ``(device_id, req_id)`` request, recorded by the wallet engine.
+
+    The engine calls :meth:`row` with its result inside the transaction (or
+    group-commit batch) that applies the request, so ``processed_reqs``
+    holds the reply exactly when the write happened. ``payload`` is then
+    what gets published. Without a ``req_id`` nothing is recorded.
+    """
+
+    __slots__ = ("device_id", "req_id", "build", "payload")
+
+    def __init__(self, device_id: str, req_id: Optional[str], build: Callable[[Any], Dict]):
+        self.device_id = device_id
+        self.req_id = req_id
+        self.build = build
+        self.payload: Optional[Dict] = None
+
+    def resolve(self, result: Any) -> Dict:
+        self.payload = self.build(result)
+        return self.payload
+
+    def row(self, result: Any, ts: int) -> Optional[Tuple[str, str, int, str]]:
+        payload = self.resolve(result)
+        if not self.req_id:
+            return None
+        return self.device_id, self.req_id, ts, json.dumps(payload)
+
+class ReplyCache:
+    """Bounded LRU/TTL cache of ``(device_id, req_id) -> response``.
+
+    QoS 1 redeliveries and client retries of a wallet or payout-claim request
+    are answered from here instead of being executed again. The wallet
+    engines write each reply to ``processed_reqs`` together with the write
+    it answers (see :class:`Reply`) and keeps them for ``retention_s``
+    (at least ``ttl_s``); the last ``ttl_s`` seconds of them are reloaded on
+    restart. Older ones are only looked up on demand, see :meth:`recall`.
+    """
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, db: Optional[DB], max_entries: int = 10000, ttl_s: int = 3600, retention_s: int = 0):
+        self.db = db
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.retention_s = max(ttl_s, retention_s)
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[Tuple[str, str], Tuple[float, Dict]]" = OrderedDict()
+        self._puts = 0
+
+    def load(self):
+        if not self.db:
+            return
+        since = int(time.time()) - self.ttl_s
+        with self._lock:
+            for device_id, req_id, ts, response in self.db.load_replies(since):
+                self._store((device_id, req_id), response, ts)
+
+    def get(self, device_id: str, req_id: str) -> Optional[Dict]:
+        key = (device_id, req_id)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            ts, response = item
+            if time.time() - ts > self.ttl_s:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def recall(self, device_id: str, req_id: str) -> Optional[Dict]:
+        """Reply from ``processed_reqs`` for a request the memory cache no longer holds (e.g. a spool replay)."""
+        if not self.db:
+            return None
+        response = self.db.get_reply(device_id, req_id, int(time.time()) - self.retention_s)
+        if response is not None:
+            with self._lock:
+                self.hits += 1
+        return response
+
+    def put(self, device_id: str, req_id: str, response: Dict):
+        """Cache a reply already in ``processed_reqs``; prunes the table every PRUNE_EVERY puts."""
+        with self._lock:
+            self._store((device_id, req_id), response, time.time())
+            self._puts += 1
+            prune = self._puts % self.PRUNE_EVERY == 0
+        if self.db and prune:
+            self.db.prune_replies(int(time.time()) - self.retention_s)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _store(self, key: Tuple[str, str], response: Dict, ts: float):
+        self._items[key] = (ts, response)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
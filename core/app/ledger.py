@@ -0,0 +1,100 @@
+import logging, time
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+from .db import DB
+from .metrics import metrics
+from .wallet_cache import WriteBehindWallet
+
+log = logging.getLogger(__name__)
+
+# Balance effect of each tx_log op; payout_claim rows only annotate the credit row next to them.
+SIGN = {"credit": 1, "debit": -1}
+
+def fold(balances: Dict[str, int], rows: Iterable[Tuple[int, str, str, int]], touched: Optional[Set[str]] = None) -> int:
+    """Apply (id, op, tag_uid, amount_cents) ledger rows to ``balances``; returns the last id (0 if none)."""
+    seq = 0
+    for seq, op, tag, amount in rows:
+        sign = SIGN.get(op)
+        if sign:
+            balances[tag] = balances.get(tag, 0) + sign * (amount or 0)
+            if touched is not None:
+                touched.add(tag)
+    return seq
+
+def load_ledger(db: DB, batch_rows: int = 10000) -> Tuple[Dict[str, int], int, Set[str]]:
+    """Newest checkpoint plus the tx_log tail after it: (balances, last id, tags the tail touched)."""
+    balances = db.load_balances()
+    seq = db.last_checkpoint()
+    touched: Set[str] = set()
+    while True:
+        rows = db.ledger_after(seq, batch_rows)
+        if not rows:
+            return balances, seq, touched
+        seq = fold(balances, rows, touched)
+
+def recover_wallets(db: DB, engine: str) -> int:
+    """Bring ``wallets`` up to date after a ledger-engine run, for the other engines.
+
+    Only needed when the last run used WALLET_ENGINE=ledger and did not stop
+    cleanly; returns the number of wallets rewritten.
+    """
+    if db.get_kv("wallet_engine") != "ledger":
+        return 0
+    balances, _, touched = load_ledger(db)
+    if touched:
+        ts = db.now()
+        db.write_batch([(tag, balances[tag], ts) for tag in touched], [], checkpoint=True)
+    db.set_kv("wallet_engine", engine)
+    return len(touched)
+
+class LedgerWallet(WriteBehindWallet):
+    """Write-behind engine where ``tx_log`` is the source of truth.
+
+    Group commits only append to ``tx_log`` (and claim payouts, record replies); ``wallets``
+    becomes a checkpoint. Every ``checkpoint_s`` seconds, and on stop, the
+    wallet rows changed since the previous checkpoint go out in the same
+    transaction as a flush, together with the tx_log id they reflect. At
+    startup the balances are the newest checkpoint plus a replay of the
+    rows after it, so a crash costs at most ``checkpoint_s`` of replay.
+
+    The first start on a database written by another engine takes its
+    ``wallets`` table as checkpoint of the current tx_log; going back to
+    another engine afterwards runs :func:`recover_wallets` first.
+    """
+
+    def __init__(self, db: DB, flush_ms: int = 5, flush_ops: int = 256, checkpoint_s: float = 30.0,
+                 writer: Optional[Callable] = None):
+        if db.get_kv("wallet_engine") != "ledger":
+            db.write_batch([], [], checkpoint=True)
+            db.set_kv("wallet_engine", "ledger")
+        t0 = time.perf_counter()
+        balances, seq, touched = load_ledger(db)
+        super().__init__(db, flush_ms=flush_ms, flush_ops=flush_ops, balances=balances, writer=writer)
+        self.checkpoint_s = checkpoint_s
+        self._next_checkpoint = time.monotonic() + checkpoint_s
+        ts = db.now()
+        # Replayed wallets go into the first checkpoint.
+        self._wallets = {tag: (tag, balances[tag], ts) for tag in touched}
+        log.info("ledger: %d wallets at tx_log id %d, %d replayed in %.3fs", len(balances), seq, len(touched),
+                 time.perf_counter() - t0)
+
+    def stop(self):
+        super().stop()
+        if self._wallets:
+            self._commit(list(self._wallets.values()), [], [], [], [], checkpoint=True)
+            self._wallets = {}
+
+    # Called with self._lock held.
+    def _take(self) -> Tuple:
+        txs, claims, replies, payouts = self._txs, self._claims, self._replies, self._payouts
+        self._txs, self._claims, self._replies, self._payouts = [], [], [], []
+        wallets: list = []
+        checkpoint = self._stop or time.monotonic() >= self._next_checkpoint
+        if checkpoint:
+            wallets, self._wallets = list(self._wallets.values()), {}
+            self._next_checkpoint = time.monotonic() + self.checkpoint_s
+        return wallets, txs, claims, replies, payouts, checkpoint
+
+    def _commit(self, wallets, txs, claims, replies, payouts, checkpoint=False):
+        self.writer(self.db.write_batch, wallets, txs, claims, replies, checkpoint, payouts)
+        if checkpoint:
+            metrics.inc("eg_ledger_checkpoints_total")
@@ -1,130 +1,655 @@
-import os, threading
-from fastapi import FastAPI
-from typing import Dict
+import asyncio, os, json, functools, logging
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from typing import Dict, Optional, Tuple
+from .archive import TxArchiver
+from .aio_bus import AsyncMqttBus
+from .codec import negotiate
 from .db import DB
+from .db_executor import DBExecutor, InlineExecutor
+from .dispatch import ShardedDispatcher
+from .batch import claim_result
+from .events import EventHub, sse
+from .idempotency import Reply, ReplyCache
+from .ledger import LedgerWallet, recover_wallets
+from .metrics import metrics, profiler
 from .mqtt_bus import MqttBus
-from .schemas import ModeIn, NightStepIn, PayoutList
+from .payouts import PayoutBook
+from .presence import Presence
+from .schemas import ModeIn, NightStepIn, PayoutList, ProfilerIn, TxPage
+from .sharding import ShardMap
+from .votes import VoteTally
+from .wallet_cache import WalletUnavailable, WriteBehindWallet
 
 MQTT_HOST = os.getenv("MQTT_HOST", "localhost")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
+# payload codecs the core agrees to use towards devices that offer them in hello
+MQTT_CODECS = [c for c in os.getenv("MQTT_CODECS", "bin1,json").split(",") if c]
+# outbound publish queue (MqttBus): waiting messages, unacknowledged QoS 1 messages in paho
+MQTT_PUBLISH_QUEUE = int(os.getenv("MQTT_PUBLISH_QUEUE", "4096"))
+MQTT_MAX_INFLIGHT = int(os.getenv("MQTT_MAX_INFLIGHT", "64"))
 CORE_DEVICE_ID = os.getenv("CORE_DEVICE_ID", "core-01")
 DB_PATH = os.getenv("DB_PATH", "/data/eg.db")
+DB_READ_POOL = int(os.getenv("DB_READ_POOL", "4"))
 NIGHT_EXPECTED_VOTES = int(os.getenv("NIGHT_EXPECTED_VOTES", "9"))
+# online: vote quorum = slots currently online (NIGHT_EXPECTED_VOTES until a slot has been seen); static: NIGHT_EXPECTED_VOTES
+NIGHT_QUORUM = os.getenv("NIGHT_QUORUM", "online")
+NIGHT_TALLY_INTERVAL_MS = int(os.getenv("NIGHT_TALLY_INTERVAL_MS", "500"))
+# inline: handlers run on paho's network thread; sharded: per-tag worker pool;
+# asyncio: MQTT I/O and handlers on the uvicorn loop, DB work on a single writer thread
+DISPATCH_MODE = os.getenv("DISPATCH_MODE", "inline")
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "4"))
+DISPATCH_QUEUE_DEPTH = int(os.getenv("DISPATCH_QUEUE_DEPTH", "256"))
+# sqlite: one commit per operation; writebehind: in-memory balances + group commit;
+# ledger: like writebehind, but commits only append to tx_log and balances are checkpointed
+WALLET_ENGINE = os.getenv("WALLET_ENGINE", "sqlite")
+WALLET_FLUSH_MS = int(os.getenv("WALLET_FLUSH_MS", "5"))
+WALLET_FLUSH_OPS = int(os.getenv("WALLET_FLUSH_OPS", "256"))
+LEDGER_CHECKPOINT_S = float(os.getenv("LEDGER_CHECKPOINT_S", "30"))
+PAYOUT_SNAPSHOT_S = float(os.getenv("PAYOUT_SNAPSHOT_S", "5"))
+REPLY_CACHE_SIZE = int(os.getenv("REPLY_CACHE_SIZE", "10000"))
+REPLY_CACHE_TTL_S = int(os.getenv("REPLY_CACHE_TTL_S", "3600"))
+# processed_reqs rows are kept this long for offline replays (agents' spool_max_age_s must stay below)
+REPLY_RETENTION_S = int(os.getenv("REPLY_RETENTION_S", "86400"))
+# tx_log sessions older than TX_RETENTION_DAYS go to gzip files in TX_ARCHIVE_DIR (0, the default, disables)
+TX_ARCHIVE_DIR = os.getenv("TX_ARCHIVE_DIR", os.path.join(os.path.dirname(DB_PATH), "archive"))
+TX_RETENTION_DAYS = int(os.getenv("TX_RETENTION_DAYS", "0"))
+TX_SESSION_START_HOUR = int(os.getenv("TX_SESSION_START_HOUR", "12"))
+TX_ARCHIVE_INTERVAL_S = float(os.getenv("TX_ARCHIVE_INTERVAL_S", "3600"))
+TX_PAGE_MAX = 500
+STATS_MINUTES_MAX = 24 * 60
+# /api/events: replay ring, per-client buffer, tally coalescing window
+EVENTS_HISTORY = int(os.getenv("EVENTS_HISTORY", "4096"))
+EVENTS_CLIENT_BUFFER = int(os.getenv("EVENTS_CLIENT_BUFFER", "1024"))
+EVENTS_COALESCE_MS = int(os.getenv("EVENTS_COALESCE_MS", "100"))
+# Sharded deployment: SHARD_COUNT workers, each with its own DB_PATH and CORE_DEVICE_ID
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_COORDINATOR = int(os.getenv("SHARD_COORDINATOR", "0"))
+SHARD_GROUP = os.getenv("SHARD_GROUP", "core")
+
+log = logging.getLogger(__name__)
+
+# Inline dispatch handles one message at a time, so each group commit would hold a single op: the
+# write-behind engines then only add latency over sqlite.
+if DISPATCH_MODE == "inline" and WALLET_ENGINE == "writebehind":
+    raise RuntimeError("WALLET_ENGINE=writebehind needs DISPATCH_MODE=sharded or asyncio")
+if DISPATCH_MODE == "inline" and WALLET_ENGINE == "ledger":
+    log.warning("WALLET_ENGINE=ledger with DISPATCH_MODE=inline: one op per group commit, "
+                "use DISPATCH_MODE=sharded or asyncio for throughput")
+
+RES_TYPES = {
+    "eg/core/wallet/get": "wallet_get",
+    "eg/core/wallet/debit": "wallet_debit",
+    "eg/core/wallet/credit": "wallet_credit",
+    "eg/core/wallet/batch": "wallet_batch",
+    "eg/core/payouts/claim": "payout_claim",
+}
 
 app = FastAPI(title="EG Core", version="1.0.0")
-db = DB(DB_PATH)
-bus = MqttBus(client_id=CORE_DEVICE_ID, host=MQTT_HOST, port=MQTT_PORT)
-current_step_lock = threading.Lock()
-current_step = {"step": None}
+shards = ShardMap(SHARD_COUNT, SHARD_INDEX, SHARD_COORDINATOR, SHARD_GROUP)
+db = DB(DB_PATH, read_pool=DB_READ_POOL)
+# Every write goes through dbx.run (plain threads) or dbx.write (asyncio handlers); in asyncio mode
+# that makes its writer thread the only one writing.
+dbx = DBExecutor(queue_depth=DISPATCH_QUEUE_DEPTH) if DISPATCH_MODE == "asyncio" else InlineExecutor()
+wallet = db
+if WALLET_ENGINE == "ledger":
+    wallet = LedgerWallet(db, flush_ms=WALLET_FLUSH_MS, flush_ops=WALLET_FLUSH_OPS, checkpoint_s=LEDGER_CHECKPOINT_S,
+                          writer=dbx.run)
+else:
+    recover_wallets(db, WALLET_ENGINE)
+    if WALLET_ENGINE == "writebehind":
+        wallet = WriteBehindWallet(db, flush_ms=WALLET_FLUSH_MS, flush_ops=WALLET_FLUSH_OPS, writer=dbx.run)
+replies = ReplyCache(db, max_entries=REPLY_CACHE_SIZE, ttl_s=REPLY_CACHE_TTL_S, retention_s=REPLY_RETENTION_S)
+metrics.gauge("eg_reply_cache_entries", lambda: len(replies), "Entries in the req_id reply cache")
+metrics.gauge("eg_reply_cache_hits", lambda: replies.hits, "Duplicate requests answered from the reply cache")
+dispatcher = None
+if DISPATCH_MODE == "sharded":
+    dispatcher = ShardedDispatcher(workers=DISPATCH_WORKERS, queue_depth=DISPATCH_QUEUE_DEPTH)
+if DISPATCH_MODE == "asyncio":
+    bus = AsyncMqttBus(client_id=CORE_DEVICE_ID, host=MQTT_HOST, port=MQTT_PORT, max_inflight=DISPATCH_QUEUE_DEPTH)
+else:
+    bus = MqttBus(client_id=CORE_DEVICE_ID, host=MQTT_HOST, port=MQTT_PORT, dispatcher=dispatcher,
+                  publish_queue=MQTT_PUBLISH_QUEUE, max_inflight=MQTT_MAX_INFLIGHT)
+events = EventHub(history=EVENTS_HISTORY, client_buffer=EVENTS_CLIENT_BUFFER, coalesce_ms=EVENTS_COALESCE_MS)
+
+def publish_payouts_delta(delta: Dict):
+    bus.publish("eg/payouts/delta", delta)
+    events.publish("payouts_delta", delta)
+
+def publish_night_result(result: Dict):
+    bus.publish("eg/night/result", result)
+    events.publish("night_result", result)
+
+payouts = PayoutBook(db, publish_delta=publish_payouts_delta,
+                     publish_snapshot=lambda snap: bus.publish("eg/payouts/snapshot", snap, retain=True),
+                     snapshot_interval_s=PAYOUT_SNAPSHOT_S)
+presence = Presence()
+metrics.gauge("eg_devices_online", lambda: len(presence.online()), "Devices currently online (hello/status)")
+
+def night_quorum() -> int:
+    if NIGHT_QUORUM == "online" and presence.known("slot"):
+        return max(1, len(presence.online("slot")))
+    return NIGHT_EXPECTED_VOTES
+
+tally = VoteTally(db, quorum=night_quorum, publish_interval_s=NIGHT_TALLY_INTERVAL_MS / 1000.0,
+                  on_tally=lambda snap: bus.publish("eg/night/tally", snap),
+                  on_result=publish_night_result, writer=dbx.run)
+archiver = TxArchiver(db, TX_ARCHIVE_DIR, retention_days=TX_RETENTION_DAYS,
+                      session_start_hour=TX_SESSION_START_HOUR, interval_s=TX_ARCHIVE_INTERVAL_S,
+                      max_id=db.last_checkpoint if WALLET_ENGINE == "ledger" else None, writer=dbx.run)
+
+def on_presence_change(device_id: str, device_type: str, online: bool):
+    events.publish("device", {"device_id": device_id, "type": device_type, "online": online})
+    if not shards.is_coordinator:
+        return
+    if device_type == "slot":
+        tally.recheck()
+    if not online:
+        return
+    # Catch a device up on what it missed while away, on its own topic.
+    if device_type == "slot" and tally.step is not None:
+        night = json.loads(db.get_kv("night_step") or "null") or {}
+        bus.publish(f"eg/dev/{device_id}/night/step", {"step": tally.step, "question": night.get("question"),
+                                                       "options": tally.options})
+    elif device_type == "change":
+        bus.publish(f"eg/dev/{device_id}/payouts", payouts.snapshot())
+
+presence.on_change = on_presence_change
 
 def publish_mode(mode: str):
     bus.publish("eg/state/mode", {"mode": mode}, retain=True)
+    events.publish("mode", {"mode": mode})
 
 @app.on_event("startup")
 def on_startup():
+    if dispatcher:
+        dispatcher.on_overload = reject_busy
+    dbx.start()
+    events.start()
+    if isinstance(wallet, WriteBehindWallet):
+        wallet.start()
+    replies.load()
+    if shards.is_coordinator:
+        night = json.loads(db.get_kv("night_step") or "null")
+        if night:
+            tally.restore(night["step"], night.get("options", []))
+        tally.start()
     bus.connect()
-    bus.subscribe("eg/core/wallet/get", on_wallet_get)
-    bus.subscribe("eg/core/wallet/debit", on_wallet_debit)
-    bus.subscribe("eg/core/wallet/credit", on_wallet_credit)
-    bus.subscribe("eg/core/payouts/new", on_payout_new)
-    bus.subscribe("eg/core/payouts/claim", on_payout_claim)
-    bus.subscribe("eg/night/vote", on_night_vote)
-    mode = db.get_kv("mode") or "day"
-    db.set_kv("mode", mode)
-    publish_mode(mode)
-    push_change_payouts()
+    wallet_handlers = {
+        "eg/core/wallet/get": variant(on_wallet_get, on_wallet_get_async),
+        "eg/core/wallet/debit": idempotent(variant(on_wallet_debit, on_wallet_debit_async)),
+        "eg/core/wallet/credit": idempotent(variant(on_wallet_credit, on_wallet_credit_async)),
+        "eg/core/wallet/batch": idempotent(variant(on_wallet_batch, on_wallet_batch_async)),
+    }
+    for topic, handler in wallet_handlers.items():
+        bus.subscribe(shards.shared(topic), routed(handler))
+        if shards.enabled:
+            bus.subscribe(shards.forward_topic(shards.index, topic), handler)
+    if shards.enabled:
+        bus.subscribe(shards.forward_topic(shards.index, "eg/core/payouts/credit"),
+                      variant(on_payout_credit, on_payout_credit_async))
+    bus.subscribe("eg/dev/+/hello", on_hello)
+    if shards.is_coordinator:
+        bus.subscribe("eg/core/payouts/new", variant(on_payout_new, on_payout_new_async))
+        if shards.enabled:
+            claim = variant(on_payout_claim_sharded, on_payout_claim_sharded_async)
+        else:
+            claim = variant(on_payout_claim, on_payout_claim_async)
+        bus.subscribe("eg/core/payouts/claim", idempotent(claim, "change-01"))
+        bus.subscribe("eg/core/payouts/sync", on_payout_sync)
+        bus.subscribe("eg/night/vote", on_night_vote)
+        mode = db.get_kv("mode") or "day"
+        dbx.run(db.set_kv, "mode", mode)
+        publish_mode(mode)
+        payouts.load()
+        payouts.start()
+    # Retained, so this rebuilds the presence registry; after payouts.load() as it may push snapshots.
+    bus.subscribe("eg/dev/+/status", on_status)
+    archiver.start()
+
+@app.on_event("shutdown")
+def on_shutdown():
+    events.stop()
+    bus.disconnect()
+    archiver.stop()
+    tally.stop()
+    payouts.stop()
+    if isinstance(wallet, WriteBehindWallet):
+        wallet.stop()
+    dbx.stop()
 
 @app.get("/health")
 def health():
     return {"ok": True}
 
+def coordinator_only():
+    if not shards.is_coordinator:
+        raise HTTPException(status_code=409, detail=f"shard {shards.index} is not the coordinator "
+                                                    f"(shard {shards.coordinator})")
+
 @app.post("/api/mode")
 def set_mode(body: ModeIn):
-    db.set_kv("mode", body.mode)
+    coordinator_only()
+    dbx.run(db.set_kv, "mode", body.mode)
     publish_mode(body.mode)
     return {"ok": True, "mode": body.mode}
 
 @app.post("/api/night/step")
 def night_step(body: NightStepIn):
-    with current_step_lock:
-        current_step["step"] = body.step
-    db.reset_votes_for_step(body.step)
+    coordinator_only()
+    dbx.run(db.set_kv, "night_step", json.dumps({"step": body.step, "question": body.question, "options": body.options}))
+    tally.open_step(body.step, body.options)
     bus.publish("eg/night/step", {"step": body.step, "question": body.question, "options": body.options})
+    events.publish("night_step", {"step": body.step, "question": body.question, "options": body.options})
     return {"ok": True}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/metrics")
+def get_metrics_summary():
+    return metrics.summary()
+
+@app.get("/api/profiler")
+def get_profiler(top: int = 25):
+    return profiler.report(top)
+
+@app.post("/api/profiler")
+def set_profiler(body: ProfilerIn):
+    profiler.configure(body.handler, body.sample_rate)
+    if body.reset:
+        profiler.reset(body.handler)
+    return {"ok": True, "enabled": profiler.report(0)["enabled"]}
+
+@app.get("/api/devices")
+def get_devices(type: Optional[str] = None):
+    devices = presence.snapshot(type)
+    online: Dict[str, int] = {}
+    for d in devices:
+        if d["online"]:
+            online[d["type"]] = online.get(d["type"], 0) + 1
+    return {"devices": devices, "online": online, "night_quorum": night_quorum()}
+
+@app.get("/api/night/tally")
+def night_tally():
+    return tally.snapshot()
+
+@app.get("/api/events")
+async def get_events(request: Request, last_event_id: Optional[str] = None):
+    # EventSource sends Last-Event-ID itself when it reconnects; the query parameter covers a page reload.
+    resume = request.headers.get("last-event-id") or last_event_id
+
+    async def body():
+        async for ev in events.stream(resume):
+            yield sse(ev)
+    return StreamingResponse(body(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.get("/api/payouts", response_model=PayoutList)
 def get_payouts():
     items = db.list_ready_payouts()
     return {"items": items}
 
+@app.get("/api/tx", response_model=TxPage)
+def get_tx(tag_uid: Optional[str] = None, device_id: Optional[str] = None, op: Optional[str] = None,
+           since: Optional[int] = None, until: Optional[int] = None, cursor: Optional[str] = None, limit: int = 50):
+    try:
+        items, nxt = db.query_tx(tag_uid, device_id, op, since, until, cursor, max(1, min(limit, TX_PAGE_MAX)))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+    return {"items": items, "next": nxt}
+
+@app.get("/api/tx/summary")
+def get_tx_summary(device_id: Optional[str] = None, tag_uid: Optional[str] = None,
+                   since: Optional[int] = None, until: Optional[int] = None):
+    return {"ops": db.tx_summary(device_id, tag_uid, since, until)}
+
+@app.get("/api/stats")
+def get_stats(minutes: int = 60, device_id: Optional[str] = None):
+    out = db.stats(db.now() - 60 * max(1, min(minutes, STATS_MINUTES_MAX)), device_id)
+    out["night"] = tally.snapshot() if shards.is_coordinator else None
+    if shards.enabled:
+        out["shard"] = shards.index
+    return out
+
+@app.post("/api/tx/archive")
+def run_tx_archive():
+    if TX_RETENTION_DAYS <= 0:
+        return {"ok": False, "files": []}
+    return {"ok": True, "files": archiver.run_once()}
+
+def variant(sync, async_):
+    # Handlers come in pairs: plain functions for the threaded dispatch modes, coroutines going
+    # through dbx for the asyncio core.
+    return async_ if DISPATCH_MODE == "asyncio" else sync
+
+def wallet_write(op: str, *args):
+    return getattr(wallet, op)(*args)
+
+async def wallet_write_async(op: str, *args):
+    # Write-behind: apply on the DB thread without waiting for the commit there,
+    # so the ops queued behind this one go into the same group commit.
+    if isinstance(wallet, WriteBehindWallet):
+        res, seq = await dbx.write(wallet.begin, op, *args)
+        await wallet.durable(seq)
+        return res
+    return await dbx.write(getattr(wallet, op), *args)
+
+# (device_id, req_id) of the requests being executed (asyncio mode only: the threaded modes run a
+# wallet's requests one at a time), so a duplicate arriving meanwhile waits instead of running twice
+inflight: Dict[Tuple[str, str], asyncio.Event] = {}
+
 def respond(device_id: str, payload: Dict):
     bus.publish(f"eg/dev/{device_id}/res", payload)
 
-def on_wallet_get(topic: str, msg: dict):
+def respond_once(reply: Reply):
+    # The engine wrote it to processed_reqs with the write it answers; cache it before publishing.
+    if reply.req_id:
+        replies.put(reply.device_id, reply.req_id, reply.payload)
+    respond(reply.device_id, reply.payload)
+
+async def respond_once_async(reply: Reply):
+    if reply.req_id:
+        await dbx.write(replies.put, reply.device_id, reply.req_id, reply.payload)
+    respond(reply.device_id, reply.payload)
+
+def claim_payload(req_id: Optional[str], status: str, credited_cents: Optional[int],
+                  new_balance_cents: Optional[int]) -> Dict:
+    return {"req_id": req_id, "type": "payout_claim", "status": status,
+            "credited_cents": credited_cents, "new_balance_cents": new_balance_cents}
+
+def idempotent(handler, default_device: str = "unknown"):
+    # Answer redelivered/retried requests from the reply cache without re-executing them.
+    if asyncio.iscoroutinefunction(handler):
+        return idempotent_async(handler, default_device)
+
+    @functools.wraps(handler)
+    def wrapper(topic: str, msg: dict):
+        req_id = msg.get("req_id")
+        if req_id:
+            device_id = msg.get("device_id", default_device)
+            cached = replies.get(device_id, req_id)
+            if cached is None and msg.get("spooled_at"):
+                # Offline replay, possibly older than the memory cache: ask processed_reqs.
+                cached = replies.recall(device_id, req_id)
+            if cached is not None:
+                respond(device_id, cached)
+                return
+        try:
+            handler(topic, msg)
+        except WalletUnavailable:
+            # Rolled back by the write-behind engine: nothing was applied, the device may retry.
+            reject_busy(topic, msg)
+    return wrapper
+
+def idempotent_async(handler, default_device: str):
+    @functools.wraps(handler)
+    async def wrapper(topic: str, msg: dict):
+        req_id = msg.get("req_id")
+        key = None
+        if req_id:
+            device_id = msg.get("device_id", default_device)
+            key = (device_id, req_id)
+            while True:
+                cached = replies.get(device_id, req_id)
+                if cached is None and msg.get("spooled_at"):
+                    cached = await dbx.read(replies.recall, device_id, req_id)
+                if cached is not None:
+                    respond(device_id, cached)
+                    return
+                running = inflight.get(key)
+                if running is None:
+                    break
+                # The same request is still being executed; answer with its reply.
+                await running.wait()
+            inflight[key] = asyncio.Event()
+        try:
+            await handler(topic, msg)
+        except WalletUnavailable:
+            reject_busy(topic, msg)
+        finally:
+            done = inflight.pop(key, None) if key else None
+            if done:
+                done.set()
+    return wrapper
+
+def routed(handler):
+    # Sharded deployment: handle wallets this worker owns, forward the rest to their owner.
+    if not shards.enabled:
+        return handler
+    if asyncio.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def wrapper_async(topic: str, msg: dict):
+            if route(topic, msg):
+                await handler(topic, msg)
+        return wrapper_async
+
+    @functools.wraps(handler)
+    def wrapper(topic: str, msg: dict):
+        if route(topic, msg):
+            handler(topic, msg)
+    return wrapper
+
+def route(topic: str, msg: dict) -> bool:
+    # True when this worker owns the message; otherwise forward it or reject a cross-shard batch.
+    owner = shards.owner_of(msg)
+    if owner == shards.index:
+        return True
+    if owner is not None:
+        metrics.inc("eg_shard_forwarded_total", shard=str(owner))
+        bus.publish(shards.forward_topic(owner, topic), msg)
+    elif msg.get("device_id"):
+        respond(msg["device_id"], {"req_id": msg.get("req_id"), "type": RES_TYPES.get(topic),
+                                   "status": "invalid", "error": "batch spans several shards"})
+    return False
+
+def reject_busy(topic: str, msg: dict):
+    device_id = msg.get("device_id")
+    rtype = RES_TYPES.get(ShardMap.origin(topic))
+    if not device_id or not rtype:
+        return
+    respond(device_id, {"req_id": msg.get("req_id"), "type": rtype, "status": "busy"})
+
+def on_hello(topic: str, msg: dict):
+    device_id = topic.split("/")[2]
+    codec = negotiate(msg.get("codecs"), MQTT_CODECS)
+    bus.set_codec(device_id, codec)
+    if shards.is_coordinator:
+        bus.publish(f"eg/dev/{device_id}/codec", {"codec": codec})
+    presence.hello(device_id, msg)
+
+def on_status(topic: str, msg: dict):
+    presence.status(topic.split("/")[2], msg.get("status"))
+
+# Request parsers shared by both handler variants: (wallet method args, reply).
+
+def debit_request(msg: dict) -> Tuple[tuple, Reply]:
     req_id = msg.get("req_id")
     device_id = msg.get("device_id", "unknown")
-    tag_uid = msg.get("tag_uid")
-    bal = db.get_balance(tag_uid) if tag_uid else 0
-    respond(device_id, {"req_id": req_id, "type": "wallet_get", "status": "ok",
-                        "balance_cents": bal})
+    reply = Reply(device_id, req_id, lambda res: {
+        "req_id": req_id, "type": "wallet_debit", "status": "ok" if res[0] else "insufficient",
+        "new_balance_cents": res[1]})
+    return (device_id, msg.get("tag_uid"), int(msg.get("amount_cents", 0)), msg.get("reason", "debit"), reply), reply
 
-def on_wallet_debit(topic: str, msg: dict):
+def credit_request(msg: dict) -> Tuple[tuple, Reply]:
     req_id = msg.get("req_id")
     device_id = msg.get("device_id", "unknown")
-    tag_uid = msg.get("tag_uid")
-    amount = int(msg.get("amount_cents", 0))
-    reason = msg.get("reason", "debit")
-    ok, new_bal = db.debit(device_id, tag_uid, amount, reason)
-    status = "ok" if ok else "insufficient"
-    respond(device_id, {"req_id": req_id, "type": "wallet_debit", "status": status,
-                        "new_balance_cents": new_bal})
+    reply = Reply(device_id, req_id, lambda bal: {"req_id": req_id, "type": "wallet_credit", "status": "ok",
+                                                  "new_balance_cents": bal})
+    return (device_id, msg.get("tag_uid"), int(msg.get("amount_cents", 0)), msg.get("reason", "credit"), reply), reply
 
-def on_wallet_credit(topic: str, msg: dict):
+def batch_request(msg: dict) -> Tuple[tuple, Reply]:
     req_id = msg.get("req_id")
     device_id = msg.get("device_id", "unknown")
-    tag_uid = msg.get("tag_uid")
-    amount = int(msg.get("amount_cents", 0))
-    reason = msg.get("reason", "credit")
-    new_bal = db.credit(device_id, tag_uid, amount, reason)
-    respond(device_id, {"req_id": req_id, "type": "wallet_credit", "status": "ok",
-                        "new_balance_cents": new_bal})
+    reply = Reply(device_id, req_id, lambda plan: {
+        "req_id": req_id, "type": "wallet_batch", "status": plan.status, "failed_op": plan.failed_op,
+        "balances": plan.balances, "results": plan.results})
+    return (device_id, msg.get("ops"), reply), reply
 
-def on_payout_new(topic: str, msg: dict):
-    payout_id = msg.get("payout_id")
-    source = msg.get("source")
+def batch_invalid(msg: dict, error: ValueError):
+    device_id = msg.get("device_id", "unknown")
+    respond(device_id, {"req_id": msg.get("req_id"), "type": "wallet_batch", "status": "invalid",
+                        "error": str(error)})
+
+def claim_request(msg: dict) -> Tuple[tuple, Reply]:
+    req_id = msg.get("req_id")
+    device_id = msg.get("device_id", "change-01")
+    reply = Reply(device_id, req_id, lambda plan: claim_payload(req_id, *claim_result(plan)))
+    return (msg.get("payout_id"), device_id, msg.get("tag_uid"), reply), reply
+
+def credit_forwarded_request(msg: dict) -> Tuple[tuple, Reply]:
+    req_id = msg.get("req_id")
+    device_id = msg.get("device_id", "change-01")
     amount = int(msg.get("amount_cents", 0))
-    meta = msg.get("meta", {})
-    if not payout_id:
-        return
-    db.insert_payout(payout_id, source, amount, meta)
-    push_change_payouts()
+    source = msg.get("source") or "roulette"  # forwards from an older coordinator carry no source
+    reply = Reply(device_id, req_id, lambda res: claim_payload(req_id, *res))
+    return (msg.get("payout_id"), source, amount, device_id, msg.get("tag_uid"), reply), reply
 
-def push_change_payouts():
-    items = db.list_ready_payouts()
-    bus.publish("eg/dev/change-01/payouts", {"items": items})
+def new_payout(msg: dict) -> Optional[tuple]:
+    if not msg.get("payout_id"):
+        return None
+    return msg["payout_id"], msg.get("source"), int(msg.get("amount_cents", 0)), msg.get("meta", {})
 
-def on_payout_claim(topic: str, msg: dict):
+def forward_claim(msg: dict, status: str, amount: Optional[int], source: Optional[str]) -> Optional[Reply]:
+    # Coordinator, after take_payout: forward the credit to the wallet's shard, or return the reply
+    # to send when nothing was taken.
     req_id = msg.get("req_id")
     device_id = msg.get("device_id", "change-01")
     payout_id = msg.get("payout_id")
     tag_uid = msg.get("tag_uid")
-    status, credited_cents, new_balance = db.claim_payout(payout_id, device_id, tag_uid)
-    respond(device_id, {
-        "req_id": req_id, "type": "payout_claim", "status": status,
-        "credited_cents": credited_cents, "new_balance_cents": new_balance
+    if status != "ok":
+        # Nothing was written: cached for retries, not recorded in processed_reqs.
+        reply = Reply(device_id, req_id, lambda res: claim_payload(req_id, *res))
+        reply.resolve((status, None, None))
+        return reply
+    payouts.remove(payout_id)
+    bus.publish(shards.forward_topic(shards.owner(tag_uid), "eg/core/payouts/credit"), {
+        "req_id": req_id, "device_id": device_id, "payout_id": payout_id, "tag_uid": tag_uid,
+        "amount_cents": amount, "source": source
     })
-    push_change_payouts()
+    return None
+
+def on_wallet_get(topic: str, msg: dict):
+    tag_uid = msg.get("tag_uid")
+    bal = wallet.get_balance(tag_uid) if tag_uid else 0
+    respond(msg.get("device_id", "unknown"), {"req_id": msg.get("req_id"), "type": "wallet_get",
+                                              "status": "ok", "balance_cents": bal})
+
+async def on_wallet_get_async(topic: str, msg: dict):
+    tag_uid = msg.get("tag_uid")
+    bal = await dbx.read(wallet.get_balance, tag_uid) if tag_uid else 0
+    respond(msg.get("device_id", "unknown"), {"req_id": msg.get("req_id"), "type": "wallet_get",
+                                              "status": "ok", "balance_cents": bal})
+
+def on_wallet_debit(topic: str, msg: dict):
+    args, reply = debit_request(msg)
+    wallet_write("debit", *args)
+    respond_once(reply)
+
+async def on_wallet_debit_async(topic: str, msg: dict):
+    args, reply = debit_request(msg)
+    await wallet_write_async("debit", *args)
+    await respond_once_async(reply)
+
+def on_wallet_credit(topic: str, msg: dict):
+    args, reply = credit_request(msg)
+    wallet_write("credit", *args)
+    respond_once(reply)
+
+async def on_wallet_credit_async(topic: str, msg: dict):
+    args, reply = credit_request(msg)
+    await wallet_write_async("credit", *args)
+    await respond_once_async(reply)
+
+def on_wallet_batch(topic: str, msg: dict):
+    args, reply = batch_request(msg)
+    try:
+        plan = wallet_write("apply_batch", *args)
+    except ValueError as e:
+        batch_invalid(msg, e)
+        return
+    respond_once(reply)
+    for _, _, payout_id in plan.claims:
+        payouts.remove(payout_id)
+
+async def on_wallet_batch_async(topic: str, msg: dict):
+    args, reply = batch_request(msg)
+    try:
+        plan = await wallet_write_async("apply_batch", *args)
+    except ValueError as e:
+        batch_invalid(msg, e)
+        return
+    await respond_once_async(reply)
+    for _, _, payout_id in plan.claims:
+        payouts.remove(payout_id)
+
+def on_payout_new(topic: str, msg: dict):
+    args = new_payout(msg)
+    if args and db.insert_payout(*args):
+        payouts.add({"payout_id": args[0], "source": args[1], "amount_cents": args[2]})
+
+async def on_payout_new_async(topic: str, msg: dict):
+    args = new_payout(msg)
+    if args and await dbx.write(db.insert_payout, *args):
+        payouts.add({"payout_id": args[0], "source": args[1], "amount_cents": args[2]})
+
+def on_payout_sync(topic: str, msg: dict):
+    device_id = msg.get("device_id")
+    if device_id:
+        bus.publish(f"eg/dev/{device_id}/payouts", payouts.snapshot())
+
+def on_payout_claim(topic: str, msg: dict):
+    args, reply = claim_request(msg)
+    status, _, _ = wallet_write("claim_payout", *args)
+    respond_once(reply)
+    if status == "ok":
+        payouts.remove(msg.get("payout_id"))
+
+async def on_payout_claim_async(topic: str, msg: dict):
+    args, reply = claim_request(msg)
+    status, _, _ = await wallet_write_async("claim_payout", *args)
+    await respond_once_async(reply)
+    if status == "ok":
+        payouts.remove(msg.get("payout_id"))
 
 def on_night_vote(topic: str, msg: dict):
     device_id = msg.get("device_id")
     step = int(msg.get("step", -1))
     choice = msg.get("choice")
-    with current_step_lock:
-        if step != current_step.get("step"):
-            return
     if not device_id or not choice:
         return
-    db.add_vote(step, device_id, choice)
-    count = db.count_votes_for_step(step)
-    if count >= NIGHT_EXPECTED_VOTES:
-        bus.publish("eg/night/result", {"step": step, "status": "success", "next_step": step + 1})
+    if tally.vote(step, device_id, choice):
+        events.publish("night_tally", tally.snapshot, coalesce=True)
+
+def on_payout_claim_sharded(topic: str, msg: dict):
+    # Coordinator: mark the payout claimed here, let the wallet's shard credit it and answer.
+    tag_uid = msg.get("tag_uid")
+    if shards.owner(tag_uid) == shards.index:
+        on_payout_claim(topic, msg)
+        return
+    reply = forward_claim(msg, *db.take_payout(msg.get("payout_id"), tag_uid))
+    if reply:
+        respond_once(reply)
+
+async def on_payout_claim_sharded_async(topic: str, msg: dict):
+    tag_uid = msg.get("tag_uid")
+    if shards.owner(tag_uid) == shards.index:
+        await on_payout_claim_async(topic, msg)
+        return
+    reply = forward_claim(msg, *await dbx.write(db.take_payout, msg.get("payout_id"), tag_uid))
+    if reply:
+        await respond_once_async(reply)
+
+def on_payout_credit(topic: str, msg: dict):
+    # Owner shard: credit a payout claimed on the coordinator, at most once per payout_id
+    # (see DB.credit_forwarded_payout).
+    args, reply = credit_forwarded_request(msg)
+    wallet_write("credit_forwarded_payout", *args)
+    respond_once(reply)
+
+async def on_payout_credit_async(topic: str, msg: dict):
+    args, reply = credit_forwarded_request(msg)
+    await wallet_write_async("credit_forwarded_payout", *args)
+    await respond_once_async(reply)
@@ -0,0 +1,246 @@
+import bisect, cProfile, io, pstats, random, threading, time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Seconds; covers a sub-millisecond in-memory handler up to a stalled SD card commit.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def topic_label(topic: str) -> str:
+    """Collapse per-device topics (eg/dev/<id>/...) to keep label cardinality bounded."""
+    parts = topic.split("/")
+    if len(parts) > 2 and parts[1] == "dev":
+        parts[2] = "+"
+        return "/".join(parts)
+    return topic
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-th observation.
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float("inf")
+        return float("inf")
+
+class Metrics:
+    """Process-wide counters, histograms and gauges.
+
+    Recording is a dict lookup and an increment under one lock, cheap enough
+    to stay enabled in production. Output is Prometheus text exposition
+    (:meth:`render`) or a JSON-friendly summary (:meth:`summary`).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, _Histogram]] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self.started = time.time()
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = tuple(sorted(labels.items()))
+        idx = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            h = series.get(key)
+            if h is None:
+                h = series[key] = _Histogram()
+            h.counts[idx] += 1
+            h.sum += seconds
+            h.count += 1
+
+    def gauge(self, name: str, fn: Callable[[], float], help_text: str = ""):
+        self._gauges[name] = fn
+        if help_text:
+            self.describe(name, "gauge", help_text)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def render(self) -> str:
+        out: List[str] = []
+        with self._lock:
+            counters = {n: dict(s) for n, s in self._counters.items()}
+            hists = {n: {k: (list(h.counts), h.sum, h.count) for k, h in s.items()} for n, s in self._histograms.items()}
+        for name, series in sorted(counters.items()):
+            self._header(out, name, "counter")
+            for key, v in sorted(series.items()):
+                out.append(f"{name}{_fmt(key)} {v:g}")
+        for name, series in sorted(hists.items()):
+            self._header(out, name, "histogram")
+            for key, (counts, total, count) in sorted(series.items()):
+                cum = 0
+                for le, n in zip(BUCKETS, counts):
+                    cum += n
+                    out.append(f"{name}_bucket{_fmt(key + (('le', f'{le:g}'),))} {cum}")
+                out.append(f"{name}_bucket{_fmt(key + (('le', '+Inf'),))} {count}")
+                out.append(f"{name}_sum{_fmt(key)} {total:.6f}")
+                out.append(f"{name}_count{_fmt(key)} {count}")
+        for name, fn in sorted(self._gauges.items()):
+            self._header(out, name, "gauge")
+            out.append(f"{name} {_safe(fn):g}")
+        return "\n".join(out) + "\n"
+
+    def summary(self) -> Dict:
+        with self._lock:
+            counters = {n: {_flat(k): v for k, v in s.items()} for n, s in self._counters.items()}
+            hists = {
+                n: {_flat(k): {"count": h.count, "avg_ms": (h.sum / h.count * 1000) if h.count else 0.0,
+                               "p50_ms": h.quantile(0.5) * 1000, "p95_ms": h.quantile(0.95) * 1000,
+                               "p99_ms": h.quantile(0.99) * 1000}
+                    for k, h in s.items()}
+                for n, s in self._histograms.items()
+            }
+        gauges = {n: _safe(fn) for n, fn in self._gauges.items()}
+        return {"uptime_s": time.time() - self.started, "counters": counters, "histograms": hists, "gauges": gauges}
+
+    def _header(self, out: List[str], name: str, kind: str):
+        _, help_text = self._help.get(name, (kind, ""))
+        if help_text:
+            out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {kind}")
+
+def _fmt(key: Labels) -> str:
+    if not key:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in key)
+    return "{" + body + "}"
+
+def _flat(key: Labels) -> str:
+    return ",".join(f"{k}={v}" for k, v in key) or "_"
+
+def _safe(fn: Callable[[], float]) -> float:
+    try:
+        return float(fn())
+    except Exception:
+        return float("nan")
+
+class TimedLock:
+    """Reentrant lock recording how long callers wait to acquire it."""
+
+    def __init__(self, name: str, registry: "Metrics"):
+        self._lock = threading.RLock()
+        self._name = name
+        self._metrics = registry
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if self._lock.acquire(False):
+            self._metrics.observe("eg_lock_wait_seconds", 0.0, lock=self._name)
+            return True
+        if not blocking:
+            return False
+        t0 = time.perf_counter()
+        ok = self._lock.acquire(True, timeout)
+        self._metrics.observe("eg_lock_wait_seconds", time.perf_counter() - t0, lock=self._name)
+        return ok
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class HandlerProfiler:
+    """Opt-in sampling profiler for MQTT handlers, switchable at runtime.
+
+    While enabled for a handler, about ``sample_rate`` of its calls run
+    under cProfile and are merged into one pstats report per handler.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rates: Dict[str, float] = {}
+        self._stats: Dict[str, pstats.Stats] = {}
+        self._samples: Dict[str, int] = {}
+
+    def configure(self, handler: str, sample_rate: float):
+        with self._lock:
+            if sample_rate > 0:
+                self._rates[handler] = min(1.0, sample_rate)
+            else:
+                self._rates.pop(handler, None)
+
+    def reset(self, handler: Optional[str] = None):
+        with self._lock:
+            for d in (self._stats, self._samples):
+                if handler is None:
+                    d.clear()
+                else:
+                    d.pop(handler, None)
+
+    def call(self, handler: str, fn: Callable, *args):
+        rate = self._rates.get(handler)
+        if not rate or random.random() >= rate:
+            return fn(*args)
+        prof = cProfile.Profile()
+        try:
+            return prof.runcall(fn, *args)
+        finally:
+            with self._lock:
+                if handler in self._stats:
+                    self._stats[handler].add(prof)
+                else:
+                    self._stats[handler] = pstats.Stats(prof)
+                self._samples[handler] = self._samples.get(handler, 0) + 1
+
+    def report(self, top: int = 25) -> Dict:
+        with self._lock:
+            out = {"enabled": dict(self._rates), "handlers": {}}
+            for handler, stats in self._stats.items():
+                buf = io.StringIO()
+                stats.stream = buf
+                stats.sort_stats("cumulative").print_stats(top)
+                out["handlers"][handler] = {"samples": self._samples.get(handler, 0), "report": buf.getvalue()}
+            return out
+
+metrics = Metrics()
+profiler = HandlerProfiler()
+
+metrics.describe("eg_mqtt_messages_total", "counter", "MQTT messages received, by topic")
+metrics.describe("eg_mqtt_published_total", "counter", "MQTT messages published, by topic")
+metrics.describe("eg_handler_seconds", "histogram", "Handler execution time, by handler")
+metrics.describe("eg_lock_wait_seconds", "histogram", "Time spent waiting to acquire a lock")
+metrics.describe("eg_db_commit_seconds", "histogram", "SQLite write/commit duration")
+metrics.describe("eg_dispatch_rejected_total", "counter", "Messages rejected because a worker queue was full")
+metrics.describe("eg_shard_forwarded_total", "counter", "Wallet requests republished to the owning shard")
+metrics.describe("eg_mqtt_publish_coalesced_total", "counter", "Publishes merged into a queued one for the same topic")
+metrics.describe("eg_mqtt_publish_skipped_total", "counter", "Retained publishes skipped as identical to the last one sent")
+metrics.describe("eg_mqtt_publish_dropped_total", "counter",
+                 "Publishes dropped: payout deltas once the queue is full, the oldest device messages at 4x that")
+metrics.describe("eg_events_published_total", "counter", "Events sent on /api/events")
+metrics.describe("eg_events_dropped_clients_total", "counter", "/api/events clients disconnected for falling behind")
+metrics.describe("eg_wallet_commit_errors_total", "counter", "Failed write-behind group commit attempts")
+metrics.describe("eg_wallet_rollbacks_total", "counter", "Write-behind batches rolled back after their commit kept failing")
+metrics.describe("eg_ledger_checkpoints_total", "counter", "Wallet balance checkpoints written by the ledger engine")
@@ -1,57 +1,100 @@
-import json, threading
-from typing import Callable, Dict
+import threading, time
+from typing import Callable, Dict, Optional
 import paho.mqtt.client as mqtt
+from .codec import CODECS, JSON, decode
+from .dispatch import ShardedDispatcher
+from .metrics import metrics, profiler, topic_label
+from .publisher import PublishQueue
+from .topic_router import TopicRouter
+
+# Published state snapshots where only the latest value matters (retained topics always qualify).
+COALESCE_TOPICS = frozenset({"eg/payouts/snapshot", "eg/night/tally"})
+# Broadcasts a subscriber can afford to miss: it notices the version gap and resyncs from the snapshot.
+DROPPABLE_TOPICS = frozenset({"eg/payouts/delta"})
 
 class MqttBus:
-    def __init__(self, client_id: str, host: str, port: int):
+    def __init__(self, client_id: str, host: str, port: int, dispatcher: Optional[ShardedDispatcher] = None,
+                 publish_queue: int = 4096, max_inflight: int = 64):
         self.client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv5, transport="tcp")
         self.client.enable_logger()
+        self._out = PublishQueue(self.client, self._encode, max_queue=publish_queue, max_inflight=max_inflight)
         self.host, self.port = host, port
-        self._handlers: Dict[str, Callable[[str, dict], None]] = {}
+        self._router = TopicRouter()
         self._connected = threading.Event()
+        self._dispatcher = dispatcher
+        self._codecs: Dict[str, object] = {}  # device_id -> codec negotiated through hello
+        if dispatcher:
+            metrics.gauge("eg_dispatch_queue_depth", dispatcher.depth, "Messages waiting in the dispatch worker queues")
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message
 
     def connect(self):
+        if self._dispatcher:
+            self._dispatcher.start()
+        self._out.start()
         self.client.connect(self.host, self.port, keepalive=30)
         self.client.loop_start()
         self._connected.wait(10)
 
+    def disconnect(self):
+        self._out.stop()
+        self.client.loop_stop()
+        self.client.disconnect()
+        if self._dispatcher:
+            self._dispatcher.stop()
+
     def _on_connect(self, client, userdata, flags, reason_code, props=None):
         self._connected.set()
 
     def subscribe(self, topic: str, handler: Callable[[str, dict], None]):
-        self._handlers[topic] = handler
+        self._router.add(topic, timed(handler))
         self.client.subscribe(topic, qos=1)
 
+    def set_codec(self, device_id: str, name: str):
+        """Encode everything published under eg/dev/<device_id>/ with codec ``name``."""
+        if name == JSON.name:
+            self._codecs.pop(device_id, None)
+        else:
+            self._codecs[device_id] = CODECS[name]
+
     def _on_message(self, client, userdata, msg):
+        payload = decode(msg.payload)
+        metrics.inc("eg_mqtt_messages_total", topic=topic_label(msg.topic))
+        for handler in self._router.match(msg.topic):
+            if self._dispatcher:
+                self._dispatcher.submit(handler, msg.topic, payload)
+            else:
+                handler(msg.topic, payload)
+
+    def publish(self, topic: str, obj: dict, retain: bool=False) -> bool:
+        """Queue ``obj`` for sending; returns at once (see :class:`PublishQueue`).
+
+        Retained and snapshot topics are coalesced and never dropped, nor
+        are one-shot broadcasts (night step and result) and shard forwards
+        (eg/core/...), which nobody would resend. Payout deltas are dropped
+        once the queue is full (change UIs resync from the snapshot) and
+        messages to devices (eg/dev/...) are evicted, oldest first, while
+        the broker stays unreachable. False when the message was dropped.
+        """
+        metrics.inc("eg_mqtt_published_total", topic=topic_label(topic))
+        return self._out.put(topic, obj, retain, coalesce=retain or topic in COALESCE_TOPICS,
+                             droppable=topic in DROPPABLE_TOPICS, evictable=topic.startswith("eg/dev/"))
+
+    def _encode(self, topic: str, obj: dict) -> bytes:
+        codec = JSON
+        if self._codecs and topic.startswith("eg/dev/"):
+            codec = self._codecs.get(topic.split("/", 3)[2], JSON)
+        return codec.encode(obj)
+
+def timed(handler: Callable[[str, dict], None]) -> Callable[[str, dict], None]:
+    """Wrap a handler so its latency is recorded (and sampled by the profiler when enabled)."""
+    name = getattr(handler, "__name__", repr(handler))
+
+    def run(topic: str, payload: dict):
+        t0 = time.perf_counter()
         try:
-            payload = json.loads(msg.payload.decode("utf-8")) if msg.payload else {}
-        except Exception:
-            payload = {}
-        handler = None
-        if msg.topic in self._handlers:
-            handler = self._handlers[msg.topic]
-        else:
-            for t, h in self._handlers.items():
-                if self._match(t, msg.topic):
-                    handler = h
-                    break
-        if handler:
-            handler(msg.topic, payload)
-
-    def _match(self, pattern: str, topic: str) -> bool:
-        pp = pattern.split("/")
-        tt = topic.split("/")
-        for i, p in enumerate(pp):
-            if p == "#":
-                return True
-            if i >= len(tt):
-                return False
-            if p == "+" or p == tt[i]:
-                continue
-            return False
-        return len(pp) == len(tt)
-
-    def publish(self, topic: str, obj: dict, retain: bool=False):
-        self.client.publish(topic, payload=json.dumps(obj), qos=1, retain=retain)
+            profiler.call(name, handler, topic, payload)
+        finally:
+            metrics.observe("eg_handler_seconds", time.perf_counter() - t0, handler=name)
+    run.__name__ = name
+    return run
@@ -0,0 +1,86 @@
+import threading, time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+from .db import DB
+
+class PayoutBook:
+    """Versioned in-memory set of ready payouts.
+
+    Every change bumps ``version`` and is published, in version order, as a
+    small delta (``added`` items or ``removed`` ids). A full snapshot is
+    published retained every ``snapshot_interval_s`` when the set changed, so a change
+    terminal that joins late or misses a version can resync; ``publish_snapshot``
+    returns False when the snapshot was not queued, and it is retried on the
+    next tick. ``epoch``
+    identifies the core run; a new epoch means versions restarted.
+    """
+
+    def __init__(self, db: DB, publish_delta: Callable[[Dict], None], publish_snapshot: Callable[[Dict], bool],
+                 snapshot_interval_s: float = 5.0):
+        self.db = db
+        self.publish_delta = publish_delta
+        self.publish_snapshot = publish_snapshot
+        self.snapshot_interval_s = snapshot_interval_s
+        self.epoch = int(time.time())
+        self.version = 0
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[str, Dict]" = OrderedDict()
+        self._snapshot_version = -1
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def load(self):
+        with self._lock:
+            self._items = OrderedDict((p["payout_id"], p) for p in self.db.list_ready_payouts())
+            self.version += 1
+
+    def start(self):
+        self.refresh_snapshot(force=True)
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="payout-snapshot", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def add(self, item: Dict):
+        with self._lock:
+            if item["payout_id"] in self._items:
+                return
+            self._items[item["payout_id"]] = item
+            self.version += 1
+            self.publish_delta({"epoch": self.epoch, "version": self.version, "added": [item], "removed": []})
+
+    def remove(self, payout_id: str):
+        with self._lock:
+            if self._items.pop(payout_id, None) is None:
+                return
+            self.version += 1
+            self.publish_delta({"epoch": self.epoch, "version": self.version, "added": [], "removed": [payout_id]})
+
+    def items(self) -> List[Dict]:
+        with self._lock:
+            return list(self._items.values())
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return self._snapshot()
+
+    def refresh_snapshot(self, force: bool = False):
+        with self._lock:
+            if not force and self._snapshot_version == self.version:
+                return
+            if self.publish_snapshot(self._snapshot()):
+                self._snapshot_version = self.version
+
+    def _snapshot(self) -> Dict:
+        return {"epoch": self.epoch, "version": self.version, "items": list(self._items.values())}
+
+    def _run(self):
+        while not self._stop.wait(self.snapshot_interval_s):
+            self.refresh_snapshot()
@@ -0,0 +1,71 @@
+import threading, time
+from typing import Callable, Dict, List, Optional
+
+class Presence:
+    """Devices seen on MQTT and whether they are online, by type.
+
+    Fed by ``eg/dev/<id>/hello`` (online, with ``type`` and ``version``)
+    and the ``eg/dev/<id>/status`` LWT (``online``/``offline``, retained, so
+    subscribing at startup rebuilds the registry from the broker). A device
+    known only from its status gets the type from its id prefix
+    (``slot-03`` -> ``slot``) until it says hello. ``on_change(device_id,
+    type, online)`` is called outside the lock whenever a device goes
+    online or offline.
+    """
+
+    def __init__(self, on_change: Optional[Callable[[str, str, bool], None]] = None):
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self._devices: Dict[str, Dict] = {}
+
+    def hello(self, device_id: str, info: Dict):
+        with self._lock:
+            dev = self._device(device_id)
+            dev["type"] = info.get("type") or dev["type"]
+            dev["version"] = info.get("version") or dev["version"]
+            changed = self._set_online(dev, True)
+        self._notify(dev, changed)
+
+    def status(self, device_id: str, status: str):
+        if status not in ("online", "offline"):
+            return
+        with self._lock:
+            dev = self._device(device_id)
+            changed = self._set_online(dev, status == "online")
+        self._notify(dev, changed)
+
+    def online(self, device_type: Optional[str] = None) -> List[str]:
+        with self._lock:
+            return sorted(d["device_id"] for d in self._devices.values()
+                          if d["online"] and (device_type is None or d["type"] == device_type))
+
+    def known(self, device_type: str) -> bool:
+        """Whether any device of ``device_type`` was ever seen (online or not)."""
+        with self._lock:
+            return any(d["type"] == device_type for d in self._devices.values())
+
+    def snapshot(self, device_type: Optional[str] = None) -> List[Dict]:
+        with self._lock:
+            return [dict(d) for _, d in sorted(self._devices.items())
+                    if device_type is None or d["type"] == device_type]
+
+    # Called with self._lock held.
+    def _device(self, device_id: str) -> Dict:
+        dev = self._devices.get(device_id)
+        if dev is None:
+            dev = {"device_id": device_id, "type": device_id.rsplit("-", 1)[0], "version": None,
+                   "online": False, "since": None, "last_seen": None}
+            self._devices[device_id] = dev
+        dev["last_seen"] = int(time.time())
+        return dev
+
+    def _set_online(self, dev: Dict, online: bool) -> bool:
+        if dev["online"] == online and dev["since"] is not None:
+            return False
+        dev["online"] = online
+        dev["since"] = dev["last_seen"]
+        return True
+
+    def _notify(self, dev: Dict, changed: bool):
+        if changed and self.on_change:
+            self.on_change(dev["device_id"], dev["type"], dev["online"])
@@ -0,0 +1,159 @@
+import logging, threading, time
+from collections import deque
+from typing import Callable, Deque, Dict, Optional
+import paho.mqtt.client as mqtt
+from .metrics import metrics, topic_label
+
+log = logging.getLogger(__name__)
+
+class _Entry:
+    __slots__ = ("topic", "obj", "retain", "evictable")
+
+    def __init__(self, topic: str, obj: dict, retain: bool, evictable: bool = False):
+        self.topic = topic
+        self.obj = obj
+        self.retain = retain
+        self.evictable = evictable
+
+class PublishQueue:
+    """Outbound side of :class:`MqttBus`: a FIFO drained by one sender thread.
+
+    When nothing is waiting the caller hands its message to paho directly
+    (lowest latency for replies); otherwise it is queued and encoded on the
+    sender thread. A ``coalesce`` publish replaces the payload of a message
+    still waiting for the same topic (last value wins, at the position of the
+    first one), and a retained payload byte-identical to the last one sent
+    on its topic is skipped. paho keeps at most ``max_inflight`` QoS 1
+    messages unacknowledged and queued; beyond that the sender waits for
+    PUBACKs while new publishes pile up (and coalesce) here. Once
+    ``max_queue`` messages are waiting, ``droppable`` ones are discarded;
+    at ``4 * max_queue`` (broker down for a while) the oldest ``evictable``
+    message is dropped for each new one: by then its device has timed out
+    and retries with the same req_id, answered from the reply cache.
+    Retained and coalesced messages are never dropped (nothing would resend
+    them, and coalescing keeps one per topic), nor are messages that are
+    neither droppable nor evictable. Callers never block: in the inline
+    dispatch mode they run on paho's network thread, which is the one
+    reading the PUBACKs.
+    """
+
+    def __init__(self, client: mqtt.Client, encode: Callable[[str, dict], bytes], max_queue: int = 4096,
+                 max_inflight: int = 64):
+        self.client = client
+        self.encode = encode
+        self.max_queue = max(1, max_queue)
+        client.max_inflight_messages_set(max(1, max_inflight))
+        client.max_queued_messages_set(max(1, max_inflight))
+        client.on_publish = self._on_publish
+        self._queue: Deque[_Entry] = deque()
+        self._pending: Dict[str, _Entry] = {}  # coalescable topic -> entry still queued
+        self._retained: Dict[str, bytes] = {}  # topic -> last retained payload sent
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        self._room = threading.Event()
+        self._busy = False  # sender thread is between popping a message and handing it to paho
+        self._stop = False
+        self._deadline = 0.0
+        self._thread: Optional[threading.Thread] = None
+        metrics.gauge("eg_mqtt_publish_queue_depth", lambda: len(self._queue), "Publishes waiting for the sender thread")
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="mqtt-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 2.0):
+        """Send what is queued (for up to ``timeout`` s), then stop the sender."""
+        with self._lock:
+            self._stop = True
+            self._deadline = time.monotonic() + timeout
+            self._work.notify()
+        self._room.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def put(self, topic: str, obj: dict, retain: bool = False, coalesce: bool = False,
+            droppable: bool = False, evictable: bool = False) -> bool:
+        """Queue or send one message; False when it was dropped."""
+        if retain or coalesce:
+            droppable = evictable = False
+        with self._lock:
+            if coalesce:
+                entry = self._pending.get(topic)
+                if entry is not None:
+                    entry.obj, entry.retain = obj, retain
+                    metrics.inc("eg_mqtt_publish_coalesced_total")
+                    return True
+            # Idle: publish from the caller, still under the lock so nothing can overtake it.
+            if not self._queue and not self._busy and self._thread is not None:
+                if self._send(topic, obj, retain, wait=False):
+                    return True
+            if droppable and len(self._queue) >= self.max_queue:
+                metrics.inc("eg_mqtt_publish_dropped_total", topic=topic_label(topic))
+                return False
+            if len(self._queue) >= 4 * self.max_queue:
+                self._evict_oldest()
+            entry = _Entry(topic, obj, retain, evictable or droppable)
+            self._queue.append(entry)
+            if coalesce:
+                self._pending[topic] = entry
+            self._work.notify()
+            return True
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    # Called with self._lock held.
+    def _evict_oldest(self):
+        index = next((i for i, e in enumerate(self._queue) if e.evictable), None)
+        if index is None:
+            return
+        entry = self._queue[index]
+        del self._queue[index]
+        metrics.inc("eg_mqtt_publish_dropped_total", topic=topic_label(entry.topic))
+
+    def _on_publish(self, client, userdata, mid, *args):
+        self._room.set()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._busy = False
+                while not self._queue and not self._stop:
+                    self._work.wait()
+                if not self._queue:
+                    return
+                entry = self._queue.popleft()
+                if self._pending.get(entry.topic) is entry:
+                    del self._pending[entry.topic]
+                topic, obj, retain = entry.topic, entry.obj, entry.retain
+                self._busy = True
+            try:
+                self._send(topic, obj, retain, wait=True)
+            except Exception:
+                log.exception("publish to %s failed", topic)
+
+    def _send(self, topic: str, obj: dict, retain: bool, wait: bool) -> bool:
+        """Hand one message to paho; False (without ``wait``) when paho is full."""
+        payload = self.encode(topic, obj)
+        if retain and self._retained.get(topic) == payload:
+            metrics.inc("eg_mqtt_publish_skipped_total")
+            return True
+        while True:
+            self._room.clear()
+            info = self.client.publish(topic, payload=payload, qos=1, retain=retain)
+            if info.rc != mqtt.MQTT_ERR_QUEUE_SIZE:
+                break
+            if not wait:
+                return False
+            # paho already holds max_inflight messages: wait for a PUBACK.
+            if self._stop and time.monotonic() >= self._deadline:
+                metrics.inc("eg_mqtt_publish_dropped_total", topic=topic_label(topic))
+                return True
+            self._room.wait(0.1)
+        if retain:
+            self._retained[topic] = payload
+        return True
@@ -17,3 +17,21 @@ class PayoutItem(BaseModel):
 
 class PayoutList(BaseModel):
     items: List[PayoutItem]
+
+class ProfilerIn(BaseModel):
+    handler: str
+    sample_rate: float = 0.01
+    reset: bool = False
+
+class TxItem(BaseModel):
+    id: int
+    ts: int
+    device_id: Optional[str] = None
+    op: Optional[str] = None
+    tag_uid: Optional[str] = None
+    amount_cents: Optional[int] = None
+    details: Optional[str] = None
+
+class TxPage(BaseModel):
+    items: List[TxItem]
+    next: Optional[str] = None
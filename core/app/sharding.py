@@ -0,0 +1,66 @@
+import zlib
+from typing import Dict, Optional, Tuple
+
+# tag_uids hash into 2**16 slots split into SHARD_COUNT contiguous ranges.
+HASH_SPACE = 1 << 16
+FORWARD_PREFIX = "eg/core/shard/"
+
+class ShardMap:
+    """Which core worker owns which wallets in a sharded deployment.
+
+    With ``count`` workers, worker ``i`` owns the tags whose slot falls in
+    ``[i * HASH_SPACE // count, (i + 1) * HASH_SPACE // count)``. Wallet
+    requests reach an arbitrary worker through the ``$share/<group>/``
+    subscription and are republished to ``eg/core/shard/<owner>/...`` when
+    it is not the owner. Payouts, night state and the mode live on the
+    ``coordinator`` worker. ``count == 1`` is the classic single core.
+    """
+
+    def __init__(self, count: int = 1, index: int = 0, coordinator: int = 0, group: str = "core"):
+        if count < 1 or not 0 <= index < count or not 0 <= coordinator < count:
+            raise ValueError(f"invalid shard config: count={count} index={index} coordinator={coordinator}")
+        self.count = count
+        self.index = index
+        self.coordinator = coordinator
+        self.group = group
+
+    @property
+    def enabled(self) -> bool:
+        return self.count > 1
+
+    @property
+    def is_coordinator(self) -> bool:
+        return self.index == self.coordinator
+
+    @staticmethod
+    def slot(tag_uid: str) -> int:
+        return zlib.crc32(tag_uid.encode("utf-8")) & (HASH_SPACE - 1)
+
+    def owner(self, tag_uid: str) -> int:
+        return self.slot(tag_uid) * self.count // HASH_SPACE
+
+    def range(self, index: int) -> Tuple[int, int]:
+        return -(-index * HASH_SPACE // self.count), -(-(index + 1) * HASH_SPACE // self.count)
+
+    def owner_of(self, msg: Dict) -> Optional[int]:
+        """Owner of the wallet(s) a request touches; None for a batch spanning shards."""
+        tags = {msg.get("tag_uid")}
+        ops = msg.get("ops")
+        if isinstance(ops, list):
+            tags = {op.get("tag_uid") for op in ops if isinstance(op, dict)}
+        owners = {self.owner(str(t or "")) for t in tags} or {self.owner("")}
+        return owners.pop() if len(owners) == 1 else None
+
+    def shared(self, topic: str) -> str:
+        return f"$share/{self.group}/{topic}" if self.enabled else topic
+
+    def forward_topic(self, index: int, topic: str) -> str:
+        """eg/core/wallet/debit -> eg/core/shard/<index>/wallet/debit"""
+        return f"{FORWARD_PREFIX}{index}/{topic[len('eg/core/'):]}"
+
+    @staticmethod
+    def origin(topic: str) -> str:
+        """Inverse of :meth:`forward_topic`; other topics are returned unchanged."""
+        if topic.startswith(FORWARD_PREFIX):
+            return "eg/core/" + topic[len(FORWARD_PREFIX):].split("/", 1)[1]
+        return topic
@@ -0,0 +1,191 @@
+import logging, queue, threading, time
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Union
+from .db import DB
+
+log = logging.getLogger(__name__)
+
+class VoteTally:
+    """In-memory tally of the current night step.
+
+    One vote per device (last write wins), a per-choice histogram and an
+    O(1) quorum check. Votes are persisted to ``night_votes`` by a background
+    writer and the tally can be rebuilt from that table after a restart.
+    ``on_tally`` receives throttled snapshots (at most one per
+    ``publish_interval_s``, the last one always delivered) and ``on_result``
+    fires once when the quorum is reached. ``quorum`` may be a callable
+    (e.g. the slots currently online): call :meth:`recheck` when its value
+    may have dropped. ``writer(fn, *args)`` runs the DB writes (see
+    :class:`db_executor.DBExecutor`); by default the vote writer thread calls them.
+    """
+
+    def __init__(self, db: DB, quorum: Union[int, Callable[[], int]], publish_interval_s: float = 0.5,
+                 on_tally: Optional[Callable[[Dict], None]] = None,
+                 on_result: Optional[Callable[[Dict], None]] = None, writer: Optional[Callable] = None):
+        self.db = db
+        self.writer = writer or (lambda fn, *args: fn(*args))
+        self.quorum = quorum
+        self.publish_interval_s = publish_interval_s
+        self.on_tally = on_tally
+        self.on_result = on_result
+        self._lock = threading.Lock()
+        self.step: Optional[int] = None
+        self.options: List[str] = []
+        self._votes: Dict[str, str] = {}
+        self._counts: Counter = Counter()
+        self._decided = False
+        self._last_publish = 0.0
+        self._timer: Optional[threading.Timer] = None
+        self._writes: queue.Queue = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._writer:
+            return
+        self._writer = threading.Thread(target=self._write_loop, name="vote-writer", daemon=True)
+        self._writer.start()
+
+    def stop(self):
+        if self._writer:
+            self._writes.put(None)
+            self._writer.join()
+            self._writer = None
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+
+    def open_step(self, step: int, options: List[str]):
+        with self._lock:
+            self._reset(step, options)
+        self._writes.put(("reset", step))
+
+    def restore(self, step: int, options: List[str]):
+        rows = self.db.load_votes(step)
+        with self._lock:
+            self._reset(step, options)
+            for r in rows:
+                self._apply(r["device_id"], r["choice"])
+            self._decided = self.quorum_reached()
+
+    def vote(self, step: int, device_id: str, choice: str) -> bool:
+        result = None
+        with self._lock:
+            if step != self.step:
+                return False
+            if self.options and choice not in self.options:
+                return False
+            if self._votes.get(device_id) == choice:
+                return True
+            self._apply(device_id, choice)
+            self._writes.put(("vote", (step, device_id, choice, int(time.time()))))
+            if not self._decided and self.quorum_reached():
+                self._decided = True
+                result = self._result()
+        self._schedule_tally()
+        if result and self.on_result:
+            self.on_result(result)
+        return True
+
+    def recheck(self):
+        """Decide the step if the quorum is now met without a new vote (devices went offline)."""
+        result = None
+        with self._lock:
+            if self.step is None:
+                return
+            if not self._decided and self._votes and self.quorum_reached():
+                self._decided = True
+                result = self._result()
+        self._schedule_tally()
+        if result and self.on_result:
+            self.on_result(result)
+
+    def expected(self) -> int:
+        return self.quorum() if callable(self.quorum) else self.quorum
+
+    def quorum_reached(self) -> bool:
+        return len(self._votes) >= self.expected()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return self._snapshot()
+
+    # Called with self._lock held.
+    def _reset(self, step: int, options: List[str]):
+        self.step = step
+        self.options = list(options or [])
+        self._votes = {}
+        self._counts = Counter()
+        self._decided = False
+
+    def _apply(self, device_id: str, choice: str):
+        prev = self._votes.get(device_id)
+        if prev is not None:
+            self._counts[prev] -= 1
+        self._votes[device_id] = choice
+        self._counts[choice] += 1
+
+    def _snapshot(self) -> Dict:
+        counts = {o: self._counts.get(o, 0) for o in self.options}
+        counts.update({c: n for c, n in self._counts.items() if n > 0})
+        return {"step": self.step, "votes": len(self._votes), "expected": self.expected(), "counts": counts}
+
+    def _result(self) -> Dict:
+        snap = self._snapshot()
+        order = {o: i for i, o in enumerate(self.options)}
+        # Highest count wins; ties go to the option listed first in the step.
+        winner = min(snap["counts"], key=lambda c: (-snap["counts"][c], order.get(c, len(order)), c))
+        return {"step": self.step, "status": "success", "next_step": self.step + 1,
+                "winner": winner, "counts": snap["counts"], "votes": snap["votes"]}
+
+    def _schedule_tally(self):
+        if not self.on_tally:
+            return
+        with self._lock:
+            if self._timer:
+                return
+            delay = self._last_publish + self.publish_interval_s - time.monotonic()
+            if delay > 0:
+                self._timer = threading.Timer(delay, self._publish_tally)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+        self._publish_tally()
+
+    def _publish_tally(self):
+        with self._lock:
+            self._timer = None
+            self._last_publish = time.monotonic()
+            snap = self._snapshot()
+        self.on_tally(snap)
+
+    def _write_loop(self):
+        while True:
+            item = self._writes.get()
+            batch = [item]
+            while True:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            votes = []
+            for entry in batch:
+                if entry is None or entry[0] == "reset":
+                    self._flush(votes)
+                    votes = []
+                    if entry is None:
+                        return
+                    self._persist(self.db.reset_votes_for_step, entry[1])
+                else:
+                    votes.append(entry[1])
+            self._flush(votes)
+
+    def _flush(self, votes: List):
+        if votes:
+            self._persist(self.db.upsert_votes, votes)
+
+    def _persist(self, fn, arg):
+        try:
+            self.writer(fn, arg)
+        except Exception:
+            log.exception("vote persistence failed")
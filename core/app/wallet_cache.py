@@ -0,0 +1,351 @@
+import asyncio, logging, threading, time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from .batch import BatchPlan, batch_keys, claim_result, forwarded_claim, plan_batch
+from .db import DB
+from .metrics import metrics
+
+log = logging.getLogger(__name__)
+
+class WalletUnavailable(RuntimeError):
+    """The group commit holding an operation failed: it was rolled back and not applied."""
+
+class WriteBehindWallet:
+    """Wallet engine serving balances from memory with group-committed writes.
+
+    The in-memory map is authoritative: it is loaded from ``wallets`` at
+    startup and every credit/debit is checked and applied there first. The
+    resulting wallet rows, ``tx_log`` entries and ``processed_reqs`` replies
+    are queued and committed by a single flusher thread in one SQLite
+    transaction, either once ``flush_ops`` operations are pending,
+    ``flush_ms`` after the oldest one, or as soon as every caller currently
+    inside the engine is waiting.
+    Callers block until their operation is durable, so a response is never
+    published for a write that could still be lost. A batch therefore holds
+    at most one op per blocked thread plus what arrived during the previous
+    commit; the asyncio core uses :meth:`begin`/:meth:`durable` instead so
+    its single DB thread keeps queueing while a commit runs.
+
+    A commit is retried ``commit_retries`` times with backoff. If it still
+    fails, the balances go back to their last durable values, the failed
+    batch and everything queued behind it (checked against those phantom
+    balances) are dropped, and their callers get :class:`WalletUnavailable`.
+
+    ``writer(fn, *args)`` runs the commits: the asyncio core passes its DB
+    executor's ``run`` so its writer thread stays the only one writing (the
+    blocking methods must then not be called from that thread). By default
+    the flusher thread commits itself.
+
+    Exposes the same ``get_balance``/``credit``/``debit``/``claim_payout``/
+    ``apply_batch``/``credit_forwarded_payout`` interface as :class:`DB`.
+    """
+
+    def __init__(self, db: DB, flush_ms: int = 5, flush_ops: int = 256, balances: Optional[Dict[str, int]] = None,
+                 commit_retries: int = 4, writer: Optional[Callable] = None):
+        self.db = db
+        self.writer = writer or (lambda fn, *args: fn(*args))
+        self.flush_s = flush_ms / 1000.0
+        self.flush_ops = max(1, flush_ops)
+        self.commit_retries = max(0, commit_retries)
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        self._done = threading.Condition(self._lock)
+        self._balances: Dict[str, int] = db.load_balances() if balances is None else balances
+        self._wallets: Dict[str, Tuple[str, int, int]] = {}
+        self._txs: List[Tuple] = []
+        self._claims: List[Tuple[str, int, str]] = []
+        self._replies: List[Tuple[str, str, int, str]] = []
+        self._payouts: List[Tuple[str, str, int, str, int]] = []
+        self._claiming: Dict[str, str] = {}  # payout_id -> tag_uid, claims not committed yet
+        # Balance of each tag before its first change since the last take (None: no wallet yet).
+        self._undo: Dict[str, Optional[int]] = {}
+        self._failed: Deque[Tuple[int, int]] = deque(maxlen=16)
+        self._watchers: List[Tuple[int, asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self._first_pending: Optional[float] = None
+        self._seq = 0
+        self._durable = 0
+        self._inflight = 0
+        self._waiting = 0
+        self._stop = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="wallet-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._stop = True
+            self._work.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def get_balance(self, tag_uid: str) -> int:
+        with self._lock:
+            return self._balances.get(tag_uid, 0)
+
+    def credit(self, device_id: str, tag_uid: str, amount_cents: int, reason: str, reply: Any = None) -> int:
+        return self._call(self._credit, device_id, tag_uid, amount_cents, reason, reply)
+
+    def debit(self, device_id: str, tag_uid: str, amount_cents: int, reason: str, reply: Any = None) -> Tuple[bool, int]:
+        return self._call(self._debit, device_id, tag_uid, amount_cents, reason, reply)
+
+    def claim_payout(self, payout_id: str, device_id: str, tag_uid: str, reply: Any = None):
+        return self._call(self._claim_payout, payout_id, device_id, tag_uid, reply)
+
+    def apply_batch(self, device_id: str, ops: List[Dict], reply: Any = None) -> BatchPlan:
+        return self._call(self._apply_batch, device_id, ops, reply)
+
+    def credit_forwarded_payout(self, payout_id: str, source: str, amount_cents: int, device_id: str, tag_uid: str,
+                                reply: Any = None) -> Tuple[str, Optional[int], Optional[int]]:
+        return self._call(self._credit_forwarded_payout, payout_id, source, amount_cents, device_id, tag_uid, reply)
+
+    def begin(self, op: str, *args) -> Tuple[Any, int]:
+        """Run ``op`` (a write method's name, e.g. ``debit``) without waiting for its commit.
+
+        Returns ``(result, seq)``; the result must not be acted upon before
+        :meth:`durable` for ``seq`` returns. Unlike the blocking methods
+        this does not hold the calling thread, so a single writer thread
+        (the asyncio core's) can queue many ops into one group commit.
+        """
+        with self._lock:
+            return getattr(self, "_" + op)(*args)
+
+    async def durable(self, seq: int):
+        """Wait on the running event loop until ``seq`` is committed; raises WalletUnavailable if it was rolled back."""
+        if not seq:
+            return
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        with self._lock:
+            if self._durable >= seq:
+                exc = self._error(seq)
+                if exc:
+                    raise exc
+                return
+            self._watchers.append((seq, loop, fut))
+            self._work.notify()
+        await fut
+
+    # Called with self._lock held; each returns (result, seq of its last tx_log row or 0).
+    def _credit(self, device_id: str, tag_uid: str, amount_cents: int, reason: str, reply=None) -> Tuple[int, int]:
+        ts = int(time.time())
+        bal = self._apply(tag_uid, amount_cents, ts)
+        self._log(ts, device_id, "credit", tag_uid, amount_cents, reason)
+        return bal, self._remember(reply, bal, ts)
+
+    def _debit(self, device_id: str, tag_uid: str, amount_cents: int, reason: str,
+               reply=None) -> Tuple[Tuple[bool, int], int]:
+        ts = int(time.time())
+        bal = self._balances.get(tag_uid, 0)
+        ok = bal >= amount_cents
+        if ok:
+            bal = self._apply(tag_uid, -amount_cents, ts)
+        self._log(ts, device_id, "debit" if ok else "debit_insufficient", tag_uid, amount_cents, reason)
+        return (ok, bal), self._remember(reply, (ok, bal), ts)
+
+    def _claim_payout(self, payout_id: str, device_id: str, tag_uid: str, reply=None) -> Tuple[Tuple, int]:
+        # ``reply`` is built from the BatchPlan, like apply_batch's.
+        plan, seq = self._apply_batch(device_id, [{"op": "payout_claim", "payout_id": payout_id, "tag_uid": tag_uid}],
+                                      reply)
+        return claim_result(plan), seq
+
+    def _apply_batch(self, device_id: str, ops: List[Dict], reply=None) -> Tuple[BatchPlan, int]:
+        tags, payout_ids = batch_keys(ops)
+        ts = int(time.time())
+        balances = {t: self._balances.get(t, 0) for t in tags}
+        plan = plan_batch(device_id, ops, balances, {pid: self._payout(pid) for pid in payout_ids}, ts)
+        self._apply_plan(plan, ts)
+        return plan, self._remember(reply, plan, ts, wrote=plan.ok)
+
+    def _credit_forwarded_payout(self, payout_id: str, source: str, amount_cents: int, device_id: str, tag_uid: str,
+                                 reply=None) -> Tuple[Tuple, int]:
+        # See DB.credit_forwarded_payout; the payout row goes into the same group commit as the credit.
+        ts = int(time.time())
+        known = self._payout(payout_id)
+        res, payout = forwarded_claim(known, payout_id, amount_cents, tag_uid, self._balances.get(tag_uid, 0))
+        if res is not None:
+            return res, self._remember(reply, res, ts, wrote=False)
+        plan = plan_batch(device_id, [{"op": "payout_claim", "payout_id": payout_id, "tag_uid": tag_uid}],
+                          {tag_uid: self._balances.get(tag_uid, 0)}, {payout_id: payout}, ts)
+        if known is None and plan.ok:
+            self._payouts.append((payout_id, source, amount_cents, "{}", ts))
+        self._apply_plan(plan, ts)
+        res = claim_result(plan)
+        return res, self._remember(reply, res, ts, wrote=plan.ok)
+
+    # Called with self._lock held.
+    def _payout(self, payout_id: str) -> Optional[Dict]:
+        claimed_by = self._claiming.get(payout_id)
+        row = self.db.get_payout(payout_id)
+        if claimed_by is not None:
+            # Until the flusher has committed (or dropped) the claim, the DB still says "ready" (or nothing).
+            row = dict(row or {"payout_id": payout_id}, status="claimed", claimed_by_tag=claimed_by)
+        return row
+
+    def _apply_plan(self, plan: BatchPlan, ts: int):
+        if not plan.ok:
+            return
+        for tag, bal in plan.balances.items():
+            self._undo.setdefault(tag, self._balances.get(tag))
+            self._balances[tag] = bal
+            self._wallets[tag] = (tag, bal, ts)
+        for tx in plan.txs:
+            self._log(*tx)
+        self._claiming.update((pid, tag) for tag, _, pid in plan.claims)
+        self._claims.extend(plan.claims)
+
+    # Called with self._lock held.
+    def _apply(self, tag_uid: str, delta: int, ts: int) -> int:
+        self._undo.setdefault(tag_uid, self._balances.get(tag_uid))
+        bal = self._balances.get(tag_uid, 0) + delta
+        self._balances[tag_uid] = bal
+        self._wallets[tag_uid] = (tag_uid, bal, ts)
+        return bal
+
+    def _log(self, ts: int, device_id: str, op: str, tag_uid: str, amount_cents: int, details: str):
+        self._txs.append((ts, device_id, op, tag_uid, amount_cents, details))
+        self._pending()
+
+    def _remember(self, reply, result: Any, ts: int, wrote: bool = True) -> int:
+        """Queue the processed_reqs row of ``reply`` (idempotency.Reply) with the op's writes.
+
+        Returns the seq to wait for, 0 when the op queued nothing.
+        """
+        row = reply.row(result, ts) if reply is not None else None
+        if row:
+            self._replies.append(row)
+            self._pending()
+        elif not wrote:
+            return 0
+        return self._seq
+
+    def _pending(self):
+        if self._first_pending is None:
+            self._first_pending = time.monotonic()
+        self._seq += 1
+
+    def _call(self, op, *args):
+        # Blocking callers count as in flight until their op is durable, see _ready().
+        with self._lock:
+            self._inflight += 1
+            try:
+                res, seq = op(*args)
+                self._waiting += 1
+                self._work.notify()
+                try:
+                    while self._durable < seq:
+                        self._done.wait()
+                finally:
+                    self._waiting -= 1
+            finally:
+                self._inflight -= 1
+            exc = self._error(seq)
+            if exc:
+                raise exc
+            return res
+
+    def _error(self, seq: int) -> Optional[WalletUnavailable]:
+        if any(lo <= seq <= hi for lo, hi in self._failed):
+            return WalletUnavailable("wallet commit failed, operation rolled back")
+        return None
+
+    def _ready(self) -> bool:
+        if not self._txs and not self._replies:
+            return False
+        if self._stop or len(self._txs) >= self.flush_ops or self._waiting >= self._inflight:
+            return True
+        return time.monotonic() - self._first_pending >= self.flush_s
+
+    def _take(self) -> Tuple:
+        wallets, txs, claims, replies, payouts = (list(self._wallets.values()), self._txs, self._claims,
+                                                  self._replies, self._payouts)
+        self._wallets, self._txs, self._claims, self._replies, self._payouts = {}, [], [], [], []
+        return wallets, txs, claims, replies, payouts
+
+    def _commit(self, wallets, txs, claims, replies, payouts):
+        # Flusher thread, lock released.
+        self.writer(self.db.write_batch, wallets, txs, claims, replies, False, payouts)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._ready():
+                    if self._stop:
+                        return
+                    timeout = None
+                    if self._first_pending is not None:
+                        timeout = max(0.0, self._first_pending + self.flush_s - time.monotonic())
+                    self._work.wait(timeout)
+                batch = self._take()
+                undo, self._undo = self._undo, {}
+                upto = self._seq
+                self._first_pending = None
+            ok = self._commit_retrying(batch)
+            with self._lock:
+                for _, _, pid in batch[2]:
+                    self._claiming.pop(pid, None)
+                if not ok:
+                    upto = self._rollback(batch[0], undo)
+                self._durable = upto
+                self._done.notify_all()
+                # One wakeup per event loop for all the begin() ops of the batch.
+                settle: Dict[asyncio.AbstractEventLoop, List] = {}
+                for seq, loop, fut in self._watchers:
+                    if seq <= upto:
+                        settle.setdefault(loop, []).append((fut, self._error(seq)))
+                if settle:
+                    self._watchers = [w for w in self._watchers if w[0] > upto]
+            for loop, futs in settle.items():
+                loop.call_soon_threadsafe(_settle, futs)
+
+    def _commit_retrying(self, batch: Tuple) -> bool:
+        for attempt in range(self.commit_retries + 1):
+            try:
+                self._commit(*batch)
+                return True
+            except Exception:
+                metrics.inc("eg_wallet_commit_errors_total")
+                if attempt == self.commit_retries:
+                    log.exception("wallet group commit failed %d times, rolling back", attempt + 1)
+                    return False
+                log.warning("wallet group commit failed, retrying", exc_info=True)
+                time.sleep(min(2.0, 0.1 * 2 ** attempt))
+        return False
+
+    # Called with self._lock held.
+    def _rollback(self, wallets: List[Tuple[str, int, int]], undo: Dict[str, Optional[int]]) -> int:
+        """Back to the durable balances after a failed commit; returns the last seq failed."""
+        # Ops queued during the retries were checked against the failed balances: drop them too.
+        restore = dict(self._undo)
+        restore.update(undo)
+        ts = int(time.time())
+        for tag, bal in restore.items():
+            if bal is None:
+                self._balances.pop(tag, None)
+                self._wallets.pop(tag, None)
+            else:
+                self._balances[tag] = bal
+                self._wallets[tag] = (tag, bal, ts)
+        # Rows of the failed batch that no op changed (ledger checkpoints) are still due.
+        for tag, _, _ in wallets:
+            if tag in self._balances:
+                self._wallets.setdefault(tag, (tag, self._balances[tag], ts))
+        self._txs, self._claims, self._replies, self._payouts, self._undo = [], [], [], [], {}
+        self._claiming.clear()
+        self._failed.append((self._durable + 1, self._seq))
+        metrics.inc("eg_wallet_rollbacks_total")
+        return self._seq
+
+def _settle(futs: List[Tuple[asyncio.Future, Optional[BaseException]]]):
+    for fut, exc in futs:
+        if fut.done():
+            continue
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(None)
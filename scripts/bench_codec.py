@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""Bytes and CPU per message: JSON vs the struct-based "bin1" codec.
+
+    python3 scripts/bench_codec.py [--rounds 20000]
+"""
+import argparse, json, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "core"))
+from app.codec import BINARY, JSON, decode
+
+MESSAGES = {
+    "wallet/get": {"req_id": "5f0c1e9a7b2d4c3e8f9a0b1c", "device_id": "slot-01", "tag_uid": "04A1B2C3D4E5F6"},
+    "wallet/debit": {"req_id": "5f0c1e9a7b2d4c3e8f9a0b1c", "device_id": "slot-01", "tag_uid": "04A1B2C3D4E5F6",
+                     "amount_cents": 200, "reason": "slot_bet"},
+    "payouts/claim": {"req_id": "5f0c1e9a7b2d4c3e8f9a0b1c", "device_id": "change-01", "payout_id": "R123-2",
+                      "tag_uid": "04A1B2C3D4E5F6"},
+    "night/vote": {"device_id": "slot-01", "step": 1, "choice": "B", "ts": "12345.678"},
+    "res wallet_get": {"req_id": "5f0c1e9a7b2d4c3e8f9a0b1c", "type": "wallet_get", "status": "ok",
+                       "balance_cents": 12300},
+    "res wallet_debit": {"req_id": "5f0c1e9a7b2d4c3e8f9a0b1c", "type": "wallet_debit", "status": "ok",
+                         "new_balance_cents": 12100},
+    "res payout_claim": {"req_id": "5f0c1e9a7b2d4c3e8f9a0b1c", "type": "payout_claim", "status": "ok",
+                         "credited_cents": 12500, "new_balance_cents": 24600},
+}
+
+def per_call_us(fn, arg, rounds: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        fn(arg)
+    return (time.perf_counter() - t0) / rounds * 1e6
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rounds", type=int, default=20000)
+    args = ap.parse_args()
+    print(f"{'message':<18} {'json B':>7} {'bin1 B':>7} {'json enc+dec us':>16} {'bin1 enc+dec us':>16}")
+    for name, msg in MESSAGES.items():
+        j, b = JSON.encode(msg), BINARY.encode(msg)
+        assert decode(j) == msg and decode(b) == msg, name
+        # json.loads directly, as the buses did before the codec layer
+        j_us = per_call_us(JSON.encode, msg, args.rounds) + per_call_us(json.loads, j, args.rounds)
+        b_us = per_call_us(BINARY.encode, msg, args.rounds) + per_call_us(decode, b, args.rounds)
+        print(f"{name:<18} {len(j):>7} {len(b):>7} {j_us:>16.2f} {b_us:>16.2f}")
+
+if __name__ == "__main__":
+    main()
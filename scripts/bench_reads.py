@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""wallet_get throughput under a concurrent write load, with and without the read pool.
+
+    python3 scripts/bench_reads.py [--readers 4] [--writers 2] [--duration 5] [--pool 4] [--dir /data]
+"""
+import argparse, os, random, tempfile, threading, time
+
+import benchlib
+from app.db import DB
+
+def run(pool: int, readers: int, writers: int, duration: float, tags: int, workdir: str, synchronous: str) -> dict:
+    path = os.path.join(tempfile.mkdtemp(prefix="eg-reads-", dir=workdir or None), "eg.db")
+    db = DB(path, read_pool=pool)
+    # FULL fsyncs every commit, closer to what an SD card costs than tmpfs.
+    db._conn.execute(f"PRAGMA synchronous={synchronous}")
+    names = [f"R{i:04d}" for i in range(tags)]
+    for t in names:
+        db.credit("seed", t, 1_000_000, "seed")
+    stop = threading.Event()
+    reads, writes = [0] * readers, [0] * writers
+    lat = benchlib.LatencyStats()
+
+    def reader(i):
+        rnd = random.Random(i)
+        while not stop.is_set():
+            t0 = benchlib.now()
+            db.get_balance(rnd.choice(names))
+            lat.record("get", "ok", benchlib.now() - t0)
+            reads[i] += 1
+
+    def writer(i):
+        rnd = random.Random(1000 + i)
+        while not stop.is_set():
+            tag = rnd.choice(names)
+            if rnd.random() < 0.5:
+                db.debit("bench", tag, 200, "bench")
+            else:
+                db.credit("bench", tag, 200, "bench")
+            writes[i] += 1
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    threads += [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    for th in threads:
+        th.start()
+    time.sleep(duration)
+    stop.set()
+    for th in threads:
+        th.join()
+    s = lat.summary(duration)
+    return {"pool": pool, "reads_s": sum(reads) / duration, "writes_s": sum(writes) / duration,
+            "get_p50_ms": s["latency"]["p50_ms"], "get_p99_ms": s["latency"]["p99_ms"]}
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--readers", type=int, default=4)
+    ap.add_argument("--writers", type=int, default=2)
+    ap.add_argument("--duration", type=float, default=5.0)
+    ap.add_argument("--pool", type=int, default=4)
+    ap.add_argument("--tags", type=int, default=200)
+    ap.add_argument("--dir", default="", help="directory for the DB (use the target storage, not tmpfs)")
+    ap.add_argument("--synchronous", default="FULL", choices=("OFF", "NORMAL", "FULL"))
+    args = ap.parse_args()
+    for pool in (0, args.pool):
+        r = run(pool, args.readers, args.writers, args.duration, args.tags, args.dir, args.synchronous)
+        label = "writer conn" if pool == 0 else f"read pool={pool}"
+        print(f"{label:<14} wallet_get {r['reads_s']:>9.0f}/s  p50={r['get_p50_ms']:.3f}ms p99={r['get_p99_ms']:.3f}ms"
+              f"  | concurrent writes {r['writes_s']:>7.0f}/s")
+
+if __name__ == "__main__":
+    main()
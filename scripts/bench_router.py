@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Micro-benchmark: TopicRouter trie vs. the former linear `_match` scan.
+
+    python3 scripts/bench_router.py [--subs 1000] [--lookups 200000]
+"""
+import argparse, os, random, sys, time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(ROOT, "core"))
+
+from app.topic_router import TopicRouter
+
+def linear_match(pattern: str, topic: str) -> bool:
+    pp = pattern.split("/")
+    tt = topic.split("/")
+    for i, p in enumerate(pp):
+        if p == "#":
+            return True
+        if i >= len(tt):
+            return False
+        if p == "+" or p == tt[i]:
+            continue
+        return False
+    return len(pp) == len(tt)
+
+def build_subs(n: int):
+    subs = ["eg/state/mode", "eg/night/step", "eg/night/vote", "eg/core/wallet/#", "eg/dev/+/status"]
+    i = 0
+    while len(subs) < n:
+        subs.append(f"eg/dev/slot-{i:04d}/res")
+        subs.append(f"eg/dev/slot-{i:04d}/+")
+        i += 1
+    return subs[:n]
+
+def build_topics(n_devices: int):
+    topics = ["eg/state/mode", "eg/night/vote", "eg/core/wallet/debit", "eg/core/wallet/get"]
+    topics += [f"eg/dev/slot-{i:04d}/res" for i in range(n_devices)]
+    topics += [f"eg/dev/slot-{i:04d}/status" for i in range(n_devices)]
+    return topics
+
+def run(label, fn, topics, lookups):
+    rnd = random.Random(42)
+    seq = [rnd.choice(topics) for _ in range(lookups)]
+    t0 = time.perf_counter()
+    matched = 0
+    for t in seq:
+        matched += len(fn(t))
+    dt = time.perf_counter() - t0
+    print(f"{label:<14} {lookups / dt:>12.0f} lookups/s  {dt / lookups * 1e6:8.2f} us/lookup  (matches={matched})")
+    return dt
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--subs", type=int, default=1000)
+    ap.add_argument("--lookups", type=int, default=200000)
+    args = ap.parse_args()
+
+    subs = build_subs(args.subs)
+    topics = build_topics(args.subs // 2)
+    router = TopicRouter()
+    for s in subs:
+        router.add(s, s)
+    uncached = TopicRouter(cache_size=0)
+    for s in subs:
+        uncached.add(s, s)
+
+    def linear(topic):
+        return [s for s in subs if linear_match(s, topic)]
+
+    # Sanity check: both matchers agree.
+    for t in topics:
+        assert sorted(linear(t)) == sorted(router.match(t)), t
+
+    print(f"{len(subs)} subscriptions, {len(topics)} distinct topics")
+    base = run("linear", linear, topics, max(1, args.lookups // 50))
+    base *= 50
+    trie = run("trie", uncached.match, topics, args.lookups)
+    cached = run("trie+cache", router.match, topics, args.lookups)
+    print(f"speedup: trie x{base / trie:.0f}, trie+cache x{base / cached:.0f}")
+
+if __name__ == "__main__":
+    main()
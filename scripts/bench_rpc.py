@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""Load generator / latency benchmark for the wallet, payout and vote RPC path.
+
+Simulates N slot devices and M change terminals, each a closed loop issuing
+one request at a time and matching the reply on eg/dev/<id>/res by req_id.
+
+    # in-process core + fake broker (no mosquitto needed)
+    python3 scripts/bench_rpc.py --slots 12 --change 2 --duration 10 --out bench.json
+    python3 scripts/bench_rpc.py --env WALLET_ENGINE=writebehind --env DISPATCH_MODE=sharded
+    python3 scripts/bench_rpc.py --slot-mix spin=1          # vs. --slot-mix debit=1,credit=1
+
+    # against a running core + mosquitto (invariant checked if --db is readable)
+    python3 scripts/bench_rpc.py --transport mqtt --host localhost --api http://localhost:8000 --db /data/eg.db
+"""
+import argparse, json, os, random, subprocess, threading, time, uuid
+from typing import Callable, Dict, List
+
+import benchlib
+
+AMOUNTS = {"debit": 200, "credit": 500, "claim": 1000}
+SEED_CENTS = 1_000_000
+
+def parse_mix(text: str) -> Dict[str, int]:
+    mix = {}
+    for part in text.split(","):
+        if part.strip():
+            op, w = part.split("=")
+            mix[op.strip()] = int(w)
+    return mix
+
+class FakeTransport:
+    def __init__(self, bus: benchlib.FakeBus):
+        self.bus = bus
+
+    def client(self, client_id: str):
+        return self
+
+    def subscribe(self, topic: str, handler: Callable[[str, dict], None]):
+        self.bus.client_subscribe(topic, handler)
+
+    def publish(self, topic: str, obj: dict):
+        self.bus.publish(topic, obj)
+
+    def close(self):
+        pass
+
+class MqttTransport:
+    def __init__(self, host: str, port: int):
+        self.host, self.port = host, port
+        self._clients: List = []
+
+    def client(self, client_id: str):
+        import paho.mqtt.client as mqtt
+        c = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id, protocol=mqtt.MQTTv5)
+        handlers: Dict[str, Callable] = {}
+
+        def on_message(_c, _u, msg):
+            try:
+                payload = json.loads(msg.payload.decode("utf-8")) if msg.payload else {}
+            except Exception:
+                payload = {}
+            h = handlers.get(msg.topic)
+            if h:
+                h(msg.topic, payload)
+
+        c.on_message = on_message
+        c.connect(self.host, self.port, keepalive=30)
+        c.loop_start()
+        self._clients.append(c)
+
+        class _Client:
+            def subscribe(self, topic, handler):
+                handlers[topic] = handler
+                c.subscribe(topic, qos=1)
+
+            def publish(self, topic, obj):
+                c.publish(topic, json.dumps(obj), qos=1)
+
+        return _Client()
+
+    def close(self):
+        for c in self._clients:
+            c.loop_stop()
+            c.disconnect()
+
+class Device(threading.Thread):
+    def __init__(self, device_id: str, client, mix: Dict[str, int], tags: List[str], stats: benchlib.LatencyStats,
+                 stop_at: float, timeout: float, think_s: float, seed: int):
+        super().__init__(name=device_id, daemon=True)
+        self.device_id = device_id
+        self.client = client
+        self.ops = list(mix)
+        self.weights = [mix[o] for o in self.ops]
+        self.tags = tags
+        self.stats = stats
+        self.stop_at = stop_at
+        self.timeout = timeout
+        self.think_s = think_s
+        self.rnd = random.Random(seed)
+        self._pending: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self.payouts: List[str] = []
+        client.subscribe(f"eg/dev/{device_id}/res", self.on_res)
+
+    def on_res(self, topic: str, msg: dict):
+        with self._lock:
+            slot = self._pending.get(msg.get("req_id"))
+        if slot is not None:
+            slot["res"] = msg
+            slot["t1"] = benchlib.now()
+            slot["ev"].set()
+
+    def call(self, op: str, topic: str, msg: dict) -> Dict:
+        req_id = uuid.uuid4().hex
+        msg = dict(msg, req_id=req_id, device_id=self.device_id)
+        slot = {"ev": threading.Event()}
+        with self._lock:
+            self._pending[req_id] = slot
+        t0 = benchlib.now()
+        self.client.publish(topic, msg)
+        got = slot["ev"].wait(self.timeout)
+        with self._lock:
+            self._pending.pop(req_id, None)
+        if not got:
+            self.stats.record(op, "timeout", None)
+            return {}
+        res = slot["res"]
+        self.stats.record(op, res.get("status", "?"), slot["t1"] - t0)
+        return res
+
+    def run_op(self, op: str):
+        tag = self.rnd.choice(self.tags)
+        if op == "get":
+            self.call(op, "eg/core/wallet/get", {"tag_uid": tag})
+        elif op in ("debit", "credit"):
+            self.call(op, f"eg/core/wallet/{op}", {"tag_uid": tag, "amount_cents": AMOUNTS[op], "reason": "bench"})
+        elif op == "spin":
+            # debit + credit of one spin in a single eg/core/wallet/batch round trip
+            self.call(op, "eg/core/wallet/batch", {"ops": [{"op": "settle_spin", "tag_uid": tag,
+                                                            "bet_cents": AMOUNTS["debit"],
+                                                            "win_cents": self.rnd.choice((0, 0, AMOUNTS["credit"]))}]})
+        elif op == "claim":
+            # Claim a pre-created payout and create the next one ahead of time so the
+            # claim never races its own eg/core/payouts/new.
+            if not self.payouts:
+                self.payouts.append(self.new_payout())
+            payout_id = self.payouts.pop(0)
+            self.payouts.append(self.new_payout())
+            self.call(op, "eg/core/payouts/claim", {"payout_id": payout_id, "tag_uid": tag})
+        elif op == "vote":
+            self.client.publish("eg/night/vote", {"device_id": self.device_id, "step": 1,
+                                                  "choice": self.rnd.choice("ABC"), "ts": str(time.time())})
+            self.stats.record(op, "sent", None)
+        else:
+            raise ValueError(f"unknown op: {op}")
+
+    def new_payout(self) -> str:
+        payout_id = "bench-" + uuid.uuid4().hex[:16]
+        self.client.publish("eg/core/payouts/new",
+                            {"payout_id": payout_id, "source": "roulette", "amount_cents": AMOUNTS["claim"]})
+        return payout_id
+
+    def run(self):
+        while benchlib.now() < self.stop_at:
+            self.run_op(self.rnd.choices(self.ops, self.weights)[0])
+            if self.think_s:
+                time.sleep(self.think_s)
+
+def git_rev() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=benchlib.ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return ""
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--transport", choices=("fake", "mqtt"), default="fake")
+    ap.add_argument("--host", default="localhost")
+    ap.add_argument("--port", type=int, default=1883)
+    ap.add_argument("--api", default="", help="core HTTP base URL (mqtt transport) to open night step 1")
+    ap.add_argument("--db", default="", help="core DB path for the invariant check (mqtt transport)")
+    ap.add_argument("--slots", type=int, default=12)
+    ap.add_argument("--change", type=int, default=2)
+    ap.add_argument("--tags", type=int, default=50)
+    ap.add_argument("--duration", type=float, default=10.0)
+    ap.add_argument("--timeout", type=float, default=5.0)
+    ap.add_argument("--think-ms", type=float, default=0.0)
+    ap.add_argument("--slot-mix", default="get=30,debit=40,credit=25,vote=5")
+    ap.add_argument("--change-mix", default="claim=80,get=20")
+    ap.add_argument("--env", action="append", default=[], metavar="K=V", help="core env override (fake transport)")
+    ap.add_argument("--payouts", type=int, default=50, help="payouts pre-created per change terminal")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default="", help="write results as JSON to this file")
+    args = ap.parse_args()
+
+    env = dict(e.split("=", 1) for e in args.env)
+    core = None
+    db_path = args.db
+    if args.transport == "fake":
+        env.setdefault("NIGHT_EXPECTED_VOTES", str(10 ** 9))
+        core, db_path = benchlib.load_core(env)
+        core.tally.open_step(1, ["A", "B", "C"])
+        transport = FakeTransport(core.bus)
+    else:
+        transport = MqttTransport(args.host, args.port)
+        if args.api:
+            import urllib.request
+            req = urllib.request.Request(args.api.rstrip("/") + "/api/night/step", method="POST",
+                                         headers={"content-type": "application/json"},
+                                         data=json.dumps({"step": 1, "question": "bench", "options": ["A", "B", "C"]}).encode())
+            urllib.request.urlopen(req, timeout=5).read()
+
+    tags = [f"BENCH{i:04d}" for i in range(args.tags)]
+    stats = benchlib.LatencyStats()
+    run_id = uuid.uuid4().hex[:6]
+
+    # Seed every wallet so debits mostly succeed; not part of the measurement.
+    seeder = Device(f"bench-seed-{run_id}", transport.client(f"bench-seed-{run_id}"), {"credit": 1}, tags,
+                    benchlib.LatencyStats(), 0, args.timeout, 0, args.seed)
+    for tag in tags:
+        seeder.call("credit", "eg/core/wallet/credit", {"tag_uid": tag, "amount_cents": SEED_CENTS, "reason": "bench_seed"})
+
+    devices = []
+    for i in range(args.slots):
+        did = f"bench-slot-{run_id}-{i:02d}"
+        devices.append(Device(did, transport.client(did), parse_mix(args.slot_mix), tags, stats, 0,
+                              args.timeout, args.think_ms / 1000.0, args.seed + i + 1))
+    for i in range(args.change):
+        did = f"bench-change-{run_id}-{i:02d}"
+        devices.append(Device(did, transport.client(did), parse_mix(args.change_mix), tags, stats, 0,
+                              args.timeout, args.think_ms / 1000.0, args.seed + 1000 + i))
+    for d in devices:
+        if "claim" in d.ops:
+            d.payouts = [d.new_payout() for _ in range(args.payouts)]
+    time.sleep(1.0)  # let the core insert the pre-created payouts
+    t0 = benchlib.now()
+    stop_at = t0 + args.duration
+    for d in devices:
+        d.stop_at = stop_at
+        d.start()
+    for d in devices:
+        d.join()
+    duration = benchlib.now() - t0
+
+    if core is not None:
+        core.on_shutdown()
+    transport.close()
+
+    result = {
+        "meta": {"ts": int(time.time()), "git": git_rev(), "transport": args.transport, "slots": args.slots,
+                 "change": args.change, "tags": args.tags, "slot_mix": parse_mix(args.slot_mix),
+                 "change_mix": parse_mix(args.change_mix), "env": env},
+        "results": stats.summary(duration),
+        "invariant": benchlib.check_invariant(db_path) if db_path and os.path.exists(db_path) else {"checked": False},
+    }
+    r = result["results"]
+    print(f"{r['total_ops']} ops in {r['duration_s']:.1f}s -> {r['ops_s']:.0f} ops/s | "
+          f"p50={r['latency']['p50_ms']:.2f}ms p95={r['latency']['p95_ms']:.2f}ms p99={r['latency']['p99_ms']:.2f}ms")
+    for op, o in r["ops"].items():
+        print(f"  {op:<7} n={o['count']:<7} p50={o['p50_ms']:.2f} p95={o['p95_ms']:.2f} p99={o['p99_ms']:.2f} {o['status']}")
+    inv = result["invariant"]
+    if inv.get("checked"):
+        print(f"invariant: {'OK' if inv['ok'] else 'FAILED'} ({inv['wallets']} wallets)")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+    return 0 if inv.get("ok", True) else 1
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,174 @@
+"""Shared helpers for the benchmark scripts in this directory.
+
+- `load_core()` imports the FastAPI core in-process against a throw-away DB,
+  with its MqttBus swapped for `FakeBus`.
+- `FakeBus` mimics the broker: core-bound messages are handled on one
+  "network" thread (like paho's loop thread), everything else is delivered
+  straight to the subscribed test clients.
+- `LatencyStats` collects round-trip samples and reports percentiles.
+- `check_invariant()` verifies wallets.balance_cents against tx_log and archived totals,
+  and the stats rollups against tx_log.
+"""
+import asyncio, os, queue, sqlite3, sys, tempfile, threading, time
+from typing import Callable, Dict, List, Optional
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+CORE_DIR = os.path.join(ROOT, "core")
+if CORE_DIR not in sys.path:
+    sys.path.insert(0, CORE_DIR)
+
+from app.aio_bus import atimed
+from app.db import DB
+from app.topic_router import TopicRouter
+
+class FakeBus:
+    """In-process stand-in for MqttBus (same subscribe/publish/connect API).
+
+    With ``loop`` (DISPATCH_MODE=asyncio) handlers run as tasks on that loop,
+    like AsyncMqttBus, instead of on the fake network thread.
+    """
+
+    def __init__(self, dispatcher=None, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self._dispatcher = dispatcher
+        self._aio = loop
+        self._core = TopicRouter()
+        self._clients = TopicRouter()
+        self._inbox: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self.retained: Dict[str, dict] = {}
+        self.published = 0
+
+    # MqttBus API used by the core
+    def connect(self):
+        if self._dispatcher:
+            self._dispatcher.start()
+        self._thread = threading.Thread(target=self._loop, name="fakebus-net", daemon=True)
+        self._thread.start()
+
+    def disconnect(self):
+        self._inbox.put(None)
+        if self._thread:
+            self._thread.join()
+        if self._dispatcher:
+            self._dispatcher.stop()
+
+    def subscribe(self, topic: str, handler: Callable[[str, dict], None]):
+        if self._aio:
+            self._core.add(topic, atimed(handler))
+        else:
+            self._core.add(topic, handler)
+
+    def set_codec(self, device_id: str, name: str):
+        pass  # payloads stay in-process dicts
+
+    def publish(self, topic: str, obj: dict, retain: bool = False) -> bool:
+        self.published += 1
+        if retain:
+            self.retained[topic] = obj
+        if self._core.match(topic):
+            self._inbox.put((topic, obj))
+        for handler in self._clients.match(topic):
+            handler(topic, obj)
+        return True
+
+    # Test-client side
+    def client_subscribe(self, topic: str, handler: Callable[[str, dict], None]):
+        self._clients.add(topic, handler)
+        for t, obj in list(self.retained.items()):
+            if handler in self._clients.match(t):
+                handler(t, obj)
+
+    def _loop(self):
+        while True:
+            item = self._inbox.get()
+            if item is None:
+                return
+            topic, obj = item
+            for handler in self._core.match(topic):
+                if self._aio:
+                    asyncio.run_coroutine_threadsafe(handler(topic, obj), self._aio)
+                elif self._dispatcher:
+                    self._dispatcher.submit(handler, topic, obj)
+                else:
+                    handler(topic, obj)
+
+def load_core(env: Optional[Dict[str, str]] = None, db_path: Optional[str] = None):
+    """Import app.main with a fresh DB and a FakeBus; returns (module, db_path)."""
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(prefix="eg-bench-"), "eg.db")
+    os.environ["DB_PATH"] = db_path
+    for k, v in (env or {}).items():
+        os.environ[k] = str(v)
+    import app.main as core
+    if core.DISPATCH_MODE != "asyncio":
+        core.bus = FakeBus(dispatcher=core.dispatcher)
+        core.on_startup()
+        return core, db_path
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="core-loop", daemon=True).start()
+    core.bus = FakeBus(loop=loop)
+
+    async def startup():
+        core.on_startup()  # uvicorn also calls it on the loop thread
+    asyncio.run_coroutine_threadsafe(startup(), loop).result()
+    return core, db_path
+
+def percentile(sorted_samples: List[float], p: float) -> float:
+    if not sorted_samples:
+        return 0.0
+    k = max(0, min(len(sorted_samples) - 1, int(round(p / 100.0 * len(sorted_samples) + 0.5)) - 1))
+    return sorted_samples[k]
+
+class LatencyStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = {}
+        self.counts: Dict[str, Dict[str, int]] = {}
+
+    def record(self, op: str, status: str, seconds: Optional[float]):
+        with self._lock:
+            c = self.counts.setdefault(op, {})
+            c[status] = c.get(status, 0) + 1
+            if seconds is not None:
+                self.samples.setdefault(op, []).append(seconds)
+
+    def summary(self, duration_s: float) -> Dict:
+        ops = {}
+        total = 0
+        all_samples: List[float] = []
+        for op in sorted(set(self.counts) | set(self.samples)):
+            s = sorted(self.samples.get(op, []))
+            n = sum(self.counts.get(op, {}).values())
+            total += n
+            all_samples.extend(s)
+            ops[op] = {"count": n, "status": self.counts.get(op, {}), "ops_s": n / duration_s if duration_s else 0.0,
+                       **_pcts(s)}
+        all_samples.sort()
+        return {"duration_s": duration_s, "total_ops": total, "ops_s": total / duration_s if duration_s else 0.0,
+                "latency": _pcts(all_samples), "ops": ops}
+
+def _pcts(s: List[float]) -> Dict[str, float]:
+    return {"p50_ms": percentile(s, 50) * 1000, "p95_ms": percentile(s, 95) * 1000,
+            "p99_ms": percentile(s, 99) * 1000, "max_ms": (s[-1] * 1000) if s else 0.0}
+
+def check_invariant(db_path: str) -> Dict:
+    """Every wallet balance must equal its credits minus its debits in tx_log (plus archived totals)."""
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("""
+        SELECT w.tag_uid, w.balance_cents, COALESCE(t.total, 0)
+        FROM wallets w LEFT JOIN (
+            SELECT tag_uid, SUM(total) AS total FROM (
+                SELECT tag_uid, SUM(CASE op WHEN 'credit' THEN amount_cents WHEN 'debit' THEN -amount_cents ELSE 0 END) AS total
+                FROM tx_log GROUP BY tag_uid
+                UNION ALL
+                SELECT tag_uid, credit_cents - debit_cents FROM tx_archive_totals
+            ) GROUP BY tag_uid
+        ) t ON t.tag_uid = w.tag_uid""").fetchall()
+    conn.close()
+    mismatches = [{"tag_uid": tag, "balance_cents": bal, "tx_log_cents": tot} for tag, bal, tot in rows if bal != tot]
+    drift = DB(db_path).rebuild_rollups(dry_run=True)
+    return {"checked": True, "wallets": len(rows), "ok": not mismatches and not drift["drifted_buckets"]
+            and not drift["drifted_totals"], "mismatches": mismatches[:20], "rollup_drift": drift}
+
+def now() -> float:
+    return time.perf_counter()
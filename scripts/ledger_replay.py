@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Rebuild every wallet balance from the ledger (tx_archive_totals + tx_log).
+
+    python3 scripts/ledger_replay.py --db /data/eg.db [--batch 50000] [--engine sqlite --engine ledger] [--repair]
+
+tx_log is read in id order with keyset-paginated batches inside one read
+transaction, so the run sees a consistent snapshot and can go next to a
+live core. Reported: rows/s of the replay and the wallets whose stored
+balance (``wallets``, plus the tail after the newest checkpoint when the
+core runs the ledger engine) differs from it; exit status 1 on mismatch.
+
+--engine NAME replays the same ops (the first --limit rows) through a core
+wallet engine on a scratch DB in --dir, one call at a time in ledger order.
+The input and order are fixed, so ops/s are comparable between engines,
+storage devices and commits. --repair (core stopped) writes the replayed
+balances to ``wallets`` as a checkpoint of the last tx_log id.
+"""
+import argparse, json, os, sqlite3, sys, tempfile, time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "core"))
+from app.db import DB
+from app.ledger import LedgerWallet, fold
+from app.wallet_cache import WriteBehindWallet
+
+ENGINES = ("sqlite", "writebehind", "ledger")
+
+def batches(conn: sqlite3.Connection, batch: int, limit: Optional[int] = None) -> Iterator[List[Tuple]]:
+    """(id, op, tag_uid, amount_cents, device_id) rows in id order, ``batch`` at a time."""
+    last, left = 0, limit
+    while left is None or left > 0:
+        n = batch if left is None else min(batch, left)
+        rows = conn.execute("SELECT id, op, tag_uid, amount_cents, device_id FROM tx_log WHERE id>? ORDER BY id LIMIT ?",
+                            (last, n)).fetchall()
+        if not rows:
+            return
+        yield rows
+        last = rows[-1][0]
+        if left is not None:
+            left -= len(rows)
+
+def opening(conn: sqlite3.Connection) -> Dict[str, int]:
+    """Net effect of the archived rows, per tag."""
+    return {tag: cr - db for tag, cr, db in
+            conn.execute("SELECT tag_uid, credit_cents, debit_cents FROM tx_archive_totals")}
+
+def replay(conn: sqlite3.Connection, batch: int) -> Dict:
+    conn.execute("BEGIN")
+    try:
+        t0 = time.perf_counter()
+        balances = opening(conn)
+        stored = {tag: bal for tag, bal in conn.execute("SELECT tag_uid, balance_cents FROM wallets")}
+        engine = conn.execute("SELECT v FROM kv WHERE k='wallet_engine'").fetchone()
+        checkpoint = None
+        if engine and engine[0] == "ledger":
+            checkpoint = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM wallet_checkpoints").fetchone()[0]
+        rows = reads = seq = 0
+        for chunk in batches(conn, batch):
+            rows += len(chunk)
+            reads += 1
+            ops = [r[:4] for r in chunk]
+            seq = fold(balances, ops)
+            if checkpoint is not None and seq > checkpoint:
+                fold(stored, [r for r in ops if r[0] > checkpoint])
+        elapsed = time.perf_counter() - t0
+    finally:
+        conn.execute("COMMIT")
+    mismatches = [{"tag_uid": tag, "stored_cents": stored.get(tag, 0), "ledger_cents": balances.get(tag, 0)}
+                  for tag in sorted(set(stored) | set(balances)) if stored.get(tag, 0) != balances.get(tag, 0)]
+    return {"rows": rows, "batches": reads, "last_id": seq, "wallets": len(balances), "seconds": elapsed,
+            "rows_s": rows / elapsed if elapsed else 0.0, "checkpoint": checkpoint,
+            "mismatches": len(mismatches), "first_mismatches": mismatches[:20], "balances": balances}
+
+def bench_engine(name: str, conn: sqlite3.Connection, batch: int, limit: Optional[int], workdir: str) -> Dict:
+    path = os.path.join(tempfile.mkdtemp(prefix=f"eg-replay-{name}-", dir=workdir or None), "eg.db")
+    db = DB(path)
+    wallet = db
+    if name == "writebehind":
+        wallet = WriteBehindWallet(db)
+    elif name == "ledger":
+        wallet = LedgerWallet(db)
+    if isinstance(wallet, WriteBehindWallet):
+        wallet.start()
+    expected = opening(conn)
+    for tag, net in sorted(expected.items()):
+        if net:
+            wallet.credit("replay", tag, net, "archived")
+    ops = 0
+    t0 = time.perf_counter()
+    for chunk in batches(conn, batch, limit):
+        for _id, op, tag, amount, device_id in chunk:
+            if op == "credit":
+                wallet.credit(device_id, tag, amount, "replay")
+            elif op in ("debit", "debit_insufficient"):
+                wallet.debit(device_id, tag, amount, "replay")
+            else:
+                continue
+            ops += 1
+        fold(expected, [r[:4] for r in chunk])
+    if isinstance(wallet, WriteBehindWallet):
+        wallet.stop()
+    elapsed = time.perf_counter() - t0
+    got = db.load_balances()
+    diverged = sum(1 for tag in set(got) | set(expected) if got.get(tag, 0) != expected.get(tag, 0))
+    return {"engine": name, "ops": ops, "seconds": elapsed, "ops_s": ops / elapsed if elapsed else 0.0,
+            "diverged": diverged, "db": path}
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--db", required=True)
+    ap.add_argument("--batch", type=int, default=50000, help="tx_log rows per read")
+    ap.add_argument("--engine", action="append", choices=ENGINES, default=[],
+                    help="also replay the ops through this wallet engine (repeatable)")
+    ap.add_argument("--limit", type=int, default=None, help="rows replayed through each --engine")
+    ap.add_argument("--dir", default="", help="directory for the --engine scratch DBs (use the target storage)")
+    ap.add_argument("--repair", action="store_true", help="write the replayed balances to wallets (core stopped)")
+    args = ap.parse_args()
+    conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True, isolation_level=None)
+    res = replay(conn, args.batch)
+    balances = res.pop("balances")
+    res["engines"] = [bench_engine(name, conn, args.batch, args.limit, args.dir) for name in args.engine]
+    conn.close()
+    if args.repair and res["mismatches"]:
+        db = DB(args.db)
+        ts = db.now()
+        tags = set(balances) | set(db.load_balances())
+        db.write_batch([(tag, balances.get(tag, 0), ts) for tag in sorted(tags)], [], checkpoint=True)
+        res["repaired"] = len(tags)
+    print(json.dumps(res, indent=2))
+    if res["mismatches"] and not args.repair:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""Recompute the /api/stats rollups from tx_log and report drift.
+
+    python3 scripts/rebuild_rollups.py --db /data/eg.db [--check] [--since UNIX_TS]
+
+--check only counts the buckets that differ. Safe to run next to a live
+core: the rebuild is a single write transaction.
+"""
+import argparse, json, os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "core"))
+from app.db import DB
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--db", required=True)
+    ap.add_argument("--since", type=int, default=None, help="first second to recompute (default: oldest tx_log row)")
+    ap.add_argument("--check", action="store_true", help="report drift without rewriting the rollups")
+    args = ap.parse_args()
+    res = DB(args.db).rebuild_rollups(args.since, dry_run=args.check)
+    print(json.dumps(res))
+    if args.check and (res["drifted_buckets"] or res["drifted_totals"]):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+#!/usr/bin/env bash
+# Start N sharded core workers on this machine (Ctrl-C stops them all).
+#   scripts/run_shards.sh [N] [data dir]
+# Worker i listens on port 8000+i and uses <data dir>/eg-shard<i>.db.
+set -e
+
+N=${1:-2}
+DATA=${2:-./data}
+MQTT_HOST=${MQTT_HOST:-localhost}
+
+mkdir -p "$DATA"
+DATA=$(cd "$DATA" && pwd)
+cd "$(dirname "$0")/../core"
+trap 'kill $(jobs -p) 2>/dev/null' EXIT
+for ((i = 0; i < N; i++)); do
+  SHARD_COUNT=$N SHARD_INDEX=$i CORE_DEVICE_ID=core-$i MQTT_HOST=$MQTT_HOST \
+  DB_PATH="$DATA/eg-shard$i.db" TX_ARCHIVE_DIR="$DATA/archive-shard$i" \
+    uvicorn app.main:app --host 0.0.0.0 --port $((8000 + i)) --timeout-graceful-shutdown 5 &
+done
+wait
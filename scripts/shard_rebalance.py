@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Move wallets between shard DBs when SHARD_COUNT changes.
+
+    python3 scripts/shard_rebalance.py --db-pattern 'data/eg-shard{i}.db' --from 2 --to 4 [--dry-run]
+
+Run it with every core worker stopped. For each wallet whose owner changes,
+its wallets row, tx_log rows and tx_archive_totals row are copied into the
+new owner's DB (after deleting whatever that DB already holds for the tag),
+then removed from the old one. Each step is one transaction, so an
+interrupted run can simply be started again; the stats rollups of the
+touched shards are rebuilt from their tx_log at the end. Shards last run
+with WALLET_ENGINE=ledger first get their wallets brought up to date, and
+each copy records a balance checkpoint so the moved tx_log rows are not
+replayed on top of the moved balances. Payouts, night
+state and the kv table stay where they are (on the coordinator);
+processed_reqs are not moved, so replays of requests sent before the
+rebalance are not recognised.
+"""
+import argparse, os, sqlite3, sys
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "core"))
+from app.db import DB
+from app.ledger import recover_wallets
+from app.sharding import ShardMap
+
+TX_COLUMNS = "ts, device_id, op, tag_uid, amount_cents, details"
+
+def plan(pattern: str, old: int, new: ShardMap) -> Dict[Tuple[int, int], List[str]]:
+    """(from shard, to shard) -> tags to move."""
+    moves: Dict[Tuple[int, int], List[str]] = defaultdict(list)
+    for i in range(old):
+        path = pattern.format(i=i)
+        if not os.path.exists(path):
+            continue
+        conn = sqlite3.connect(path)
+        tags = [r[0] for r in conn.execute("SELECT tag_uid FROM wallets UNION SELECT tag_uid FROM tx_archive_totals")]
+        conn.close()
+        for tag in tags:
+            owner = new.owner(tag)
+            if owner != i:
+                moves[(i, owner)].append(tag)
+    return moves
+
+def oldest_tx(pattern: str, count: int) -> Optional[int]:
+    oldest = None
+    for i in range(count):
+        path = pattern.format(i=i)
+        if os.path.exists(path):
+            conn = sqlite3.connect(path)
+            ts = conn.execute("SELECT MIN(ts) FROM tx_log").fetchone()[0]
+            conn.close()
+            if ts is not None and (oldest is None or ts < oldest):
+                oldest = ts
+    return oldest
+
+def move(src_path: str, dst_path: str, tags: List[str]) -> int:
+    DB(dst_path)  # creates the file and applies migrations
+    conn = sqlite3.connect(dst_path, isolation_level=None)
+    conn.execute("ATTACH DATABASE ? AS src", (src_path,))
+    conn.execute("CREATE TEMP TABLE moving(tag_uid TEXT PRIMARY KEY)")
+    conn.executemany("INSERT OR IGNORE INTO moving VALUES(?)", [(t,) for t in tags])
+    tx_rows = conn.execute("SELECT COUNT(*) FROM src.tx_log WHERE tag_uid IN moving").fetchone()[0]
+    conn.execute("BEGIN IMMEDIATE")
+    for table in ("wallets", "tx_log", "tx_archive_totals"):
+        conn.execute(f"DELETE FROM main.{table} WHERE tag_uid IN moving")
+    conn.execute("INSERT INTO main.wallets SELECT * FROM src.wallets WHERE tag_uid IN moving")
+    conn.execute(f"INSERT INTO main.tx_log({TX_COLUMNS}) SELECT {TX_COLUMNS} FROM src.tx_log "
+                 "WHERE tag_uid IN moving ORDER BY id")
+    conn.execute("INSERT INTO main.tx_archive_totals SELECT * FROM src.tx_archive_totals WHERE tag_uid IN moving")
+    conn.execute("INSERT OR REPLACE INTO main.wallet_checkpoints(seq, ts, wallets) "
+                 "SELECT seq, CAST(strftime('%s', 'now') AS INTEGER), ? FROM main.sqlite_sequence WHERE name='tx_log'",
+                 (len(tags),))
+    conn.execute("COMMIT")
+    conn.execute("BEGIN IMMEDIATE")
+    for table in ("wallets", "tx_log", "tx_archive_totals"):
+        conn.execute(f"DELETE FROM src.{table} WHERE tag_uid IN moving")
+    conn.execute("COMMIT")
+    conn.close()
+    return tx_rows
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--db-pattern", required=True, help="shard DB path with {i}, e.g. data/eg-shard{i}.db")
+    ap.add_argument("--from", dest="old", type=int, required=True, help="current SHARD_COUNT")
+    ap.add_argument("--to", dest="new", type=int, required=True, help="new SHARD_COUNT")
+    ap.add_argument("--dry-run", action="store_true")
+    args = ap.parse_args()
+    if "{i}" not in args.db_pattern:
+        ap.error("--db-pattern must contain {i}")
+    moves = plan(args.db_pattern, args.old, ShardMap(args.new))
+    if not moves:
+        print("nothing to move")
+        return
+    since = oldest_tx(args.db_pattern, max(args.old, args.new))
+    if not args.dry_run:
+        for i in range(args.old):
+            path = args.db_pattern.format(i=i)
+            if os.path.exists(path):
+                recover_wallets(DB(path), "ledger")
+    for (src, dst), tags in sorted(moves.items()):
+        src_path, dst_path = args.db_pattern.format(i=src), args.db_pattern.format(i=dst)
+        if args.dry_run:
+            print(f"shard {src} -> {dst}: {len(tags)} wallets")
+            continue
+        tx_rows = move(src_path, dst_path, tags)
+        print(f"shard {src} -> {dst}: {len(tags)} wallets, {tx_rows} tx rows")
+    if not args.dry_run:
+        for i in sorted({i for pair in moves for i in pair}):
+            DB(args.db_pattern.format(i=i)).rebuild_rollups(since)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import os, sys
+
+import pytest
+
+# The core (core/app) and the agents (agents/common) are run from their own directories, not installed.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "core"))
+sys.path.insert(0, os.path.join(ROOT, "agents"))
+
+@pytest.fixture(params=["sqlite", "writebehind"])
+def engine(request, tmp_path):
+    """(db, wallet engine) on a fresh database."""
+    from app.db import DB
+    from app.wallet_cache import WriteBehindWallet
+    db = DB(str(tmp_path / "eg.db"))
+    if request.param == "sqlite":
+        yield db, db
+        return
+    wallet = WriteBehindWallet(db, flush_ms=1, commit_retries=0)
+    wallet.start()
+    yield db, wallet
+    wallet.stop()
+
+class RecordingBus:
+    def __init__(self):
+        self.sent = []
+
+    def publish(self, topic, obj, retain=False):
+        self.sent.append((topic, obj))
+        return True
+
+@pytest.fixture(scope="session")
+def core_app(tmp_path_factory):
+    # app.main builds its DB, engine and bus at import time from the environment.
+    os.environ.update(DB_PATH=str(tmp_path_factory.mktemp("core") / "eg.db"), DISPATCH_MODE="inline",
+                      WALLET_ENGINE="sqlite", SHARD_COUNT="1", TX_RETENTION_DAYS="0")
+    from app import main
+    return main
+
+@pytest.fixture
+def core(core_app, monkeypatch):
+    """app.main publishing to a RecordingBus (``core.bus.sent``), with an empty reply cache."""
+    from app.idempotency import ReplyCache
+    monkeypatch.setattr(core_app, "bus", RecordingBus())
+    monkeypatch.setattr(core_app, "replies", ReplyCache(core_app.db))
+    return core_app
@@ -0,0 +1,35 @@
+import asyncio, threading
+
+from app.db_executor import DBExecutor
+
+def test_run_from_plain_threads_uses_the_writer_thread():
+    dbx = DBExecutor()
+    seen = []
+
+    async def main():
+        dbx.start()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, dbx.run, lambda: seen.append(threading.current_thread().name))
+        await dbx.write(lambda: seen.append(threading.current_thread().name))
+        dbx.run(lambda: seen.append(threading.current_thread().name))  # from the loop thread too
+        dbx.stop()
+    asyncio.run(main())
+    assert seen == ["db-writer"] * 3
+
+def test_duplicate_in_flight_waits_for_the_original(core, monkeypatch):
+    handler = core.idempotent(core.on_wallet_credit_async)
+    msg = {"req_id": "inflight-1", "device_id": "slot-01", "tag_uid": "INF1", "amount_cents": 400}
+
+    async def main():
+        monkeypatch.setattr(core, "dbx", DBExecutor())
+        core.dbx.start()
+        try:
+            await asyncio.gather(handler("eg/core/wallet/credit", dict(msg)),
+                                 handler("eg/core/wallet/credit", dict(msg)))
+        finally:
+            core.dbx.stop()
+    asyncio.run(main())
+    assert core.db.get_balance("INF1") == 400
+    answers = [obj for topic, obj in core.bus.sent if topic == "eg/dev/slot-01/res"]
+    assert len(answers) == 2 and answers[0] == answers[1]
+    assert core.replies.hits == 1 and core.inflight == {}
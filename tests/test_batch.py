@@ -0,0 +1,68 @@
+import pytest
+
+from app.batch import batch_keys, claim_result, plan_batch
+
+READY = {"payout_id": "P1", "amount_cents": 500, "status": "ready"}
+
+def test_plan_applies_ops_in_order():
+    ops = [{"op": "credit", "tag_uid": "T1", "amount_cents": 100},
+           {"op": "settle_spin", "tag_uid": "T1", "bet_cents": 150, "win_cents": 300},
+           {"op": "payout_claim", "tag_uid": "T2", "payout_id": "P1"}]
+    plan = plan_batch("slot-01", ops, {"T1": 50, "T2": 0}, {"P1": READY}, 1000)
+    assert plan.ok and plan.failed_op is None
+    assert plan.balances == {"T1": 300, "T2": 500}
+    assert [r["new_balance_cents"] for r in plan.results] == [150, 300, 500]
+    assert [tx[2] for tx in plan.txs] == ["credit", "debit", "credit", "credit", "payout_claim"]
+    assert plan.claims == [("T2", 1000, "P1")]
+
+@pytest.mark.parametrize("ops, status, failed_op", [
+    ([{"op": "credit", "tag_uid": "T1", "amount_cents": 100},
+      {"op": "debit", "tag_uid": "T1", "amount_cents": 1000}], "insufficient", 1),
+    ([{"op": "credit", "tag_uid": "T1", "amount_cents": 100},
+      {"op": "payout_claim", "tag_uid": "T1", "payout_id": "P9"}], "not_found", 1),
+    ([{"op": "payout_claim", "tag_uid": "T1", "payout_id": "P1"},
+      {"op": "payout_claim", "tag_uid": "T1", "payout_id": "P1"}], "already_claimed", 1),
+])
+def test_failed_op_cancels_the_whole_batch(ops, status, failed_op):
+    plan = plan_batch("slot-01", ops, {"T1": 50}, {"P1": READY, "P9": None}, 1000)
+    assert (plan.status, plan.failed_op) == (status, failed_op)
+    assert plan.balances == {"T1": 50}
+    assert plan.txs == [] and plan.claims == [] and plan.results == []
+
+def test_claim_result():
+    plan = plan_batch("change-01", [{"op": "payout_claim", "tag_uid": "T1", "payout_id": "P1"}],
+                      {"T1": 0}, {"P1": dict(READY, status="claimed")}, 1000)
+    assert claim_result(plan) == ("already_claimed", None, None)
+
+@pytest.mark.parametrize("ops", [
+    [],
+    "debit",
+    [{"op": "refund", "tag_uid": "T1"}],
+    [{"op": "debit", "amount_cents": 1}],
+    [{"op": "debit", "tag_uid": "T1", "amount_cents": 0}],
+    [{"op": "credit", "tag_uid": "T1", "amount_cents": "ten"}],
+    [{"op": "settle_spin", "tag_uid": "T1", "bet_cents": 10, "win_cents": -1}],
+    [{"op": "payout_claim", "tag_uid": "T1"}],
+])
+def test_invalid_batches_are_rejected(ops):
+    with pytest.raises(ValueError):
+        batch_keys(ops)
+
+def test_batch_keys():
+    tags, payout_ids = batch_keys([{"op": "settle_spin", "tag_uid": "T1", "bet_cents": 10, "win_cents": 0},
+                                   {"op": "payout_claim", "tag_uid": "T2", "payout_id": "P1"}])
+    assert tags == {"T1", "T2"} and payout_ids == {"P1"}
+
+def test_engine_applies_a_failed_batch_nowhere(engine):
+    db, wallet = engine
+    db.insert_payout("P1", "roulette", 500, {})
+    wallet.credit("slot-01", "T1", 100, "credit")
+    plan = wallet.apply_batch("slot-01", [{"op": "payout_claim", "tag_uid": "T1", "payout_id": "P1"},
+                                          {"op": "debit", "tag_uid": "T2", "amount_cents": 10}])
+    assert plan.status == "insufficient"
+    assert wallet.get_balance("T1") == 100
+    assert [p["payout_id"] for p in db.list_ready_payouts()] == ["P1"]
+    plan = wallet.apply_batch("slot-01", [{"op": "payout_claim", "tag_uid": "T1", "payout_id": "P1"},
+                                          {"op": "debit", "tag_uid": "T1", "amount_cents": 550}])
+    assert plan.ok and plan.balances == {"T1": 50}
+    assert db.list_ready_payouts() == [] and db.get_balance("T1") == 50
@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from app.codec import BINARY, JSON, MAGIC, decode, negotiate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_core_and_agent_copies_are_identical():
+    with open(os.path.join(ROOT, "core", "app", "codec.py"), "rb") as core, \
+            open(os.path.join(ROOT, "agents", "common", "codec.py"), "rb") as agent:
+        assert core.read() == agent.read(), "core/app/codec.py and agents/common/codec.py have diverged"
+
+@pytest.mark.parametrize("msg", [
+    {"req_id": "r1", "device_id": "slot-01", "tag_uid": "AA01"},
+    {"req_id": "r2", "device_id": "slot-01", "tag_uid": "AA01", "amount_cents": 250, "reason": "bet"},
+    {"req_id": "r3", "device_id": "change-01", "payout_id": "P1", "tag_uid": "AA01"},
+    {"device_id": "slot-02", "step": 3, "choice": "B", "ts": "2026-01-01T00:00:00"},
+    {"payout_id": "P1", "source": "roulette", "amount_cents": 500},
+    {"req_id": "r4", "type": "wallet_get", "status": "ok", "balance_cents": 2 ** 40},
+    {"req_id": "r5", "type": "wallet_debit", "status": "insufficient", "new_balance_cents": 0},
+    {"req_id": "r6", "type": "payout_claim", "status": "already_claimed"},
+])
+def test_bin1_round_trip(msg):
+    data = BINARY.encode(msg)
+    assert data[0] == MAGIC
+    assert decode(data) == msg
+
+@pytest.mark.parametrize("msg", [
+    {"req_id": "r1", "device_id": "slot-01", "ops": [{"op": "debit"}]},  # no schema for batches
+    {"req_id": "r1", "device_id": "slot-01", "tag_uid": "x" * 256},      # string too long
+    {"req_id": "r1", "device_id": "slot-01", "tag_uid": "AA", "amount_cents": 2 ** 40, "reason": "bet"},
+])
+def test_unfit_messages_fall_back_to_json(msg):
+    data = BINARY.encode(msg)
+    assert data == JSON.encode(msg)
+    assert decode(data) == msg
+
+def test_decode_status_words_and_garbage():
+    assert decode(b"offline") == {"status": "offline"}
+    assert decode(b"") == {}
+    assert decode(bytes((MAGIC, 99, 0, 0))) == {}
+    assert decode(b"{not json") == {}
+
+def test_negotiate():
+    assert negotiate(["bin1", "json"]) == "bin1"
+    assert negotiate(["bin1", "json"], allowed=["json"]) == "json"
+    assert negotiate(["msgpack"]) == "json"
+    assert negotiate(None) == "json"
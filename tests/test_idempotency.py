@@ -0,0 +1,64 @@
+import time
+
+from app.idempotency import Reply, ReplyCache
+
+def credit_reply(req_id):
+    return Reply("slot-01", req_id, lambda bal: {"req_id": req_id, "type": "wallet_credit", "status": "ok",
+                                                 "new_balance_cents": bal})
+
+def test_reply_without_req_id_is_not_recorded():
+    reply = credit_reply(None)
+    assert reply.row(100, 0) is None
+    assert reply.payload["new_balance_cents"] == 100
+
+def test_cache_evicts_least_recently_used():
+    cache = ReplyCache(None, max_entries=2)
+    cache.put("d", "r1", {"n": 1})
+    cache.put("d", "r2", {"n": 2})
+    assert cache.get("d", "r1") == {"n": 1}
+    cache.put("d", "r3", {"n": 3})
+    assert cache.get("d", "r2") is None
+    assert cache.get("d", "r1") == {"n": 1} and cache.get("d", "r3") == {"n": 3}
+
+def test_cache_entries_expire():
+    cache = ReplyCache(None, ttl_s=10)
+    cache.put("d", "r1", {"n": 1})
+    cache._items[("d", "r1")] = (time.time() - 11, {"n": 1})
+    assert cache.get("d", "r1") is None and len(cache) == 0
+
+def test_reply_is_written_with_the_write(engine):
+    db, wallet = engine
+    reply = credit_reply("r1")
+    assert wallet.credit("slot-01", "T1", 300, "credit", reply) == 300
+    assert db.get_reply("slot-01", "r1", 0) == reply.payload
+    # A restarted core reloads it; an older one is still found on demand.
+    cache = ReplyCache(db)
+    cache.load()
+    assert cache.get("slot-01", "r1") == reply.payload
+    assert ReplyCache(db, ttl_s=0).recall("slot-01", "r1") == reply.payload
+
+def test_insufficient_debit_is_recorded(engine):
+    db, wallet = engine
+    reply = Reply("slot-01", "r1", lambda res: {"status": "ok" if res[0] else "insufficient"})
+    assert wallet.debit("slot-01", "T1", 300, "bet", reply) == (False, 0)
+    assert db.get_reply("slot-01", "r1", 0) == {"status": "insufficient"}
+
+def test_prune_keeps_recent_replies(engine):
+    db, wallet = engine
+    wallet.credit("slot-01", "T1", 300, "credit", credit_reply("r1"))
+    assert db.prune_replies(int(time.time()) - 60) == 0
+    assert db.prune_replies(int(time.time()) + 1) == 1
+    assert db.get_reply("slot-01", "r1", 0) is None
+
+def test_duplicate_request_is_applied_once(core):
+    handler = core.idempotent(core.on_wallet_credit)
+    msg = {"req_id": "dup-1", "device_id": "slot-01", "tag_uid": "DUP1", "amount_cents": 250}
+    handler("eg/core/wallet/credit", dict(msg))
+    handler("eg/core/wallet/credit", dict(msg))
+    # Offline replay after the memory cache was lost: answered from processed_reqs.
+    core.replies = ReplyCache(core.db)
+    handler("eg/core/wallet/credit", dict(msg, spooled_at=1))
+    assert core.db.get_balance("DUP1") == 250
+    answers = [obj for topic, obj in core.bus.sent if topic == "eg/dev/slot-01/res"]
+    assert len(answers) == 3
+    assert all(a == answers[0] for a in answers) and answers[0]["new_balance_cents"] == 250
@@ -0,0 +1,71 @@
+from app.db import DB
+from app.ledger import LedgerWallet, fold, load_ledger, recover_wallets
+
+def play(wallet):
+    wallet.credit("slot-01", "T1", 1000, "credit")
+    wallet.credit("slot-01", "T2", 300, "credit")
+    wallet.debit("slot-01", "T1", 250, "bet")
+    wallet.debit("slot-01", "T2", 900, "bet")  # insufficient: logged, no effect
+    wallet.apply_batch("slot-01", [{"op": "settle_spin", "tag_uid": "T2", "bet_cents": 100, "win_cents": 400}])
+
+EXPECTED = {"T1": 750, "T2": 600}
+
+def test_fold():
+    balances = {"T1": 10}
+    touched = set()
+    rows = [(1, "credit", "T1", 5), (2, "debit_insufficient", "T2", 99), (3, "payout_claim", "T1", 5),
+            (4, "debit", "T2", 3)]
+    assert fold(balances, rows, touched) == 4
+    assert balances == {"T1": 15, "T2": -3} and touched == {"T1", "T2"}
+    assert fold(balances, []) == 0
+
+def test_crash_replays_the_tail_after_the_checkpoint(tmp_path):
+    path = str(tmp_path / "eg.db")
+    wallet = LedgerWallet(DB(path), flush_ms=1, checkpoint_s=3600)
+    wallet.start()
+    try:
+        play(wallet)
+        # A second process opening the file now sees what a restart after a crash would.
+        db = DB(path)
+        assert db.load_balances() == {}
+        full = {}
+        fold(full, db.ledger_after(0, 1000))
+        assert full == EXPECTED
+        balances, seq, touched = load_ledger(db)
+        assert balances == EXPECTED and touched == {"T1", "T2"}
+        assert seq == db.ledger_after(0, 1000)[-1][0]
+        assert LedgerWallet(db).get_balance("T1") == 750
+        assert recover_wallets(db, "sqlite") == 2
+        assert db.load_balances() == EXPECTED
+    finally:
+        wallet.stop()
+
+def test_stop_checkpoints_every_balance(tmp_path):
+    db = DB(str(tmp_path / "eg.db"))
+    wallet = LedgerWallet(db, flush_ms=1, checkpoint_s=3600)
+    wallet.start()
+    play(wallet)
+    wallet.stop()
+    assert db.load_balances() == EXPECTED
+    assert db.last_checkpoint() == db.ledger_after(0, 1000)[-1][0]
+    assert load_ledger(db)[2] == set()
+    assert recover_wallets(db, "sqlite") == 0
+
+def test_periodic_checkpoint(tmp_path):
+    db = DB(str(tmp_path / "eg.db"))
+    wallet = LedgerWallet(db, flush_ms=1, checkpoint_s=0)
+    wallet.start()
+    try:
+        play(wallet)
+        assert db.load_balances() == EXPECTED
+        assert db.last_checkpoint() == db.ledger_after(0, 1000)[-1][0]
+    finally:
+        wallet.stop()
+
+def test_first_start_takes_the_wallets_table_as_checkpoint(tmp_path):
+    db = DB(str(tmp_path / "eg.db"))
+    play(db)
+    wallet = LedgerWallet(db, flush_ms=1)
+    assert wallet.get_balance("T1") == 750 and wallet.get_balance("T2") == 600
+    assert db.get_kv("wallet_engine") == "ledger"
+    assert load_ledger(db)[2] == set()
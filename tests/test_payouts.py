@@ -0,0 +1,25 @@
+from app.payouts import PayoutBook
+
+def test_refused_snapshot_is_retried():
+    sent, accept = [], [False]
+
+    def publish_snapshot(snap):
+        sent.append(snap["version"])
+        return accept[0]
+    book = PayoutBook(None, publish_delta=lambda delta: None, publish_snapshot=publish_snapshot)
+    book.add({"payout_id": "p1", "amount_cents": 100})
+    book.refresh_snapshot()
+    accept[0] = True
+    book.refresh_snapshot()
+    book.refresh_snapshot()
+    assert sent == [1, 1]
+
+def test_deltas_follow_versions():
+    deltas = []
+    book = PayoutBook(None, publish_delta=deltas.append, publish_snapshot=lambda snap: True)
+    book.add({"payout_id": "p1"})
+    book.add({"payout_id": "p1"})
+    book.remove("p1")
+    book.remove("p1")
+    assert [(d["version"], [a["payout_id"] for a in d["added"]], d["removed"]) for d in deltas] == \
+        [(1, ["p1"], []), (2, [], ["p1"])]
@@ -0,0 +1,90 @@
+import paho.mqtt.client as mqtt
+from app.codec import decode
+from app.mqtt_bus import MqttBus
+from app.publisher import PublishQueue
+
+class FakeClient:
+    """paho stand-in: refuses every publish while ``down``, records the others."""
+
+    def __init__(self):
+        self.down = True
+        self.sent = []
+        self.on_publish = None
+
+    def max_inflight_messages_set(self, n):
+        pass
+
+    def max_queued_messages_set(self, n):
+        pass
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        class Info:
+            rc = mqtt.MQTT_ERR_QUEUE_SIZE if self.down else mqtt.MQTT_ERR_SUCCESS
+        if not self.down:
+            self.sent.append((topic, decode(payload), retain))
+        return Info()
+
+def make_bus(max_queue):
+    bus = MqttBus("test", "localhost", 1883)
+    client = FakeClient()
+    bus._out = PublishQueue(client, bus._encode, max_queue=max_queue)
+    return bus, client
+
+def deliver(bus, client):
+    client.down = False
+    bus._out.start()
+    bus._out.stop(timeout=5)
+    return client.sent
+
+def topics(sent):
+    return [t for t, _, _ in sent]
+
+def test_retained_and_state_survive_a_full_queue():
+    bus, client = make_bus(max_queue=4)
+    for i in range(10):
+        bus.publish("eg/payouts/delta", {"version": i})
+    assert bus.publish("eg/state/mode", {"mode": "night"}, retain=True)
+    assert bus.publish("eg/payouts/snapshot", {"version": 9}, retain=True)
+    assert bus.publish("eg/night/result", {"step": 1})
+    assert bus.publish("eg/night/step", {"step": 2})
+    assert len(bus._out) == 8  # 4 deltas (the other 6 refused) and the 4 state messages
+    for i in range(40):
+        bus.publish(f"eg/dev/slot-{i:02d}/res", {"i": i})
+    assert len(bus._out) == 16
+    sent = deliver(bus, client)
+    assert topics(sent)[:4] == ["eg/state/mode", "eg/payouts/snapshot", "eg/night/result", "eg/night/step"]
+    assert ("eg/state/mode", {"mode": "night"}, True) in sent
+    assert ("eg/payouts/snapshot", {"version": 9}, True) in sent
+    assert "eg/payouts/delta" not in topics(sent)  # evicted before the device replies
+
+def test_device_messages_are_evicted_oldest_first():
+    bus, client = make_bus(max_queue=2)
+    for i in range(20):
+        bus.publish(f"eg/dev/slot-{i:02d}/res", {"i": i})
+    assert len(bus._out) == 8
+    assert [obj["i"] for _, obj, _ in deliver(bus, client)] == list(range(12, 20))
+
+def test_shard_forwards_are_never_evicted():
+    bus, client = make_bus(max_queue=2)
+    for i in range(10):
+        bus.publish("eg/core/shard/1/payouts/credit", {"i": i})
+        bus.publish(f"eg/dev/slot-{i:02d}/res", {"i": i})
+    sent = deliver(bus, client)
+    forwards = [obj["i"] for t, obj, _ in sent if t.startswith("eg/core/")]
+    assert forwards == list(range(10))
+
+def test_coalesce_keeps_last_value_at_first_position():
+    bus, client = make_bus(max_queue=8)
+    bus.publish("eg/night/tally", {"n": 1})
+    bus.publish("eg/dev/slot-01/res", {"i": 1})
+    bus.publish("eg/night/tally", {"n": 2})
+    assert deliver(bus, client) == [("eg/night/tally", {"n": 2}, False), ("eg/dev/slot-01/res", {"i": 1}, False)]
+
+def test_identical_retained_payload_is_sent_once():
+    bus, client = make_bus(max_queue=8)
+    client.down = False
+    bus._out.start()
+    bus.publish("eg/state/mode", {"mode": "day"}, retain=True)
+    bus.publish("eg/state/mode", {"mode": "day"}, retain=True)
+    bus._out.stop(timeout=5)
+    assert topics(client.sent) == ["eg/state/mode"]
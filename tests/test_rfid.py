@@ -0,0 +1,37 @@
+import asyncio, logging
+
+import pytest
+
+from common.rfid import SimulatedReader, TagPipeline, TagReader
+
+class FailingReader(TagReader):
+    def read(self, timeout):
+        raise OSError("port gone")
+
+def run_pipeline(reader, seconds, **kw):
+    async def main():
+        queue: asyncio.Queue = asyncio.Queue()
+        pipe = TagPipeline(reader, queue, asyncio.get_running_loop(), **kw)
+        pipe.start()
+        await asyncio.sleep(seconds)
+        pipe.stop()
+        events = []
+        while not queue.empty():
+            events.append(queue.get_nowait())
+        return pipe, events
+    return asyncio.run(main())
+
+def test_reader_must_implement_read():
+    with pytest.raises(TypeError):
+        TagReader()
+
+def test_card_is_debounced_then_removed():
+    reader = SimulatedReader([(0.0, "AA"), (0.15, None)], poll_ms=10)
+    pipe, events = run_pipeline(reader, 0.6, remove_ms=100, poll_ms=10)
+    assert [(e.kind, e.tag_uid) for e in events] == [("present", "AA"), ("removed", "AA")]
+    assert pipe.suppressed > 0
+
+def test_read_failure_is_logged(caplog):
+    with caplog.at_level(logging.WARNING, logger="common.rfid"):
+        run_pipeline(FailingReader(), 0.1)
+    assert "rfid read failed" in caplog.text
@@ -0,0 +1,75 @@
+import pytest
+from app.db import DB
+from app.idempotency import Reply
+from app.sharding import HASH_SPACE, ShardMap
+from app.wallet_cache import WalletUnavailable, WriteBehindWallet
+
+@pytest.mark.parametrize("count", [1, 2, 3, 5, 7])
+def test_ranges_partition_the_hash_space(count):
+    shards = ShardMap(count)
+    ranges = [shards.range(i) for i in range(count)]
+    assert ranges[0][0] == 0 and ranges[-1][1] == HASH_SPACE
+    assert all(ranges[i][1] == ranges[i + 1][0] for i in range(count - 1))
+    for slot in range(0, HASH_SPACE, 97):
+        lo, hi = ranges[slot * count // HASH_SPACE]
+        assert lo <= slot < hi
+
+def test_owner_matches_range():
+    shards = ShardMap(3)
+    for i in range(200):
+        tag = f"TAG{i:04d}"
+        lo, hi = shards.range(shards.owner(tag))
+        assert lo <= ShardMap.slot(tag) < hi
+
+def test_forward_topic_round_trip():
+    shards = ShardMap(4, index=1)
+    topic = shards.forward_topic(2, "eg/core/wallet/debit")
+    assert topic == "eg/core/shard/2/wallet/debit"
+    assert ShardMap.origin(topic) == "eg/core/wallet/debit"
+    assert shards.shared("eg/core/wallet/get") == "$share/core/eg/core/wallet/get"
+
+def test_batch_spanning_shards_has_no_owner():
+    shards = ShardMap(2)
+    a = next(f"A{i}" for i in range(100) if shards.owner(f"A{i}") == 0)
+    b = next(f"B{i}" for i in range(100) if shards.owner(f"B{i}") == 1)
+    assert shards.owner_of({"ops": [{"tag_uid": a}, {"tag_uid": a}]}) == 0
+    assert shards.owner_of({"ops": [{"tag_uid": a}, {"tag_uid": b}]}) is None
+
+def test_invalid_config():
+    with pytest.raises(ValueError):
+        ShardMap(2, index=2)
+
+def credit(wallet, req_id, tag="T1", payout_id="P1"):
+    reply = Reply("change-01", req_id, lambda res: {"req_id": req_id, "status": res[0], "new_balance_cents": res[2]})
+    return wallet.credit_forwarded_payout(payout_id, "roulette", 500, "change-01", tag, reply), reply
+
+def test_forwarded_payout_is_credited_once(engine):
+    db, wallet = engine
+    assert credit(wallet, "r1")[0] == ("ok", 500, 500)
+    assert credit(wallet, "r2")[0] == ("ok", 500, 500)  # redelivery / retried claim
+    assert credit(wallet, "r3", tag="T2")[0] == ("already_claimed", None, None)
+    assert db.get_balance("T1") == 500 and db.get_balance("T2") == 0
+    assert db.get_payout("P1")["claimed_by_tag"] == "T1"
+    assert db.list_ready_payouts() == []
+    ops = [r["op"] for r in db.query_tx(tag_uid="T1")[0]]
+    assert sorted(ops) == ["credit", "payout_claim"]
+    assert db.get_reply("change-01", "r1", 0)["status"] == "ok"
+
+def test_failed_credit_leaves_no_payout_row(tmp_path):
+    db = DB(str(tmp_path / "eg.db"))
+    wallet = WriteBehindWallet(db, flush_ms=1, commit_retries=0)
+    write_batch = db.write_batch
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("disk I/O error")
+    db.write_batch = broken
+    wallet.start()
+    try:
+        with pytest.raises(WalletUnavailable):
+            credit(wallet, "r1")
+        assert db.get_payout("P1") is None and wallet.get_balance("T1") == 0
+        db.write_batch = write_batch
+        assert credit(wallet, "r2")[0] == ("ok", 500, 500)
+    finally:
+        wallet.stop()
+    assert db.get_balance("T1") == 500 and db.list_ready_payouts() == []
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from app.topic_router import TopicRouter, strip_share
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_core_and_agent_copies_are_identical():
+    with open(os.path.join(ROOT, "core", "app", "topic_router.py"), "rb") as core, \
+            open(os.path.join(ROOT, "agents", "common", "topic_router.py"), "rb") as agent:
+        assert core.read() == agent.read(), "core/app/topic_router.py and agents/common/topic_router.py have diverged"
+
+def router(*patterns):
+    r = TopicRouter()
+    for p in patterns:
+        r.add(p, p)
+    return r
+
+def test_plus_matches_one_level():
+    r = router("eg/dev/+/res")
+    assert r.match("eg/dev/slot-01/res") == ("eg/dev/+/res",)
+    assert r.match("eg/dev/res") == ()
+    assert r.match("eg/dev/slot-01/x/res") == ()
+
+def test_hash_matches_the_parent_and_everything_below():
+    r = router("eg/#")
+    assert r.match("eg") == ("eg/#",)
+    assert r.match("eg/dev/slot-01/res") == ("eg/#",)
+    assert r.match("other/eg") == ()
+
+def test_wildcards_skip_dollar_topics():
+    r = router("#", "+/broker", "$SYS/#")
+    assert r.match("$SYS/broker") == ("$SYS/#",)
+    assert r.match("eg/broker") == ("#", "+/broker")
+
+def test_hash_must_be_last():
+    with pytest.raises(ValueError):
+        TopicRouter().add("eg/#/res", None)
+
+def test_share_prefix_is_stripped():
+    assert strip_share("$share/core/eg/core/wallet/debit") == "eg/core/wallet/debit"
+    assert strip_share("eg/core/wallet/debit") == "eg/core/wallet/debit"
+    r = router("$share/core/eg/core/wallet/+")
+    assert r.match("eg/core/wallet/debit") == ("$share/core/eg/core/wallet/+",)
+
+def test_handlers_in_subscription_order_without_duplicates():
+    r = TopicRouter()
+    r.add("eg/dev/+/res", "b")
+    r.add("eg/#", "a")
+    r.add("eg/dev/slot-01/res", "c")
+    r.add("eg/#", "a")
+    assert r.match("eg/dev/slot-01/res") == ("b", "a", "c")
+    assert len(r) == 3
+
+def test_remove_invalidates_the_cache():
+    r = TopicRouter()
+    r.add("eg/+", "a")
+    r.add("eg/+", "b")
+    assert r.match("eg/x") == ("a", "b")
+    assert r.remove("eg/+", "a")
+    assert r.match("eg/x") == ("b",)
+    assert r.remove("eg/+")
+    assert r.match("eg/x") == ()
+    assert not r.remove("eg/none")
+    assert len(r) == 0
+
+def test_cache_is_bounded():
+    r = TopicRouter(cache_size=2)
+    r.add("#", "a")
+    for i in range(5):
+        r.match(f"t/{i}")
+    assert len(r._cache) == 2
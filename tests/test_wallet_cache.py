@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from app.db import DB
+from app.wallet_cache import WalletUnavailable, WriteBehindWallet
+
+@pytest.fixture
+def db(tmp_path):
+    return DB(str(tmp_path / "eg.db"))
+
+def break_commits(db, failures):
+    # The next ``failures`` group commits raise, like a full disk would.
+    write_batch = db.write_batch
+    calls = []
+
+    def flaky(*args, **kwargs):
+        calls.append(len(args[1]))
+        if len(calls) <= failures:
+            raise RuntimeError("disk I/O error")
+        return write_batch(*args, **kwargs)
+    db.write_batch = flaky
+    return calls
+
+def test_failed_commit_raises_and_restores_balances(db):
+    wallet = WriteBehindWallet(db, flush_ms=1, commit_retries=0)
+    wallet.start()
+    try:
+        assert wallet.credit("slot-01", "T1", 1000, "credit") == 1000
+        calls = break_commits(db, 1)
+        with pytest.raises(WalletUnavailable):
+            wallet.debit("slot-01", "T1", 300, "bet")
+        assert wallet.get_balance("T1") == 1000
+        assert wallet.debit("slot-01", "T1", 300, "bet") == (True, 700)
+        assert len(calls) == 2
+    finally:
+        wallet.stop()
+    assert db.get_balance("T1") == 700
+    assert [r["op"] for r in db.query_tx(tag_uid="T1")[0]].count("debit") == 1
+
+def test_new_wallet_disappears_on_rollback(db):
+    wallet = WriteBehindWallet(db, flush_ms=1, commit_retries=0)
+    break_commits(db, 1)
+    wallet.start()
+    try:
+        with pytest.raises(WalletUnavailable):
+            wallet.credit("slot-01", "T1", 500, "credit")
+        assert wallet.get_balance("T1") == 0
+    finally:
+        wallet.stop()
+    assert db.load_balances() == {}
+
+def test_commit_is_retried(db):
+    wallet = WriteBehindWallet(db, flush_ms=1, commit_retries=1)
+    calls = break_commits(db, 1)
+    wallet.start()
+    try:
+        assert wallet.credit("slot-01", "T1", 500, "credit") == 500
+    finally:
+        wallet.stop()
+    assert len(calls) == 2 and db.get_balance("T1") == 500
+
+def test_begin_queues_one_group_commit(db):
+    calls = break_commits(db, 0)
+    wallet = WriteBehindWallet(db, flush_ms=1)
+
+    async def main():
+        seqs = [wallet.begin("credit", "slot-01", f"T{i}", 100, "credit")[1] for i in range(20)]
+        wallet.start()
+        await asyncio.gather(*(wallet.durable(s) for s in seqs))
+    try:
+        asyncio.run(main())
+    finally:
+        wallet.stop()
+    assert calls == [20]
+    assert sum(db.load_balances().values()) == 2000
+
+def test_ops_queued_behind_a_failed_batch_are_dropped(db):
+    wallet = WriteBehindWallet(db, flush_ms=1, commit_retries=0)
+    break_commits(db, 1)
+
+    async def main():
+        (bal, s1) = wallet.begin("credit", "slot-01", "T1", 500, "credit")
+        ((ok, left), s2) = wallet.begin("debit", "slot-01", "T1", 400, "bet")
+        assert bal == 500 and ok and left == 100
+        wallet.start()
+        results = await asyncio.gather(wallet.durable(s1), wallet.durable(s2), return_exceptions=True)
+        assert all(isinstance(r, WalletUnavailable) for r in results)
+    try:
+        asyncio.run(main())
+        assert wallet.get_balance("T1") == 0
+    finally:
+        wallet.stop()
+    assert db.query_tx(tag_uid="T1")[0] == []
+
+def test_writer_runs_the_commits(db):
+    ran = []
+
+    def writer(fn, *args):
+        ran.append(fn.__name__)
+        return fn(*args)
+    wallet = WriteBehindWallet(db, flush_ms=1, writer=writer)
+    wallet.start()
+    try:
+        wallet.credit("slot-01", "T1", 100, "credit")
+    finally:
+        wallet.stop()
+    assert ran == ["write_batch"]
@@ -27,18 +27,41 @@ function App() {
         host: mqttHost, 
         port: mqttPort, 
         path: mqttPath, 
-        clientId: deviceId + "-ui" 
+        clientId: deviceId + "-ui",
+        statusTopic: `eg/dev/${deviceId}/status`
       });
       clientRef.current = client;
-      client.subscribe("eg/dev/change-01/payouts");
+      // Liste versionnée : snapshot retained + deltas ; resync si un delta manque.
+      const book = { epoch: null, version: -1, items: [] };
+      const applySnapshot = (snap) => {
+        if (snap.epoch === book.epoch && snap.version < book.version) return;
+        Object.assign(book, { epoch: snap.epoch, version: snap.version, items: snap.items || [] });
+        setPayouts(book.items);
+      };
+      const applyDelta = (d) => {
+        if (d.epoch === book.epoch && d.version <= book.version) return;
+        if (d.epoch !== book.epoch || d.version !== book.version + 1) {
+          pub("eg/core/payouts/sync", { device_id: deviceId });
+          return;
+        }
+        const removed = new Set(d.removed || []);
+        book.items = book.items.filter(p => !removed.has(p.payout_id)).concat(d.added || []);
+        book.version = d.version;
+        setPayouts(book.items);
+      };
+      client.subscribe("eg/payouts/snapshot");
+      client.subscribe("eg/payouts/delta");
+      client.subscribe(`eg/dev/${deviceId}/payouts`);
       client.subscribe(`eg/dev/${deviceId}/res`);
       client.onMessageArrived = (m) => {
         const topic = m.destinationName;
         let payload = {};
         try { payload = JSON.parse(m.payloadString); } catch {}
-        if (topic === "eg/dev/change-01/payouts") setPayouts(payload.items || []);
+        if (topic === "eg/payouts/snapshot" || topic === `eg/dev/${deviceId}/payouts`) applySnapshot(payload);
+        if (topic === "eg/payouts/delta") applyDelta(payload);
         if (topic === `eg/dev/${deviceId}/res`) setLastRes(payload);
       };
+      pub(`eg/dev/${deviceId}/hello`, { type: "change", version: "1.0.0", ts: Date.now().toString() });
     })();
   }, []);
 
@@ -1,9 +1,20 @@
 import { Client, Message } from "paho-mqtt";
-export function connectMQTT({ host="localhost", port=9001, path="/mqtt", clientId }) {
+// statusTopic: retained "online" once connected, "offline" as LWT (core presence registry)
+export function connectMQTT({ host="localhost", port=9001, path="/mqtt", clientId, statusTopic }) {
   return new Promise((resolve, reject) => {
     const c = new Client(host, Number(port), path, clientId);
     c.onConnectionLost = () => console.warn("MQTT lost");
-    c.connect({ timeout: 5, useSSL: false, onSuccess: () => resolve(c), onFailure: reject });
+    const status = (text) => {
+      const m = new Message(text);
+      m.destinationName = statusTopic;
+      m.qos = 1;
+      m.retained = true;
+      return m;
+    };
+    const opts = { timeout: 5, useSSL: false, onFailure: reject,
+                   onSuccess: () => { if (statusTopic) c.send(status("online")); resolve(c); } };
+    if (statusTopic) opts.willMessage = status("offline");
+    c.connect(opts);
   });
 }
 export { Message };
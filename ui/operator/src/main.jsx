@@ -1,4 +1,4 @@
-import React, { useState } from "react";
+import React, { useEffect, useState } from "react";
 import { createRoot } from "react-dom/client";
 
 function App() {
@@ -15,6 +15,20 @@ function App() {
   const [question, setQuestion] = useState("Choix ?");
   const [options, setOptions] = useState("A,B,C");
   const [log, setLog] = useState("");
+  const [live, setLive] = useState({ mode: null, tally: null, result: null, payouts: null });
+
+  // Flux serveur /api/events : EventSource se reconnecte seul en renvoyant Last-Event-ID.
+  useEffect(() => {
+    const es = new EventSource(base + "/api/events");
+    const on = (name, fn) => es.addEventListener(name, (e) => fn(JSON.parse(e.data)));
+    on("mode", (d) => setLive((l) => ({ ...l, mode: d.mode })));
+    on("night_step", () => setLive((l) => ({ ...l, tally: null, result: null })));
+    on("night_tally", (d) => setLive((l) => ({ ...l, tally: d })));
+    on("night_result", (d) => setLive((l) => ({ ...l, result: d })));
+    on("payouts_delta", (d) => setLive((l) => ({ ...l, payouts: d.version })));
+    on("reset", () => setLog((l) => l + "\nevents: reset (reprise impossible, état à recharger)"));
+    return () => es.close();
+  }, [base]);
 
   const post = async (path, body) => {
     const res = await fetch(base + path, { method: "POST", headers: { "content-type": "application/json" }, body: JSON.stringify(body) });
@@ -43,6 +57,14 @@ function App() {
         <button onClick={()=>post("/api/night/step", { step, question, options: options.split(",").map(s=>s.trim()).filter(Boolean) })} style={{ marginTop: 8 }}>Send Step</button>
       </div>
 
+      <div style={{ border: "1px solid #ddd", padding: 12, marginTop: 12 }}>
+        <h3>Live</h3>
+        <div>Mode: {live.mode ?? "?"}</div>
+        <div>Tally: {live.tally ? `step ${live.tally.step} — ${live.tally.votes}/${live.tally.expected} ${JSON.stringify(live.tally.counts)}` : "-"}</div>
+        <div>Résultat: {live.result ? `${live.result.winner} (step ${live.result.step})` : "-"}</div>
+        <div>Payouts version: {live.payouts ?? "-"}</div>
+      </div>
+
       <pre style={{ marginTop: 16, whiteSpace: "pre-wrap" }}>{log}</pre>
     </div>
   );
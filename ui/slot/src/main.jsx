@@ -37,6 +37,7 @@ function App() {
       client.subscribe("eg/state/mode");
       client.subscribe(`eg/dev/${deviceId}/res`);
       client.subscribe("eg/night/step");
+      client.subscribe(`eg/dev/${deviceId}/night/step`);
 
       client.onMessageArrived = (m) => {
         const topic = m.destinationName;
@@ -46,7 +47,7 @@ function App() {
         else if (topic === `eg/dev/${deviceId}/res`) {
           if (payload.type === "wallet_get") setBalance(payload.balance_cents);
           if (payload.type === "wallet_debit" || payload.type === "wallet_credit") setBalance(payload.new_balance_cents);
-        } else if (topic === "eg/night/step") {
+        } else if (topic === "eg/night/step" || topic === `eg/dev/${deviceId}/night/step`) {
           setStep(payload.step); setQuestion(payload.question); setOptions(payload.options || []);
         }
       };